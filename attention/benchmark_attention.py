@@ -0,0 +1,263 @@
+#!/usr/bin/env python3 -u
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Benchmark the attention layers registered in fairseq/models/fconv.py on the
+CPU: for every variant and every batch size, target length and source
+length, the time of a training forward/backward pass, the time of one
+incremental decoding step (with the source projections cached in the
+incremental state, and recomputed as without the cache), the peak memory
+and the number of parameters. Decoding steps run without weight
+normalization, as in generation.
+
+The variant multihead-loop is the multihead layer computed head by head,
+as before its heads were fused.
+
+With --decoder-attention-scores, it also times one incremental decoding
+step of the whole decoder for each of the given settings.
+
+Each measurement runs in a fresh process so that its peak resident memory
+(ru_maxrss, above what the process holds after building the layer and its
+inputs) is not hidden by an earlier, larger one.
+"""
+
+import argparse
+import itertools
+import math
+import multiprocessing
+import resource
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from fairseq.dictionary import Dictionary
+from fairseq.models.fconv import ATTENTION_REGISTRY, FConvDecoder, weight_of
+
+
+# standard deviation of the random embeddings and encoder outputs, that of
+# the embeddings of a new model; with unit variance the attention scores
+# saturate the softmax and many of its outputs are denormal floats, which
+# make the matrix products several times slower
+INPUT_STD = 0.1
+
+
+def random_input(*size):
+    return torch.randn(*size) * INPUT_STD
+
+
+def remove_weight_norm_(module):
+    """Remove weight normalization, as FairseqModel.make_generation_fast_
+    does before generation."""
+    def apply_remove_weight_norm(module):
+        try:
+            nn.utils.remove_weight_norm(module)
+        except ValueError:  # this module didn't have weight norm
+            return
+    module.apply(apply_remove_weight_norm)
+
+
+def peak_rss_mb():
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+class MultiHeadLoop(nn.Module):
+    """MultiHeadAttentionLayer computed as before its heads were fused: a
+    query, key and value projection and two bmm's per head, in a Python
+    loop, with nothing cached between decoding steps. It has the weights of
+    *layer*, so it gives the same output."""
+
+    def __init__(self, layer):
+        super().__init__()
+        self.num_heads = layer.num_heads
+        self.in_projection = layer.in_projection
+        self.out_projection = layer.out_projection
+        rows = [slice(i * layer.head_dim, (i + 1) * layer.head_dim) for i in range(layer.num_heads)]
+
+        def per_head(projection):
+            weight = weight_of(projection).detach()
+            heads = nn.ModuleList()
+            for r in rows:
+                head = nn.Linear(weight.size(1), layer.head_dim)
+                head.weight.data.copy_(weight[r])
+                head.bias.data.copy_(projection.bias.data[r])
+                heads.append(head)
+            return heads
+
+        self.multi_head_query = per_head(layer.query_projection)
+        self.multi_head_key = per_head(layer.key_projection)
+        self.multi_head_value = per_head(layer.value_projection)
+
+    def forward(self, x, target_embedding, encoder_out, incremental_state=None):
+        residual = x
+        x = (self.in_projection(x) + target_embedding) * math.sqrt(0.5)
+        outputs, attn_scores = [], 0
+        for query, key, value in zip(self.multi_head_query, self.multi_head_key, self.multi_head_value):
+            scores = F.softmax(torch.bmm(query(x), key(encoder_out[0].transpose(1, 2)).transpose(1, 2)), dim=2)
+            outputs.append(torch.bmm(scores, value(encoder_out[1])))
+            attn_scores = attn_scores + scores
+        x = torch.cat(outputs, dim=2)
+        s = encoder_out[1].size(1)
+        x = x * (s * math.sqrt(1.0 / s))
+        x = (self.out_projection(x) + residual) * math.sqrt(0.5)
+        return x, attn_scores / self.num_heads
+
+
+def build_layer(args, variant):
+    if variant == 'multihead-loop':
+        return MultiHeadLoop(ATTENTION_REGISTRY['multihead'](args.conv_channels, args.embed_dim))
+    return ATTENTION_REGISTRY[variant](args.conv_channels, args.embed_dim)
+
+
+def timed(fn, repeat):
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def measure(args, variant, bsz, tgt_len, src_len, mode):
+    """Seconds per call and peak memory (MB) of *mode* ('train', 'step' or
+    'uncached', a step that recomputes the source projections)."""
+    torch.set_num_threads(args.cpu_threads)
+    torch.manual_seed(1)
+    width = args.embed_dim + args.embed_dim
+    layer = build_layer(args, variant)
+    encoder_out = (random_input(bsz, width, src_len), random_input(bsz, src_len, width))
+
+    if mode == 'train':
+        layer.train()
+        x = torch.randn(bsz, tgt_len, args.conv_channels, requires_grad=True)
+        target_embedding = random_input(bsz, tgt_len, width)
+
+        def run():
+            out, _ = layer(x, target_embedding, encoder_out)
+            out.sum().backward()
+    else:
+        layer.eval()
+        remove_weight_norm_(layer)
+        x = torch.randn(bsz, 1, args.conv_channels)
+        target_embedding = random_input(bsz, 1, width)
+        incremental_state = {}
+        # the source projections are cached at the first step
+        layer(x, target_embedding, encoder_out, incremental_state)
+
+        def run():
+            with torch.no_grad():
+                layer(x, target_embedding, encoder_out, incremental_state if mode == 'step' else {})
+
+    before = peak_rss_mb()
+    seconds = timed(run, args.repeat)
+    return seconds, peak_rss_mb() - before
+
+
+def measure_decoder(args, variant, attention_scores, bsz, src_len):
+    """Seconds per incremental decoding step of a decoder of
+    --decoder-layers layers, all with attention, whose layers compute their
+    scores as given by *attention_scores*."""
+    torch.set_num_threads(args.cpu_threads)
+    torch.manual_seed(1)
+    dictionary = Dictionary()
+    for i in range(args.vocab_size):
+        dictionary.add_symbol(str(i))
+    decoder = FConvDecoder(
+        dictionary, embed_dim=args.embed_dim, out_embed_dim=args.embed_dim // 2,
+        convolutions=((args.conv_channels, 3),) * args.decoder_layers,
+        attention_type=variant, attention_scores=eval(attention_scores), dropout=0.,
+    )
+    decoder.eval()
+    remove_weight_norm_(decoder)
+    width = args.embed_dim + args.embed_dim
+    encoder_out = (random_input(bsz, src_len, width), random_input(bsz, src_len, width))
+    doctopic = random_input(bsz, args.embed_dim)
+    tokens = torch.full((bsz, 1), dictionary.eos(), dtype=torch.long)
+    incremental_state = {}
+    # the source projections are cached at the first step
+    decoder(tokens, encoder_out, doctopic, incremental_state)
+
+    def run():
+        with torch.no_grad():
+            decoder(tokens, encoder_out, doctopic, incremental_state)
+
+    return timed(run, args.repeat)
+
+
+def _measure_in_child(queue, fn, *args):
+    queue.put(fn(*args))
+
+
+def measure_in_process(fn, *args):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_measure_in_child, args=(queue, fn) + args)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(args):
+    variants = args.variants or sorted(ATTENTION_REGISTRY)
+    print('| {:<10} {:>5} {:>5} {:>5} {:>10} {:>12} {:>10} {:>12} {:>10} {:>12}'.format(
+        'variant', 'bsz', 'tgt', 'src', 'params', 'train ms', 'train MB', 'step ms', 'step MB',
+        'uncached ms'))
+    for variant in variants:
+        layer = build_layer(args, variant)
+        num_params = sum(p.numel() for p in layer.parameters())
+        steps = {}  # the decoding step does not depend on the target length
+        for bsz, tgt_len, src_len in itertools.product(args.batch_sizes, args.tgt_lens, args.src_lens):
+            train_s, train_mb = measure_in_process(measure, args, variant, bsz, tgt_len, src_len, 'train')
+            if (bsz, src_len) not in steps:
+                steps[bsz, src_len] = (
+                    measure_in_process(measure, args, variant, bsz, 1, src_len, 'step'),
+                    measure_in_process(measure, args, variant, bsz, 1, src_len, 'uncached')[0],
+                )
+            (step_s, step_mb), uncached_s = steps[bsz, src_len]
+            print('| {:<10} {:>5} {:>5} {:>5} {:>10} {:>12.2f} {:>10.1f} {:>12.3f} {:>10.1f} {:>12.3f}'.format(
+                variant, bsz, tgt_len, src_len, num_params,
+                train_s * 1000, train_mb, step_s * 1000, step_mb, uncached_s * 1000))
+
+    if args.decoder_attention_scores:
+        print('| decoder step ({} layers), ms'.format(args.decoder_layers))
+        print('| {:<10} {:>5} {:>5} {:>12}  {}'.format('variant', 'bsz', 'src', 'step ms', 'attention scores'))
+        for variant in [variant for variant in variants if variant in ATTENTION_REGISTRY]:
+            for bsz, src_len in itertools.product(args.batch_sizes, args.src_lens):
+                for attention_scores in args.decoder_attention_scores:
+                    step_s = measure_in_process(measure_decoder, args, variant, attention_scores, bsz, src_len)
+                    print('| {:<10} {:>5} {:>5} {:>12.3f}  {}'.format(
+                        variant, bsz, src_len, step_s * 1000, attention_scores))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the decoder attention variants on the CPU')
+    parser.add_argument('--variants', nargs='+', choices=sorted(ATTENTION_REGISTRY) + ['multihead-loop'],
+                        help='attention variants to benchmark (default: all registered ones);'
+                             ' multihead-loop is multihead with a loop over the heads')
+    parser.add_argument('--embed-dim', default=512, type=int, metavar='N',
+                        help='decoder embedding dimension')
+    parser.add_argument('--conv-channels', default=512, type=int, metavar='N',
+                        help='channels of the decoder convolutions')
+    parser.add_argument('--batch-sizes', nargs='+', default=[8, 32], type=int, metavar='N')
+    parser.add_argument('--tgt-lens', nargs='+', default=[32, 64], type=int, metavar='N',
+                        help='target lengths of the training pass')
+    parser.add_argument('--src-lens', nargs='+', default=[200, 400, 800], type=int, metavar='N')
+    parser.add_argument('--repeat', default=10, type=int, metavar='N',
+                        help='timed calls per measurement')
+    parser.add_argument('--cpu-threads', default=1, type=int, metavar='N',
+                        help='number of threads used by torch')
+    parser.add_argument('--decoder-attention-scores', nargs='+', metavar='EXPR',
+                        help='also time a decoding step of the whole decoder for each of these'
+                             ' --decoder-attention-scores settings')
+    parser.add_argument('--decoder-layers', default=20, type=int, metavar='N',
+                        help='layers of the decoder timed with --decoder-attention-scores')
+    parser.add_argument('--vocab-size', default=10000, type=int, metavar='N',
+                        help='target vocabulary of the decoder timed with --decoder-attention-scores')
+    main(parser.parse_args())
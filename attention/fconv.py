@@ -12,6 +12,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.nn.utils.weight_norm import WeightNorm
 
 
 from fairseq import utils
@@ -44,6 +45,11 @@ class FConvModel(FairseqModel):
                             help='decoder output embedding dimension')
         parser.add_argument('--decoder-attention', type=str, metavar='EXPR',
                             help='decoder attention [True, ...]')
+        parser.add_argument('--decoder-attention-type', choices=sorted(ATTENTION_REGISTRY),
+                            help='attention layer of the decoder')
+        parser.add_argument('--decoder-attention-scores', type=str, metavar='EXPR',
+                            help='decoder attention layers computing their scores [True, ...];'
+                                 ' the others reuse the scores of the previous attention layer')
         parser.add_argument('--share-input-output-embed', action='store_true',
                             help='share input and output embeddings (requires'
                                  ' --decoder-out-embed-dim and --decoder-embed-dim'
@@ -65,6 +71,8 @@ class FConvModel(FairseqModel):
             convolutions=eval(args.decoder_layers),
             out_embed_dim=args.decoder_out_embed_dim,
             attention=eval(args.decoder_attention),
+            attention_type=getattr(args, 'decoder_attention_type', 'multihead'),
+            attention_scores=eval(getattr(args, 'decoder_attention_scores', 'True')),
             dropout=args.dropout,
             max_positions=args.max_target_positions,
             share_embed=args.share_input_output_embed
@@ -176,9 +184,28 @@ class FConvEncoder(FairseqEncoder):
         """Maximum input length supported by the encoder."""
         return self.embed_positions.max_positions()
 
+ATTENTION_REGISTRY = {}
+
+
+def register_attention(name):
+    """Decorator registering an attention layer class under *name*, which
+    can then be selected with --decoder-attention-type. The class is built
+    as cls(conv_channels, embed_dim)."""
+    def register_attention_cls(cls):
+        if name in ATTENTION_REGISTRY:
+            raise ValueError('Cannot register duplicate attention ({})'.format(name))
+        ATTENTION_REGISTRY[name] = cls
+        return cls
+    return register_attention_cls
+
+
 # original attension
-'''
-class AttentionLayer(nn.Module):
+@register_attention('dot')
+class DotAttentionLayer(nn.Module):
+    # submodules only used to compute the attention scores, which layers
+    # reusing the scores of an earlier layer do not have
+    scoring_modules = ('in_projection',)
+
     def __init__(self, conv_channels, embed_dim, bmm=None):
         super().__init__()
         # projects from output of convolution to embedding dimension
@@ -188,7 +215,7 @@ class AttentionLayer(nn.Module):
 
         self.bmm = bmm if bmm is not None else torch.bmm
 
-    def forward(self, x, target_embedding, encoder_out):
+    def forward(self, x, target_embedding, encoder_out, incremental_state=None):
         residual = x
 
         # attention
@@ -196,12 +223,16 @@ class AttentionLayer(nn.Module):
         x = self.bmm(x, encoder_out[0]) # d_i*z_i
 
         # softmax over last dim
-        sz = x.size()
-        x = F.softmax(x.view(sz[0] * sz[1], sz[2]), dim=1)
-        x = x.view(sz)
+        x = F.softmax(x, dim=2)
         attn_scores = x # a_i_j
 
-        x = self.bmm(x, encoder_out[1]) # get c_i
+        return self.attend(residual, attn_scores, encoder_out), attn_scores
+
+    def attend(self, x, attn_scores, encoder_out, incremental_state=None):
+        """Output of the layer for input x and attention scores a_i_j
+        (B x T x S), which may be those of an earlier layer."""
+        residual = x
+        x = self.bmm(attn_scores, encoder_out[1]) # get c_i
 
         # scale attention output
         s = encoder_out[1].size(1)
@@ -209,17 +240,201 @@ class AttentionLayer(nn.Module):
 
         # project back
         x = (self.out_projection(x) + residual) * math.sqrt(0.5)
-        return x, attn_scores
+        return x
 
     def make_generation_fast_(self, beamable_mm_beam_size=None, **kwargs):
         """Replace torch.bmm with BeamableMM."""
         if beamable_mm_beam_size is not None:
             del self.bmm
             self.add_module('bmm', BeamableMM(beamable_mm_beam_size))
-'''
-'''
+
+
+# chunked attension for long sources
+class ChunkedAttentionFunction(torch.autograd.Function):
+    """softmax(query keys) values, computed over chunks of chunk_size source
+    positions with a running maximum and normalizer (online softmax).
+
+    Neither forward nor backward builds a B x T x S tensor: backward keeps
+    only the inputs, the output and the log-normalizer (B x T x 1), and
+    recomputes the probabilities chunk by chunk.
+    """
+
+    @staticmethod
+    def forward(ctx, query, keys, values, chunk_size):
+        bsz, tgt_len = query.size(0), query.size(1)
+        row_max = query.new_full((bsz, tgt_len, 1), float('-inf'))
+        normalizer = query.new_zeros(bsz, tgt_len, 1)
+        out = query.new_zeros(bsz, tgt_len, values.size(2))
+        for j in range(0, keys.size(2), chunk_size):
+            scores = torch.bmm(query, keys[:, :, j:j + chunk_size])
+            new_max = torch.max(row_max, scores.max(dim=2, keepdim=True)[0])
+            correction = torch.exp(row_max - new_max)
+            probs = torch.exp(scores - new_max)
+            normalizer.mul_(correction).add_(probs.sum(dim=2, keepdim=True))
+            out.mul_(correction).baddbmm_(probs, values[:, j:j + chunk_size])
+            row_max = new_max
+        out.div_(normalizer)
+
+        ctx.chunk_size = chunk_size
+        ctx.save_for_backward(query, keys, values, out, row_max + torch.log(normalizer))
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        query, keys, values, out, log_normalizer = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        # d loss / d scores = probs * (grad_out values^T - sum(grad_out * out))
+        delta = (grad_out * out).sum(dim=2, keepdim=True)
+        grad_query = torch.zeros_like(query)
+        grad_keys = torch.zeros_like(keys)
+        grad_values = torch.zeros_like(values)
+        for j in range(0, keys.size(2), chunk_size):
+            chunk_keys = keys[:, :, j:j + chunk_size]
+            chunk_values = values[:, j:j + chunk_size]
+            probs = torch.exp(torch.bmm(query, chunk_keys) - log_normalizer)
+            grad_values[:, j:j + chunk_size] = torch.bmm(probs.transpose(1, 2), grad_out)
+            grad_scores = probs * (torch.bmm(grad_out, chunk_values.transpose(1, 2)) - delta)
+            grad_query.baddbmm_(grad_scores, chunk_keys.transpose(1, 2))
+            grad_keys[:, :, j:j + chunk_size] = torch.bmm(query.transpose(1, 2), grad_scores)
+        return grad_query, grad_keys, grad_values, None
+
+
+@register_attention('chunked')
+class ChunkedAttentionLayer(DotAttentionLayer):
+    """The original dot attention, computed by ChunkedAttentionFunction over
+    chunks of *chunk_size* source positions for full target sequences, so
+    that its memory does not grow with T x S. The attention scores are not
+    built and None is returned for them; incremental decoding (one target
+    position) uses the dense attention and returns them. The parameters are
+    those of DotAttentionLayer.
+    """
+    def __init__(self, conv_channels, embed_dim, bmm=None, chunk_size=128):
+        super().__init__(conv_channels, embed_dim, bmm)
+        self.chunk_size = chunk_size
+
+    def forward(self, x, target_embedding, encoder_out, incremental_state=None):
+        if incremental_state is not None:
+            return super().forward(x, target_embedding, encoder_out, incremental_state)
+        residual = x
+
+        # attention
+        x = (self.in_projection(x) + target_embedding) * math.sqrt(0.5) # d_i
+        x = ChunkedAttentionFunction.apply(x, encoder_out[0], encoder_out[1], self.chunk_size) # get c_i
+
+        # scale attention output
+        s = encoder_out[1].size(1)
+        x = x * (s * math.sqrt(1.0 / s))
+
+        # project back
+        x = (self.out_projection(x) + residual) * math.sqrt(0.5)
+        return x, None
+
+
+# local attension for long sources
+@register_attention('local')
+class LocalAttentionLayer(DotAttentionLayer):
+    """Dot attention restricted, when doing incremental inference, to a
+    window of *window* source positions.
+
+    The window is centred on the block of *pool* source positions whose mean
+    key scores highest against d_i, so a decoding step scores S / pool +
+    window source positions instead of S. Target positions are processed in
+    blocks of *block_size* that share the source span covering their
+    windows, each masked to its own window. Training and other full-sequence
+    passes use the dense attention: the gather and masking of the windows
+    cost more than the dense bmm there. Sources no longer than the window
+    also get the dense attention. The parameters are those of
+    DotAttentionLayer, so either can be used with the weights of the other.
+    """
+    def __init__(self, conv_channels, embed_dim, bmm=None, window=64, pool=8, block_size=16):
+        super().__init__(conv_channels, embed_dim, bmm)
+        self.window = window
+        self.pool = pool
+        self.block_size = block_size
+
+    def forward(self, x, target_embedding, encoder_out, incremental_state=None):
+        s = encoder_out[1].size(1)
+        if incremental_state is None or s <= self.window:
+            return super().forward(x, target_embedding, encoder_out, incremental_state)
+        residual = x
+
+        # attention
+        x = (self.in_projection(x) + target_embedding) * math.sqrt(0.5) # d_i
+        start = self._window_start(x, encoder_out, incremental_state)
+
+        contexts, attn_scores = [], []
+        for t in range(0, x.size(1), self.block_size):
+            context, scores = self._attend_block(
+                x[:, t:t + self.block_size], start[:, t:t + self.block_size], encoder_out)
+            contexts.append(context)
+            attn_scores.append(scores)
+        x = torch.cat(contexts, dim=1) # get c_i
+        attn_scores = torch.cat(attn_scores, dim=1) # a_i_j
+
+        # scale attention output
+        x = x * (s * math.sqrt(1.0 / s))
+
+        # project back
+        x = (self.out_projection(x) + residual) * math.sqrt(0.5)
+        return x, attn_scores
+
+    def _window_start(self, x, encoder_out, incremental_state):
+        """First source position of the window of every target position (B x T)."""
+        s = encoder_out[1].size(1)
+        with torch.no_grad():
+            block = torch.bmm(x, self._project_source(encoder_out, incremental_state)).max(dim=2)[1]
+        center = block * self.pool + self.pool // 2
+        return (center - self.window // 2).clamp(0, s - self.window)
+
+    def _attend_block(self, x, start, encoder_out):
+        """Context (B x T x C) and attention scores (B x T x S) of the target
+        positions x, attending to the windows beginning at *start* (B x T)."""
+        s = encoder_out[1].size(1)
+        lo = start.min(dim=1)[0]
+        span = min(int((start.max(dim=1)[0] - lo).max()) + self.window, s)
+        positions = lo.clamp(max=s - span).unsqueeze(1) + torch.arange(span, device=lo.device)  # B x span
+        keys = encoder_out[0].gather(2, positions.unsqueeze(1).expand(-1, encoder_out[0].size(1), -1))
+        values = encoder_out[1].gather(1, positions.unsqueeze(2).expand(-1, -1, encoder_out[1].size(2)))
+
+        offset = positions.unsqueeze(1) - start.unsqueeze(2)  # B x T x span
+        outside = (offset < 0) | (offset >= self.window)
+        probs = F.softmax(torch.bmm(x, keys).masked_fill(outside, float('-inf')), dim=2)
+        attn_scores = probs.new_zeros(x.size(0), x.size(1), s).scatter(
+            2, positions.unsqueeze(1).expand_as(probs), probs)
+        return torch.bmm(probs, values), attn_scores
+
+    def _project_source(self, encoder_out, incremental_state):
+        """Keys averaged over blocks of pool source positions (B x C x S / pool).
+
+        This is cached when doing incremental inference.
+        """
+        cached_result = utils.get_incremental_state(self, incremental_state, 'source_proj')
+        if cached_result is not None:
+            return cached_result
+
+        result = F.avg_pool1d(encoder_out[0], self.pool, ceil_mode=True)
+
+        if incremental_state is not None:
+            utils.set_incremental_state(self, incremental_state, 'source_proj', result)
+        return result
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        reorder_source_proj(self, incremental_state, new_order)
+
+
 # attension with general dot multiply
-class AttentionLayer(nn.Module):
+@register_attention('general')
+class GeneralDotAttentionLayer(nn.Module):
+    """Attention scored by (W d_i + b)^T z_j.
+
+    The scores are computed as d_i^T (W^T z_j) + b^T z_j, so W is applied
+    once to the source instead of to every target position; when doing
+    incremental inference the projected keys are computed at the first step
+    only.
+    """
+    # submodules only used to compute the attention scores
+    scoring_modules = ('in_projection', 'attension_mul')
+
     def __init__(self, conv_channels, embed_dim, bmm=None):
         super().__init__()
         # projects from output of convolution to embedding dimension
@@ -231,21 +446,25 @@ class AttentionLayer(nn.Module):
 
         self.bmm = bmm if bmm is not None else torch.bmm
 
-    def forward(self, x, target_embedding, encoder_out):
+    def forward(self, x, target_embedding, encoder_out, incremental_state=None):
         residual = x
 
         # attention
         x = (self.in_projection(x) + target_embedding) * math.sqrt(0.5) # d_i
-        #x = self.bmm(x, encoder_out[0]) # d_i*z_i
-        x = self.bmm(self.attension_mul(x),encoder_out[0])
+        keys, key_bias = self._project_source(encoder_out, incremental_state)
+        x = self.bmm(x, keys) + key_bias # (W d_i + b)^T z_j
 
         # softmax over last dim
-        sz = x.size()
-        x = F.softmax(x.view(sz[0] * sz[1], sz[2]), dim=1)
-        x = x.view(sz)
+        x = F.softmax(x, dim=2)
         attn_scores = x # a_i_j
 
-        x = self.bmm(x, encoder_out[1]) # get c_i
+        return self.attend(residual, attn_scores, encoder_out), attn_scores
+
+    def attend(self, x, attn_scores, encoder_out, incremental_state=None):
+        """Output of the layer for input x and attention scores a_i_j
+        (B x T x S), which may be those of an earlier layer."""
+        residual = x
+        x = self.bmm(attn_scores, encoder_out[1]) # get c_i
 
         # scale attention output
         s = encoder_out[1].size(1)
@@ -253,20 +472,50 @@ class AttentionLayer(nn.Module):
 
         # project back
         x = (self.out_projection(x) + residual) * math.sqrt(0.5)
-        return x, attn_scores
+        return x
+
+    def _project_source(self, encoder_out, incremental_state):
+        """W^T z_j (B x C x S) and b^T z_j (B x 1 x S).
+
+        This is cached when doing incremental inference.
+        """
+        cached_result = utils.get_incremental_state(self, incremental_state, 'source_proj')
+        if cached_result is not None:
+            return cached_result
+
+        keys = torch.matmul(weight_of(self.attension_mul).t(), encoder_out[0])
+        key_bias = torch.matmul(self.attension_mul.bias, encoder_out[0]).unsqueeze(1)
+        result = (keys, key_bias)
+
+        if incremental_state is not None:
+            utils.set_incremental_state(self, incremental_state, 'source_proj', result)
+        return result
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        reorder_source_proj(self, incremental_state, new_order)
 
     def make_generation_fast_(self, beamable_mm_beam_size=None, **kwargs):
         """Replace torch.bmm with BeamableMM."""
         if beamable_mm_beam_size is not None:
             del self.bmm
             self.add_module('bmm', BeamableMM(beamable_mm_beam_size))
-'''
 
-'''
+
 # attension with concat scores
-class AttentionLayer(nn.Module):
+@register_attention('concat')
+class ConcatAttentionLayer(nn.Module):
+    """Attention scored by a linear layer over [z_j; d_i].
+
+    The layer is separable, w^T [z_j; d_i] = w_z^T z_j + w_d^T d_i, so the
+    scores are the broadcast sum of a key and a query term and no
+    target x source x channels tensor is built.
+    """
+    # submodules only used to compute the attention scores
+    scoring_modules = ('in_projection', 'attension_mul')
+
     def __init__(self, conv_channels, embed_dim, bmm=None):
         super().__init__()
+        self.embed_dim = embed_dim
         # projects from output of convolution to embedding dimension
         self.in_projection = Linear(conv_channels, embed_dim+embed_dim)
         # projects from embedding dimension to convolution size
@@ -276,29 +525,32 @@ class AttentionLayer(nn.Module):
 
         self.bmm = bmm if bmm is not None else torch.bmm
 
-    def forward(self, x, target_embedding, encoder_out):
+    def forward(self, x, target_embedding, encoder_out, incremental_state=None):
         residual = x
 
         # attention
         x = (self.in_projection(x) + target_embedding) * math.sqrt(0.5) # d_i
-        #x = self.bmm(x, encoder_out[0]) # d_i*z_i
-        #x = self.bmm(self.attension_mul(x),encoder_out[0])
-        enc_out = encoder_out[0].transpose(1,2)
-        all_batch_x = []
-        for i in range(x.shape[1]):
-            single_batch = torch.cat([enc_out,torch.unsqueeze(x[:,1,:],1).repeat(1,enc_out.shape[1],1)],dim=2)
-            single_batch = self.attension_mul(single_batch)
-            all_batch_x.append(single_batch)
-        all_batch_x = torch.cat(all_batch_x, dim=2)
-        x = all_batch_x.transpose(1,2)
+
+        # w_z^T z_j (B x 1 x S) + w_d^T d_i (B x T x 1); the query term is
+        # constant over the source and cancels in the softmax, it is kept so
+        # that the scores are those of the concatenation
+        key_scores = self._project_source(encoder_out, incremental_state)
+        width = self.embed_dim + self.embed_dim
+        weight = weight_of(self.attension_mul)
+        query_scores = F.linear(x, weight[:, width:], self.attension_mul.bias)
+        x = query_scores + key_scores
 
         # softmax over last dim
-        sz = x.size()
-        x = F.softmax(x.contiguous().view(sz[0] * sz[1], sz[2]), dim=1)
-        x = x.view(sz)
+        x = F.softmax(x, dim=2)
         attn_scores = x # a_i_j
 
-        x = self.bmm(x, encoder_out[1]) # get c_i
+        return self.attend(residual, attn_scores, encoder_out), attn_scores
+
+    def attend(self, x, attn_scores, encoder_out, incremental_state=None):
+        """Output of the layer for input x and attention scores a_i_j
+        (B x T x S), which may be those of an earlier layer."""
+        residual = x
+        x = self.bmm(attn_scores, encoder_out[1]) # get c_i
 
         # scale attention output
         s = encoder_out[1].size(1)
@@ -306,7 +558,26 @@ class AttentionLayer(nn.Module):
 
         # project back
         x = (self.out_projection(x) + residual) * math.sqrt(0.5)
-        return x, attn_scores
+        return x
+
+    def _project_source(self, encoder_out, incremental_state):
+        """w_z^T z_j (B x 1 x S).
+
+        This is cached when doing incremental inference.
+        """
+        cached_result = utils.get_incremental_state(self, incremental_state, 'source_proj')
+        if cached_result is not None:
+            return cached_result
+
+        width = self.embed_dim + self.embed_dim
+        result = torch.matmul(weight_of(self.attension_mul)[:, :width], encoder_out[0])
+
+        if incremental_state is not None:
+            utils.set_incremental_state(self, incremental_state, 'source_proj', result)
+        return result
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        reorder_source_proj(self, incremental_state, new_order)
 
     def make_generation_fast_(self, beamable_mm_beam_size=None, **kwargs):
         """Replace torch.bmm with BeamableMM."""
@@ -314,63 +585,58 @@ class AttentionLayer(nn.Module):
             del self.bmm
             self.add_module('bmm', BeamableMM(beamable_mm_beam_size))
 
-'''
-'''
-# attension with  Gumbel-Softmax Trick and Re-parameterization Trick
-class AttentionLayer(nn.Module):
-    
-    def __init__(self, conv_channels, embed_dim, bmm=None):
+
+# addicative attension
+@register_attention('additive')
+class AdditiveAttentionLayer(nn.Module):
+    """Attention scored by v^T tanh(W_q d_i + W_k z_j).
+
+    The query and key projections are broadcast against each other. The
+    tanh needs the target x source x (embed_dim // 2) tensor; with
+    *chunk_size*, it is built for at most chunk_size target positions at a
+    time.
+    """
+    # submodules only used to compute the attention scores
+    scoring_modules = ('in_projection', 'attension_add_query', 'attension_add_key', 'attension_add_score')
+
+    def __init__(self, conv_channels, embed_dim, bmm=None, chunk_size=None):
         super().__init__()
         # projects from output of convolution to embedding dimension
         self.in_projection = Linear(conv_channels, embed_dim+embed_dim)
         # projects from embedding dimension to convolution size
         self.out_projection = Linear(embed_dim+embed_dim, conv_channels)
 
-        self.bmm = bmm if bmm is not None else torch.bmm
-        
-    def sample_gumbel(self, shape, eps=1e-20):
-        U = torch.rand(shape).cuda()
-        return -Variable(torch.log(-torch.log(U + eps) + eps))
-
-    def gumbel_softmax_sample(self, logits, temperature):
-        y = logits + self.sample_gumbel(logits.size())
-        return F.softmax(y / temperature, dim=-1)
-
-    def gumbel_softmax(self, logits, temperature):
-        """
-        input: [*, n_class]
-        return: [*, n_class] an one-hot vector
-        """
-        y = self.gumbel_softmax_sample(logits, temperature)
-        shape = y.size()
-        _, ind = y.max(dim=-1)
-        y_hard = torch.zeros_like(y).view(-1, shape[-1])
-        y_hard.scatter_(1, ind.view(-1, 1), 1)
-        y_hard = y_hard.view(*shape)
-        return (y_hard - y).detach() + y
+        self.attension_add_query = Linear(embed_dim+embed_dim, embed_dim // 2)
+        self.attension_add_key = Linear(embed_dim+embed_dim, embed_dim // 2)
+        self.attension_add_score = Linear(embed_dim // 2, 1)
+        self.chunk_size = chunk_size
 
+        self.bmm = bmm if bmm is not None else torch.bmm
 
-    def forward(self, x, target_embedding, encoder_out):
+    def forward(self, x, target_embedding, encoder_out, incremental_state=None):
         residual = x
 
         # attention
         x = (self.in_projection(x) + target_embedding) * math.sqrt(0.5) # d_i
-        x = self.bmm(x, encoder_out[0]) # d_i*z_i
+        query = self.attension_add_query(x).unsqueeze(2) # B x T x 1 x H
+        key = self._project_source(encoder_out, incremental_state) # B x 1 x S x H
+        chunk_size = self.chunk_size or query.size(1)
+        x = torch.cat([
+            self.attension_add_score(torch.tanh(query[:, i:i + chunk_size] + key)).squeeze(3)
+            for i in range(0, query.size(1), chunk_size)
+        ], dim=1)
 
-        # Gumbel Softmax with multi samples
-        sz = x.size()
-        # sample for 10 times
-        all_samles = []
-        sample_num = 10
-        for i in range (sample_num):
-            # Gumbel Softmax
-            tmp = self.gumbel_softmax(x.view(sz[0] * sz[1], sz[2]), 0.8)
-            all_samles.append(tmp)
-        x = torch.sum(torch.cat([tmp.unsqueeze(2) for tmp in all_samles],dim=2)/sample_num,dim=2)
-        x = x.view(sz)
+        # softmax over last dim
+        x = F.softmax(x, dim=2)
         attn_scores = x # a_i_j
 
-        x = self.bmm(x, encoder_out[1]) # get c_i
+        return self.attend(residual, attn_scores, encoder_out), attn_scores
+
+    def attend(self, x, attn_scores, encoder_out, incremental_state=None):
+        """Output of the layer for input x and attention scores a_i_j
+        (B x T x S), which may be those of an earlier layer."""
+        residual = x
+        x = self.bmm(attn_scores, encoder_out[1]) # get c_i
 
         # scale attention output
         s = encoder_out[1].size(1)
@@ -378,150 +644,248 @@ class AttentionLayer(nn.Module):
 
         # project back
         x = (self.out_projection(x) + residual) * math.sqrt(0.5)
-        return x, attn_scores
+        return x
+
+    def _project_source(self, encoder_out, incremental_state):
+        """W_k z_j (B x 1 x S x H).
+
+        This is cached when doing incremental inference.
+        """
+        cached_result = utils.get_incremental_state(self, incremental_state, 'source_proj')
+        if cached_result is not None:
+            return cached_result
+
+        result = self.attension_add_key(encoder_out[0].transpose(1, 2)).unsqueeze(1)
+
+        if incremental_state is not None:
+            utils.set_incremental_state(self, incremental_state, 'source_proj', result)
+        return result
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        reorder_source_proj(self, incremental_state, new_order)
 
     def make_generation_fast_(self, beamable_mm_beam_size=None, **kwargs):
         """Replace torch.bmm with BeamableMM."""
         if beamable_mm_beam_size is not None:
             del self.bmm
             self.add_module('bmm', BeamableMM(beamable_mm_beam_size))
-'''
 
-'''
-
-# multihead attension (more parameters)
-class AttentionLayer(nn.Module):
-    def __init__(self, conv_channels, embed_dim, bmm=None):
+# attension with  Gumbel-Softmax Trick and Re-parameterization Trick
+@register_attention('gumbel')
+class GumbelAttentionLayer(nn.Module):
+    """Attention averaged over num_samples straight-through Gumbel-softmax
+    samples of the dot scores.
+
+    All samples are drawn with one torch.rand on the device of the scores,
+    from a torch.Generator seeded with *seed* (the global generator if seed
+    is None). The forward value is the mean of the hard one-hot samples and
+    the gradient that of the mean of the soft samples at *temperature*. In
+    eval mode nothing is sampled: the expectation of the hard samples, which
+    is the softmax of the scores (Gumbel-max trick), is used instead.
+    """
+
+    # submodules only used to compute the attention scores
+    scoring_modules = ('in_projection',)
+
+    def __init__(self, conv_channels, embed_dim, bmm=None, num_samples=10, temperature=0.8, seed=None):
         super().__init__()
-        self.num_head = 4
         # projects from output of convolution to embedding dimension
         self.in_projection = Linear(conv_channels, embed_dim+embed_dim)
         # projects from embedding dimension to convolution size
-        self.out_projection = Linear(self.num_head*(embed_dim+embed_dim), conv_channels)
+        self.out_projection = Linear(embed_dim+embed_dim, conv_channels)
+        self.num_samples = num_samples
+        self.temperature = temperature
+        self.seed = seed
+        self._generators = {}
+
         self.bmm = bmm if bmm is not None else torch.bmm
-        self.multi_head_key = []
-        self.multi_head_value = []
-        self.multi_head_query = []
-        for i in range(self.num_head):
-            self.multi_head_key.append(Linear(embed_dim+embed_dim, embed_dim+embed_dim).to('cuda'))
-            self.multi_head_value.append(Linear(embed_dim+embed_dim, embed_dim+embed_dim).to('cuda'))
-            self.multi_head_query.append(Linear(embed_dim+embed_dim, embed_dim+embed_dim).to('cuda'))
-        #self.multi_head_fusion = Linear(self.num_head*(embed_dim+embed_dim), embed_dim+embed_dim)
-    def forward(self, x, target_embedding, encoder_out):
+
+    def _generator(self, device):
+        """Generator of *device*, seeded at first use; None without a seed."""
+        if self.seed is None:
+            return None
+        if device not in self._generators:
+            self._generators[device] = torch.Generator(device=device).manual_seed(self.seed)
+        return self._generators[device]
+
+    def sample_gumbel(self, shape, device, eps=1e-20):
+        U = torch.rand(shape, device=device, generator=self._generator(device))
+        return -torch.log(-torch.log(U + eps) + eps)
+
+    def gumbel_softmax(self, logits):
+        """Mean of num_samples straight-through Gumbel-softmax samples over
+        the last dimension of *logits*."""
+        y = logits.unsqueeze(0) + self.sample_gumbel(
+            (self.num_samples,) + tuple(logits.size()), logits.device)
+        y = F.softmax(y / self.temperature, dim=-1)  # K x B x T x S
+        # count the argmax of every sample instead of building K one-hots
+        ind = y.max(dim=-1)[1].permute(1, 2, 0)  # B x T x K
+        y_hard = torch.zeros_like(logits).scatter_add_(
+            -1, ind, logits.new_full(ind.size(), 1. / self.num_samples))
+        y = y.mean(dim=0)
+        return (y_hard - y).detach() + y
+
+    def forward(self, x, target_embedding, encoder_out, incremental_state=None):
         residual = x
 
         # attention
         x = (self.in_projection(x) + target_embedding) * math.sqrt(0.5) # d_i
+        x = self.bmm(x, encoder_out[0]) # d_i*z_i
+
+        # Gumbel Softmax with multi samples
+        if self.training:
+            x = self.gumbel_softmax(x)
+        else:
+            x = F.softmax(x, dim=2)
+        attn_scores = x # a_i_j
+
+        return self.attend(residual, attn_scores, encoder_out), attn_scores
+
+    def attend(self, x, attn_scores, encoder_out, incremental_state=None):
+        """Output of the layer for input x and attention scores a_i_j
+        (B x T x S), which may be those of an earlier layer."""
+        residual = x
+        x = self.bmm(attn_scores, encoder_out[1]) # get c_i
+
+        # scale attention output
+        s = encoder_out[1].size(1)
+        x = x * (s * math.sqrt(1.0 / s))
 
-        # get new query and key
-        all_query_result = []
-        for i in range(self.num_head):
-            
-            # get new query and key
-            new_query = self.multi_head_query[i](x)
-            new_key = self.multi_head_key[i](encoder_out[0].transpose(1,2))
-            new_key = new_key.transpose(1,2)
-            new_queried = self.bmm(new_query, new_key)
-
-            # softmax over last dim
-            sz = new_queried.size()
-            new_queried = F.softmax(new_queried.view(sz[0] * sz[1], sz[2]), dim=1)
-            new_queried = new_queried.view(sz)
-            attn_scores = new_queried # a_i_j
-
-            # get new values
-            new_value = self.multi_head_value[i](encoder_out[1])
-            
-            query_result = self.bmm(new_queried, new_value) # get c_i
-
-            # scale attention output
-            s = encoder_out[1].size(1)
-            query_result = query_result * (s * math.sqrt(1.0 / s))
-            all_query_result.append(query_result)
-        all_query_result = torch.cat(all_query_result,dim=2)
         # project back
-        x = (self.out_projection(all_query_result) + residual) * math.sqrt(0.5)
-        return x, attn_scores
+        x = (self.out_projection(x) + residual) * math.sqrt(0.5)
+        return x
 
     def make_generation_fast_(self, beamable_mm_beam_size=None, **kwargs):
         """Replace torch.bmm with BeamableMM."""
         if beamable_mm_beam_size is not None:
             del self.bmm
             self.add_module('bmm', BeamableMM(beamable_mm_beam_size))
-'''
 
 
 # multihead attension
-class AttentionLayer(nn.Module):
-    def __init__(self, conv_channels, embed_dim, bmm=None):
+@register_attention('multihead')
+class MultiHeadAttentionLayer(nn.Module):
+    """Multi-head attention with the heads fused into single projections.
+
+    The query, key and value projections of all heads are one Linear each,
+    and all heads are scored and applied with one batched matmul over
+    B x H x T x d views of the projections, so the heads are not copied out
+    of them. With head_dim=None
+    each of the num_heads heads has width (embed_dim + embed_dim) / num_heads;
+    with head_dim='full' every head has width embed_dim + embed_dim (more
+    parameters). The returned attention scores are averaged over heads.
+    """
+    # submodules only used to compute the attention scores
+    scoring_modules = ('in_projection', 'query_projection', 'key_projection')
+
+    def __init__(self, conv_channels, embed_dim, bmm=None, num_heads=4, head_dim=None):
         super().__init__()
-        self.num_head = 4
+        self.num_heads = num_heads
+        if head_dim == 'full':
+            head_dim = embed_dim + embed_dim
+        elif head_dim is None:
+            head_dim = (embed_dim + embed_dim) // num_heads
+        self.head_dim = head_dim
         # projects from output of convolution to embedding dimension
-        self.in_projection = Linear(conv_channels, embed_dim + embed_dim)
+        self.in_projection = Linear(conv_channels, embed_dim+embed_dim)
         # projects from embedding dimension to convolution size
-        self.out_projection = Linear(embed_dim + embed_dim, conv_channels)
+        self.out_projection = Linear(num_heads*head_dim, conv_channels)
+        self.query_projection = Linear(embed_dim+embed_dim, num_heads*head_dim)
+        self.key_projection = Linear(embed_dim+embed_dim, num_heads*head_dim)
+        self.value_projection = Linear(embed_dim+embed_dim, num_heads*head_dim)
         self.bmm = bmm if bmm is not None else torch.bmm
-        self.multi_head_key = []
-        self.multi_head_value = []
-        self.multi_head_query = []
-        for i in range(self.num_head):
-            self.multi_head_key.append(
-                Linear(embed_dim + embed_dim, int((embed_dim + embed_dim) / self.num_head)).to('cuda'))
-            self.multi_head_value.append(
-                Linear(embed_dim + embed_dim, int((embed_dim + embed_dim) / self.num_head)).to('cuda'))
-            self.multi_head_query.append(
-                Linear(embed_dim + embed_dim, int((embed_dim + embed_dim) / self.num_head)).to('cuda'))
-        # self.multi_head_fusion = Linear(self.num_head*(embed_dim+embed_dim), embed_dim+embed_dim)
-
-    def forward(self, x, target_embedding, encoder_out):
+
+    def forward(self, x, target_embedding, encoder_out, incremental_state=None):
         residual = x
 
         # attention
         x = (self.in_projection(x) + target_embedding) * math.sqrt(0.5)  # d_i
 
-        # get new query and key
-        all_query_result = []
-        for i in range(self.num_head):
-            # get new query and key
-            new_query = self.multi_head_query[i](x)
-            new_key = self.multi_head_key[i](encoder_out[0].transpose(1, 2))
-            new_key = new_key.transpose(1, 2)
-            new_queried = self.bmm(new_query, new_key)
-
-            # softmax over last dim
-            sz = new_queried.size()
-            new_queried = F.softmax(new_queried.view(sz[0] * sz[1], sz[2]), dim=1)
-            new_queried = new_queried.view(sz)
-            attn_scores = new_queried  # a_i_j
-
-            # get new values
-            new_value = self.multi_head_value[i](encoder_out[1])
-
-            query_result = self.bmm(new_queried, new_value)  # get c_i
-
-            # scale attention output
-            s = encoder_out[1].size(1)
-            query_result = query_result * (s * math.sqrt(1.0 / s))
-            all_query_result.append(query_result)
-        all_query_result = torch.cat(all_query_result, dim=2)
+        query = self._heads(self.query_projection(x))  # B x H x T x d
+        key, value = self._project_source(encoder_out, incremental_state)
+
+        # softmax over last dim
+        attn_scores = F.softmax(torch.matmul(query, key), dim=3)  # a_i_j
+        x = torch.matmul(attn_scores, value)  # get c_i
+
+        # B x H x T x d -> B x T x (H*d)
+        bsz, tgt_len = residual.size(0), residual.size(1)
+        x = x.transpose(1, 2).reshape(bsz, tgt_len, self.num_heads * self.head_dim)
+
+        # scale attention output
+        s = encoder_out[1].size(1)
+        x = x * (s * math.sqrt(1.0 / s))
+
         # project back
-        x = (self.out_projection(all_query_result) + residual) * math.sqrt(0.5)
-        return x, attn_scores
+        x = (self.out_projection(x) + residual) * math.sqrt(0.5)
+        return x, attn_scores.mean(dim=1)
+
+    def attend(self, x, attn_scores, encoder_out, incremental_state=None):
+        """Output of the layer for input x and attention scores a_i_j
+        (B x T x S) of an earlier layer, shared by all heads: the values of
+        the heads are those of this layer."""
+        residual = x
+        value = utils.get_incremental_state(self, incremental_state, 'shared_value')
+        if value is None:
+            value = self.value_projection(encoder_out[1])  # B x S x (H*d)
+            if incremental_state is not None:
+                utils.set_incremental_state(self, incremental_state, 'shared_value', value)
+        x = self.bmm(attn_scores, value)  # get c_i
+
+        # scale attention output
+        s = encoder_out[1].size(1)
+        x = x * (s * math.sqrt(1.0 / s))
+
+        # project back
+        x = (self.out_projection(x) + residual) * math.sqrt(0.5)
+        return x
+
+    def _heads(self, x):
+        """B x T x (H*d) -> B x H x T x d (a view)"""
+        bsz, seq_len = x.size(0), x.size(1)
+        return x.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2)
+
+    def _project_source(self, encoder_out, incremental_state):
+        """Keys (B x H x d x S) and values (B x H x S x d) of all heads.
+
+        This is cached when doing incremental inference, made contiguous so
+        that the decoding steps do not copy them again.
+        """
+        cached_result = utils.get_incremental_state(self, incremental_state, 'source_proj')
+        if cached_result is not None:
+            return cached_result
+
+        key = self._heads(self.key_projection(encoder_out[0].transpose(1, 2))).transpose(2, 3)
+        value = self._heads(self.value_projection(encoder_out[1]))
+        result = (key, value)
+
+        if incremental_state is not None:
+            result = (key.contiguous(), value.contiguous())
+            utils.set_incremental_state(self, incremental_state, 'source_proj', result)
+        return result
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        reorder_source_proj(self, incremental_state, new_order)
+        reorder_source_proj(self, incremental_state, new_order, 'shared_value')
 
     def make_generation_fast_(self, beamable_mm_beam_size=None, **kwargs):
-        """Replace torch.bmm with BeamableMM."""
+        """Replace torch.bmm with BeamableMM (used when the scores of an
+        earlier layer are applied, see attend)."""
         if beamable_mm_beam_size is not None:
             del self.bmm
             self.add_module('bmm', BeamableMM(beamable_mm_beam_size))
 
+
 class FConvDecoder(FairseqIncrementalDecoder):
     """Convolutional decoder"""
     def __init__(self, dictionary, embed_dim=512, out_embed_dim=256,
                  max_positions=1024, convolutions=((512, 3),) * 20,
-                 attention=True, dropout=0.1, share_embed=False):
+                 attention=True, attention_type='multihead', attention_scores=True,
+                 dropout=0.1, share_embed=False):
         super().__init__(dictionary)
         self.register_buffer('version', torch.Tensor([2]))
         self.dropout = dropout
+        self.need_attn = True
 
         in_channels = convolutions[0][0]
         if isinstance(attention, bool):
@@ -530,6 +894,20 @@ class FConvDecoder(FairseqIncrementalDecoder):
         if not isinstance(attention, list) or len(attention) != len(convolutions):
             raise ValueError('Attention is expected to be a list of booleans of '
                              'length equal to the number of layers.')
+        if isinstance(attention_scores, bool):
+            attention_scores = [attention_scores] * len(convolutions)
+        if not isinstance(attention_scores, list) or len(attention_scores) != len(convolutions):
+            raise ValueError('Attention scores are expected to be a list of booleans of '
+                             'length equal to the number of layers.')
+        # layers with attention that reuse the scores of the previous attention layer
+        self.reuse_attention = [
+            attention[i] and not attention_scores[i] for i in range(len(convolutions))
+        ]
+        if any(self.reuse_attention):
+            if not attention_scores[attention.index(True)]:
+                raise ValueError('The first attention layer has to compute its scores.')
+            if attention_type == 'chunked':
+                raise ValueError('Chunked attention does not return scores to reuse.')
 
         num_embeddings = len(dictionary)
         padding_idx = dictionary.pad()
@@ -552,8 +930,12 @@ class FConvDecoder(FairseqIncrementalDecoder):
                 LinearizedConv1d(in_channels, out_channels * 2, kernel_size,
                                  padding=(kernel_size - 1), dropout=dropout)
             )
-            self.attention.append(AttentionLayer(out_channels, embed_dim)
+            self.attention.append(ATTENTION_REGISTRY[attention_type](out_channels, embed_dim)
                                   if attention[i] else None)
+            if self.reuse_attention[i]:
+                # see upgrade_state_dict for checkpoints with these modules
+                for name in self.attention[i].scoring_modules:
+                    delattr(self.attention[i], name)
             in_channels = out_channels
         self.fc2 = Linear(in_channels, out_embed_dim)
         if share_embed:
@@ -600,7 +982,9 @@ class FConvDecoder(FairseqIncrementalDecoder):
         # temporal convolutions
         avg_attn_scores = None
         num_attn_layers = len(self.attention)
-        for proj, conv, attention in zip(self.projections, self.convolutions, self.attention):
+        shared_attn_scores = None
+        for proj, conv, attention, reuse_attention in zip(self.projections, self.convolutions,
+                                                          self.attention, self.reuse_attention):
             residual = x if proj is None else proj(x)
 
             x = F.dropout(x, p=self.dropout, training=self.training)
@@ -612,12 +996,18 @@ class FConvDecoder(FairseqIncrementalDecoder):
                 x = self._transpose_if_training(x, incremental_state)
                 # print(x.size())
                 
-                x, attn_scores = attention(x, target_embedding, (encoder_a, encoder_b))
-                attn_scores = attn_scores / num_attn_layers
-                if avg_attn_scores is None:
-                    avg_attn_scores = attn_scores
+                if reuse_attention:
+                    attn_scores = shared_attn_scores
+                    x = attention.attend(x, attn_scores, (encoder_a, encoder_b), incremental_state)
                 else:
-                    avg_attn_scores.add_(attn_scores)
+                    x, attn_scores = attention(x, target_embedding, (encoder_a, encoder_b), incremental_state)
+                    shared_attn_scores = attn_scores
+                if attn_scores is not None and self.need_attn and not self.training:
+                    attn_scores = attn_scores / num_attn_layers
+                    if avg_attn_scores is None:
+                        avg_attn_scores = attn_scores
+                    else:
+                        avg_attn_scores.add_(attn_scores)
 
                 x = self._transpose_if_training(x, incremental_state)
 
@@ -635,6 +1025,12 @@ class FConvDecoder(FairseqIncrementalDecoder):
 
         return x, avg_attn_scores
 
+    def make_generation_fast_(self, need_attn=True, **kwargs):
+        """Without *need_attn*, the attention scores are neither averaged nor
+        returned (the decoder returns None for them); they are only needed
+        for alignments. They are never averaged in training."""
+        self.need_attn = need_attn
+
     def max_positions(self):
         """Maximum output length supported by the decoder."""
         return self.embed_positions.max_positions()
@@ -647,6 +1043,21 @@ class FConvDecoder(FairseqIncrementalDecoder):
                 nn.utils.remove_weight_norm(conv)
                 self.convolutions[i] = nn.utils.weight_norm(conv, dim=0)
             state_dict['decoder.version'] = torch.Tensor([1])
+        # the layers that reuse the attention scores have no scoring modules,
+        # so drop them from checkpoints trained with these layers computing
+        # their scores (a different --decoder-attention-scores)
+        for i, attention in enumerate(self.attention):
+            if attention is None:
+                continue
+            prefix = 'decoder.attention.{}.'.format(i)
+            keys = [k for k in state_dict if k.startswith(prefix)]
+            scoring_keys = [k for k in keys if k[len(prefix):].split('.')[0] in attention.scoring_modules]
+            if self.reuse_attention[i]:
+                for k in scoring_keys:
+                    del state_dict[k]
+            elif len(keys) > 0 and len(scoring_keys) == 0:
+                raise ValueError('Decoder attention layer {} computes its scores, but it reuses the '
+                                 'scores of an earlier layer in the checkpoint.'.format(i))
         return state_dict
 
     def _embed_tokens(self, tokens, incremental_state):
@@ -679,6 +1090,39 @@ class FConvDecoder(FairseqIncrementalDecoder):
         return x
 
 
+def weight_of(module):
+    """Current weight of *module*. With weight norm, module.weight is only
+    refreshed by the forward pre-hook, so it is recomputed from g and v."""
+    for hook in module._forward_pre_hooks.values():
+        if isinstance(hook, WeightNorm):
+            return hook.compute_weight(module)
+    return module.weight
+
+
+def reorder_source_proj(module, incremental_state, new_order, key='source_proj'):
+    """Reorder the cached source projections of an attention layer (tensors
+    with the batch as first dimension) to follow the beams.
+
+    The projections are the same for all the beams of a sentence, so when
+    the layer uses BeamableMM (which knows the beam size) they are only
+    copied if a beam is taken from another sentence.
+    """
+    cached_result = utils.get_incremental_state(module, incremental_state, key)
+    if cached_result is None:
+        return
+    beam_size = getattr(module.bmm, 'beam_size', None)
+    if beam_size is not None:
+        bsz = cached_result.size(0) if torch.is_tensor(cached_result) else cached_result[0].size(0)
+        sentence = torch.arange(bsz, device=new_order.device) // beam_size
+        if new_order.size(0) == bsz and torch.equal(new_order // beam_size, sentence):
+            return
+    if torch.is_tensor(cached_result) or isinstance(cached_result, Variable):
+        result = cached_result.index_select(0, new_order)
+    else:
+        result = tuple(proj.index_select(0, new_order) for proj in cached_result)
+    utils.set_incremental_state(module, incremental_state, key, result)
+
+
 def Embedding(num_embeddings, embedding_dim, padding_idx):
     m = nn.Embedding(num_embeddings, embedding_dim, padding_idx=padding_idx)
     m.weight.data.normal_(0, 0.1)
@@ -726,6 +1170,8 @@ def base_architecture(args):
     args.decoder_layers = getattr(args, 'decoder_layers', '[(512, 3)] * 20')
     args.decoder_out_embed_dim = getattr(args, 'decoder_out_embed_dim', 256)
     args.decoder_attention = getattr(args, 'decoder_attention', 'True')
+    args.decoder_attention_type = getattr(args, 'decoder_attention_type', 'multihead')
+    args.decoder_attention_scores = getattr(args, 'decoder_attention_scores', 'True')
     args.share_input_output_embed = getattr(args, 'share_input_output_embed', False)
 
 @register_model_architecture('fconv', 'fconv_newsroom')
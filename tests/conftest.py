@@ -0,0 +1,67 @@
+"""
+The tests run in an XSum-Topic-ConvS2S checkout into which the files of this
+repository have been copied as described in README.md, from its root:
+
+    python -m pytest /path/to/topic-aware-CNN-experiments/tests
+
+A test module is skipped when PyTorch or the fairseq of that checkout cannot
+be imported, or when the installed fairseq/models/fconv.py is not the
+version it tests (the one of "word-embeddings" or of "attention").
+"""
+
+import pytest
+
+
+def import_fconv(variant):
+    """fairseq.models.fconv, if it is the *variant* ('word-embeddings' or
+    'attention') of this repository; skips the calling module otherwise."""
+    pytest.importorskip('torch')
+    fconv = pytest.importorskip('fairseq.models.fconv')
+    marker = {'word-embeddings': 'NGTU', 'attention': 'ATTENTION_REGISTRY'}[variant]
+    if not hasattr(fconv, marker):
+        pytest.skip('fairseq/models/fconv.py is not the {} version'.format(variant),
+                    allow_module_level=True)
+    return fconv
+
+
+def build_dictionary(num_words=20):
+    from fairseq.dictionary import Dictionary
+    dictionary = Dictionary()
+    for i in range(num_words):
+        dictionary.add_symbol('w{}'.format(i))
+    return dictionary
+
+
+def build_word_embeddings_model(fconv, embed_dim=8, topic_dim=4, attention=True, dropout=0.):
+    """A small, randomly initialized topic-aware FConvModel (20 layers of
+    embed_dim channels in the encoder and the decoder)."""
+    dictionary = build_dictionary()
+    encoder = fconv.FConvEncoder(
+        dictionary, embed_dim=embed_dim, max_positions=64, dropout=dropout, topic_dim=topic_dim)
+    decoder = fconv.FConvDecoder(
+        dictionary, embed_dim=embed_dim, out_embed_dim=embed_dim, max_positions=64,
+        attention=attention, dropout=dropout, topic_dim=topic_dim)
+    return fconv.FConvModel(encoder, decoder)
+
+
+def random_sample(model, bsz=2, src_len=7, tgt_len=5, seed=1):
+    """Random net input for *model*: tokens without padding and topic vectors."""
+    import torch
+    generator = torch.Generator().manual_seed(seed)
+    dictionary = model.encoder.dictionary
+    topic_dim = model.encoder.topic_dim
+    nspecial = dictionary.nspecial
+    return {
+        'src_tokens': torch.randint(nspecial, len(dictionary), (bsz, src_len), generator=generator),
+        'src_lengths': torch.full((bsz,), src_len, dtype=torch.long),
+        'src_doctopic': torch.rand(bsz, topic_dim, generator=generator),
+        'src_wordtopics': torch.rand(bsz, src_len, topic_dim, generator=generator),
+        'prev_output_tokens': torch.randint(nspecial, len(dictionary), (bsz, tgt_len), generator=generator),
+    }
+
+
+def run_model(model, sample, incremental_state=None):
+    """Decoder output (logits, attention) of *model* on *sample*."""
+    encoder_out = model.encoder(
+        sample['src_tokens'], sample['src_lengths'], sample['src_doctopic'], sample['src_wordtopics'])
+    return model.decoder(sample['prev_output_tokens'], encoder_out, sample['src_doctopic'], incremental_state)
@@ -0,0 +1,73 @@
+import math
+
+import pytest
+
+from conftest import import_fconv
+
+fconv = import_fconv('attention')
+
+import torch
+import torch.nn.functional as F
+
+CONV_CHANNELS, EMBED_DIM = 6, 4
+BSZ, TGT_LEN, SRC_LEN = 2, 5, 7
+
+
+def random_inputs(seed=1):
+    torch.manual_seed(seed)
+    width = EMBED_DIM + EMBED_DIM
+    x = torch.randn(BSZ, TGT_LEN, CONV_CHANNELS)
+    target_embedding = torch.randn(BSZ, TGT_LEN, width)
+    encoder_out = (torch.randn(BSZ, width, SRC_LEN), torch.randn(BSZ, SRC_LEN, width))
+    return x, target_embedding, encoder_out
+
+
+def reference_output(layer, x, scores, encoder_out):
+    """Output of the layer for the attention *scores*, as in the original layers."""
+    attn_scores = F.softmax(scores, dim=2)
+    out = torch.bmm(attn_scores, encoder_out[1]) * (SRC_LEN * math.sqrt(1.0 / SRC_LEN))
+    return (layer.out_projection(out) + x) * math.sqrt(0.5), attn_scores
+
+
+def reference_concat(layer, x, target_embedding, encoder_out):
+    """w^T [z_j; d_i], one target position at a time."""
+    query = (layer.in_projection(x) + target_embedding) * math.sqrt(0.5)
+    keys = encoder_out[0].transpose(1, 2)
+    scores = []
+    for i in range(query.size(1)):
+        d_i = query[:, i:i + 1].expand(-1, keys.size(1), -1)
+        scores.append(layer.attension_mul(torch.cat([keys, d_i], dim=2)).squeeze(2))
+    return reference_output(layer, x, torch.stack(scores, dim=1), encoder_out)
+
+
+def reference_additive(layer, x, target_embedding, encoder_out):
+    """v^T tanh(W_q d_i + W_k z_j), one target position at a time."""
+    query = (layer.in_projection(x) + target_embedding) * math.sqrt(0.5)
+    keys = layer.attension_add_key(encoder_out[0].transpose(1, 2))
+    scores = []
+    for i in range(query.size(1)):
+        d_i = layer.attension_add_query(query[:, i:i + 1])
+        scores.append(layer.attension_add_score(torch.tanh(d_i + keys)).squeeze(2))
+    return reference_output(layer, x, torch.stack(scores, dim=1), encoder_out)
+
+
+def check_layer(layer, reference):
+    layer.eval()
+    x, target_embedding, encoder_out = random_inputs()
+    with torch.no_grad():
+        out, attn_scores = layer(x, target_embedding, encoder_out)
+        expected_out, expected_scores = reference(layer, x, target_embedding, encoder_out)
+    assert torch.allclose(attn_scores, expected_scores, atol=1e-6)
+    assert torch.allclose(out, expected_out, atol=1e-5)
+
+
+def test_concat_matches_loop():
+    torch.manual_seed(2)
+    check_layer(fconv.ConcatAttentionLayer(CONV_CHANNELS, EMBED_DIM), reference_concat)
+
+
+@pytest.mark.parametrize('chunk_size', [None, 1, 2, TGT_LEN, TGT_LEN + 3])
+def test_additive_matches_loop(chunk_size):
+    torch.manual_seed(2)
+    layer = fconv.AdditiveAttentionLayer(CONV_CHANNELS, EMBED_DIM, chunk_size=chunk_size)
+    check_layer(layer, reference_additive)
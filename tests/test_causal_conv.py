@@ -0,0 +1,35 @@
+from conftest import build_word_embeddings_model, import_fconv, random_sample, run_model
+
+fconv = import_fconv('word-embeddings')
+
+import torch
+
+
+def reference_conv(conv, x):
+    """The original decoder convolution: ConvTBC on T x B x C input."""
+    return conv(x.transpose(0, 1)).transpose(0, 1)
+
+
+def test_decoder_conv_matches_conv_tbc():
+    torch.manual_seed(1)
+    model = build_word_embeddings_model(fconv)
+    conv = model.decoder.convolutions[0]
+    x = torch.randn(2, 6, conv.in_channels)
+    out = model.decoder._conv(conv, x, None)
+    assert out.size() == x.size()[:2] + (conv.out_channels,)
+    assert torch.allclose(out, reference_conv(conv, x), atol=1e-5)
+
+
+def test_decoder_full_sequence_matches_incremental():
+    torch.manual_seed(1)
+    model = build_word_embeddings_model(fconv)
+    model.eval()
+    sample = random_sample(model)
+    with torch.no_grad():
+        logits, _ = run_model(model, sample)
+        incremental_state = {}
+        prev_output_tokens = sample['prev_output_tokens']
+        for step in range(prev_output_tokens.size(1)):
+            sample['prev_output_tokens'] = prev_output_tokens[:, :step + 1]
+            step_logits, _ = run_model(model, sample, incremental_state)
+            assert torch.allclose(step_logits[:, -1], logits[:, step], atol=1e-4)
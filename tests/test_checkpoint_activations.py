@@ -0,0 +1,30 @@
+import pytest
+
+from conftest import build_word_embeddings_model, import_fconv, random_sample, run_model
+
+fconv = import_fconv('word-embeddings')
+
+import torch
+
+
+def gradients(checkpoint_activations):
+    """Gradients of all parameters for one training step with dropout."""
+    torch.manual_seed(1)
+    model = build_word_embeddings_model(fconv, dropout=0.2)
+    model.encoder.checkpoint_activations = checkpoint_activations
+    model.decoder.checkpoint_activations = checkpoint_activations
+    model.train()
+    sample = random_sample(model)
+    torch.manual_seed(2)
+    logits, _ = run_model(model, sample)
+    logits.sum().backward()
+    return {name: p.grad for name, p in model.named_parameters() if p.grad is not None}
+
+
+@pytest.mark.parametrize('checkpoint_activations', [1, 3, 20])
+def test_checkpointed_gradients_match(checkpoint_activations):
+    expected = gradients(0)
+    grads = gradients(checkpoint_activations)
+    assert grads.keys() == expected.keys()
+    for name, grad in grads.items():
+        assert torch.allclose(grad, expected[name], atol=1e-5), name
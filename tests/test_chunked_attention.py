@@ -0,0 +1,58 @@
+import pytest
+
+from conftest import import_fconv
+
+fconv = import_fconv('attention')
+
+import torch
+import torch.nn.functional as F
+
+BSZ, TGT_LEN, WIDTH, SRC_LEN = 2, 5, 4, 11
+
+
+def reference_attention(query, keys, values):
+    """softmax(query keys) values, with the B x T x S scores."""
+    return torch.bmm(F.softmax(torch.bmm(query, keys), dim=2), values)
+
+
+def random_inputs(dtype=torch.float):
+    torch.manual_seed(1)
+    query = torch.randn(BSZ, TGT_LEN, WIDTH, dtype=dtype, requires_grad=True)
+    keys = torch.randn(BSZ, WIDTH, SRC_LEN, dtype=dtype, requires_grad=True)
+    values = torch.randn(BSZ, SRC_LEN, WIDTH, dtype=dtype, requires_grad=True)
+    return query, keys, values
+
+
+# the last chunk is shorter than chunk_size unless it divides SRC_LEN
+@pytest.mark.parametrize('chunk_size', [1, 3, 4, SRC_LEN, SRC_LEN + 5])
+def test_gradcheck(chunk_size):
+    inputs = random_inputs(torch.double)
+    assert torch.autograd.gradcheck(
+        lambda *inputs: fconv.ChunkedAttentionFunction.apply(*inputs, chunk_size), inputs)
+
+
+@pytest.mark.parametrize('chunk_size', [3, 4])
+def test_matches_dense_attention(chunk_size):
+    inputs = random_inputs()
+    expected_inputs = [x.detach().requires_grad_() for x in inputs]
+    grad_out = torch.randn(BSZ, TGT_LEN, WIDTH)
+    out = fconv.ChunkedAttentionFunction.apply(*inputs, chunk_size)
+    expected = reference_attention(*expected_inputs)
+    assert torch.allclose(out, expected, atol=1e-6)
+    out.backward(grad_out)
+    expected.backward(grad_out)
+    for x, expected_x in zip(inputs, expected_inputs):
+        assert torch.allclose(x.grad, expected_x.grad, atol=1e-5)
+
+
+def test_layer_matches_dot_attention():
+    torch.manual_seed(1)
+    layer = fconv.ChunkedAttentionLayer(6, WIDTH // 2, chunk_size=3)
+    dot = fconv.DotAttentionLayer(6, WIDTH // 2)
+    dot.load_state_dict(layer.state_dict())
+    x = torch.randn(BSZ, TGT_LEN, 6)
+    target_embedding = torch.randn(BSZ, TGT_LEN, WIDTH)
+    encoder_out = (torch.randn(BSZ, WIDTH, SRC_LEN), torch.randn(BSZ, SRC_LEN, WIDTH))
+    out, attn_scores = layer(x, target_embedding, encoder_out)
+    assert attn_scores is None
+    assert torch.allclose(out, dot(x, target_embedding, encoder_out)[0], atol=1e-5)
@@ -0,0 +1,69 @@
+from conftest import build_word_embeddings_model, import_fconv
+
+fconv = import_fconv('word-embeddings')
+
+import torch
+import torch.nn.functional as F
+
+BSZ, TGT_LEN = 2, 5
+
+
+def reference_fc1(decoder, x, src_doctopic):
+    """The original decoder input: fc1 on the concatenation of the target
+    embeddings and the doc-topic vector repeated over time."""
+    doctopic = src_doctopic.unsqueeze(1).repeat(1, x.size(1), 1)
+    return decoder.fc1(torch.cat([x, doctopic], 2))
+
+
+def embed(decoder, x, src_doctopic, incremental_state=None):
+    src_doctopic_ext, doctopic_proj = decoder._embed_doctopic(src_doctopic, x.size(1), incremental_state)
+    return F.linear(x, fconv.weight_of(decoder.fc1)[:, :decoder.embed_dim], decoder.fc1.bias) + doctopic_proj
+
+
+def random_inputs(decoder):
+    torch.manual_seed(1)
+    x = torch.randn(BSZ, TGT_LEN, decoder.embed_dim)
+    src_doctopic = torch.rand(BSZ, decoder.fc1.in_features - decoder.embed_dim)
+    return x, src_doctopic
+
+
+def test_doctopic_is_projected_once():
+    model = build_word_embeddings_model(fconv)
+    decoder = model.decoder
+    decoder.eval()
+    x, src_doctopic = random_inputs(decoder)
+    with torch.no_grad():
+        src_doctopic_ext, doctopic_proj = decoder._embed_doctopic(src_doctopic, TGT_LEN, None)
+        assert src_doctopic_ext.size() == (BSZ, 1, src_doctopic.size(1))
+        assert doctopic_proj.size() == (BSZ, 1, decoder.fc1.out_features)
+        assert torch.allclose(embed(decoder, x, src_doctopic), reference_fc1(decoder, x, src_doctopic), atol=1e-5)
+
+
+def test_incremental_doctopic_is_cached():
+    model = build_word_embeddings_model(fconv)
+    decoder = model.decoder
+    decoder.eval()
+    x, src_doctopic = random_inputs(decoder)
+    incremental_state = {}
+    with torch.no_grad():
+        expected = embed(decoder, x, src_doctopic)
+        first = decoder._embed_doctopic(src_doctopic, 1, incremental_state)
+        for step in range(TGT_LEN):
+            out = embed(decoder, x[:, step:step + 1], src_doctopic, incremental_state)
+            assert torch.allclose(out, expected[:, step:step + 1], atol=1e-6)
+        assert decoder._embed_doctopic(src_doctopic, 1, incremental_state) is first
+
+
+def test_training_dropout_is_per_position():
+    model = build_word_embeddings_model(fconv, dropout=0.5)
+    decoder = model.decoder
+    decoder.train()
+    x, src_doctopic = random_inputs(decoder)
+    torch.manual_seed(2)
+    src_doctopic_ext, doctopic_proj = decoder._embed_doctopic(src_doctopic, TGT_LEN, None)
+    torch.manual_seed(2)
+    expected = F.dropout(src_doctopic.unsqueeze(1).expand(-1, TGT_LEN, -1), p=0.5, training=True)
+    assert src_doctopic_ext.equal(expected)
+    assert not src_doctopic_ext[:, 0].equal(src_doctopic_ext[:, 1])
+    torch.manual_seed(2)
+    assert torch.allclose(embed(decoder, x, src_doctopic), decoder.fc1(torch.cat([x, expected], 2)), atol=1e-5)
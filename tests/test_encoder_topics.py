@@ -0,0 +1,94 @@
+import math
+
+from conftest import build_word_embeddings_model, import_fconv, random_sample, run_model
+
+fconv = import_fconv('word-embeddings')
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def reference_encoder(encoder, sample):
+    """The original encoder: fc1 on the concatenation of the word embeddings
+    and the topics, and attention values of width embed_dim + topic_dim."""
+    topics = sample['src_wordtopics'] * sample['src_doctopic'].unsqueeze(1)
+    tokens = sample['src_tokens']
+    input_embedding = torch.cat([encoder.embed_tokens(tokens) + encoder.embed_positions(tokens), topics], 2)
+    x = encoder.fc1(input_embedding).transpose(0, 1)
+    x = encoder._conv_layers(0, len(encoder.convolutions), x)[0].transpose(1, 0)
+    x = encoder.fc2(x)
+    return x, (x + input_embedding) * math.sqrt(0.5)
+
+
+def reference_attention(layer, x, target_embedding, encoder_out):
+    """The original attention layer, on the concatenated attention values."""
+    residual = x
+    x = (layer.in_projection(x) + torch.cat(target_embedding, 2)) * math.sqrt(0.5)
+    attn_scores = F.softmax(torch.bmm(x, encoder_out[0]), dim=2)
+    values = torch.cat(encoder_out[1], 2)
+    s = values.size(1)
+    x = torch.bmm(attn_scores, values) * (s * math.sqrt(1.0 / s))
+    return (layer.out_projection(x) + residual) * math.sqrt(0.5), attn_scores
+
+
+def test_encoder_matches_concatenation():
+    torch.manual_seed(1)
+    model = build_word_embeddings_model(fconv)
+    model.eval()
+    sample = random_sample(model)
+    with torch.no_grad():
+        x, (y_word, y_topic) = model.encoder(
+            sample['src_tokens'], sample['src_lengths'], sample['src_doctopic'], sample['src_wordtopics'])
+        expected_x, expected_y = reference_encoder(model.encoder, sample)
+    assert y_word.size(2) == model.encoder.embed_dim
+    assert y_topic.size(2) == model.encoder.topic_dim
+    assert torch.allclose(x, expected_x, atol=1e-5)
+    assert torch.allclose(torch.cat([y_word, y_topic], 2), expected_y, atol=1e-5)
+
+
+def test_attention_matches_concatenation():
+    torch.manual_seed(1)
+    embed_dim, topic_dim, bsz, tgt_len, src_len = 8, 4, 2, 5, 7
+    layer = fconv.AttentionLayer(6, embed_dim, topic_dim=topic_dim)
+    layer.eval()
+    x = torch.randn(bsz, tgt_len, 6)
+    target_embedding = (torch.randn(bsz, tgt_len, embed_dim), torch.randn(bsz, tgt_len, topic_dim))
+    encoder_out = (
+        torch.randn(bsz, embed_dim + topic_dim, src_len),
+        (torch.randn(bsz, src_len, embed_dim), torch.randn(bsz, src_len, topic_dim)),
+    )
+    with torch.no_grad():
+        out, attn_scores = layer(x, target_embedding, encoder_out)
+        expected_out, expected_scores = reference_attention(layer, x, target_embedding, encoder_out)
+    assert torch.allclose(attn_scores, expected_scores, atol=1e-6)
+    assert torch.allclose(out, expected_out, atol=1e-5)
+
+
+def test_load_weight_norm_fc1_state_dict():
+    # fc1 of the original encoder: a weight-normalized Linear over the
+    # concatenation, saved as weight_g, weight_v and bias
+    torch.manual_seed(1)
+    model = build_word_embeddings_model(fconv)
+    encoder = model.encoder
+    old_fc1 = nn.utils.weight_norm(
+        nn.Linear(encoder.embed_dim + encoder.topic_dim, encoder.fc1.out_features))
+    old_fc1.weight_g.data.uniform_(0.5, 1.5)
+    old_fc1.bias.data.normal_()
+    state_dict = model.state_dict()
+    for name, value in old_fc1.state_dict().items():
+        assert state_dict['encoder.fc1.' + name].size() == value.size(), name
+        state_dict['encoder.fc1.' + name] = value
+    model.load_state_dict(state_dict, strict=True)
+    model.eval()
+
+    sample = random_sample(model)
+    with torch.no_grad():
+        logits, attn = run_model(model, sample)
+        encoder.fc1 = old_fc1
+        expected_x, expected_y = reference_encoder(encoder, sample)
+        encoder_out = (expected_x, (expected_y[:, :, :encoder.embed_dim], expected_y[:, :, encoder.embed_dim:]))
+        expected_logits, expected_attn = model.decoder(
+            sample['prev_output_tokens'], encoder_out, sample['src_doctopic'])
+    assert torch.allclose(logits, expected_logits, atol=1e-5)
+    assert torch.allclose(attn, expected_attn, atol=1e-6)
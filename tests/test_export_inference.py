@@ -0,0 +1,38 @@
+import pytest
+
+from conftest import build_word_embeddings_model, import_fconv
+
+fconv = import_fconv('word-embeddings')
+export_inference = pytest.importorskip('export_inference')
+
+import torch
+
+from fairseq.models.fconv_inference import export_inference_modules
+
+
+@pytest.mark.parametrize('attention', [True, [True, False] * 10])
+def test_torchscript_matches_eager(attention):
+    torch.manual_seed(1)
+    model = build_word_embeddings_model(fconv, attention=attention)
+    model.eval()
+    dictionary = model.decoder.dictionary
+    sample = export_inference.make_batch(model, dictionary, batch_size=3, src_len=9)
+    encoder, decoder_step = (torch.jit.script(module) for module in export_inference_modules(model))
+    with torch.no_grad():
+        encoder_out = model.encoder(
+            sample['src_tokens'], sample['src_lengths'], sample['src_doctopic'], sample['src_wordtopics'])
+        encoder_a, encoder_b, doctopic, doctopic_proj = encoder(
+            sample['src_tokens'], sample['src_lengths'], sample['src_doctopic'], sample['src_wordtopics'])
+        conv_state = decoder_step.initial_state(encoder_b)
+        tokens = sample['src_tokens'].new(3, 5).fill_(dictionary.eos())
+        incremental_state = {}
+        for step in range(tokens.size(1) - 1):
+            logits, expected_attn = model.decoder(
+                tokens[:, :step + 1], encoder_out, sample['src_doctopic'], incremental_state)
+            expected_lprobs = model.decoder.get_normalized_probs((logits, expected_attn), log_probs=True)[:, -1]
+            lprobs, attn, conv_state = decoder_step(
+                tokens[:, step], torch.tensor(step), encoder_a, encoder_b, doctopic, doctopic_proj, conv_state)
+            assert torch.allclose(lprobs, expected_lprobs, atol=1e-4)
+            # the attention is averaged over all layers, as in the eager decoder
+            assert torch.allclose(attn, expected_attn[:, -1], atol=1e-5)
+            tokens[:, step + 1] = lprobs.max(dim=-1)[1]
@@ -0,0 +1,37 @@
+from conftest import build_word_embeddings_model, import_fconv, random_sample, run_model
+
+fconv = import_fconv('word-embeddings')
+
+import torch
+from torch.nn.utils.weight_norm import WeightNorm
+
+from fairseq.modules import LinearizedConvolution
+
+
+def decode(model, sample):
+    """Logits of every step of incremental decoding."""
+    incremental_state = {}
+    prev_output_tokens = sample['prev_output_tokens']
+    steps = []
+    for step in range(prev_output_tokens.size(1)):
+        sample['prev_output_tokens'] = prev_output_tokens[:, :step + 1]
+        steps.append(run_model(model, sample, incremental_state)[0][:, -1])
+    sample['prev_output_tokens'] = prev_output_tokens
+    return torch.stack(steps, dim=1)
+
+
+def test_make_generation_fast_removes_weight_norm():
+    torch.manual_seed(1)
+    model = build_word_embeddings_model(fconv)
+    model.eval()
+    sample = random_sample(model)
+    with torch.no_grad():
+        # fills the cached weights of the linearized convolutions
+        expected = decode(model, sample)
+    model.make_generation_fast_()
+    for module in model.modules():
+        assert not any(isinstance(hook, WeightNorm) for hook in module._forward_pre_hooks.values())
+        if isinstance(module, LinearizedConvolution):
+            assert module._linearized_weight is None
+    with torch.no_grad():
+        assert torch.allclose(decode(model, sample), expected, atol=1e-5)
@@ -0,0 +1,84 @@
+from conftest import import_fconv
+
+fconv = import_fconv('attention')
+
+import torch
+import torch.nn.functional as F
+
+CONV_CHANNELS, EMBED_DIM = 6, 4
+BSZ, TGT_LEN, SRC_LEN = 2, 5, 7
+NUM_SAMPLES = 10
+
+
+def random_inputs(seed=1):
+    torch.manual_seed(seed)
+    width = EMBED_DIM + EMBED_DIM
+    x = torch.randn(BSZ, TGT_LEN, CONV_CHANNELS)
+    target_embedding = torch.randn(BSZ, TGT_LEN, width)
+    encoder_out = (torch.randn(BSZ, width, SRC_LEN), torch.randn(BSZ, SRC_LEN, width))
+    return x, target_embedding, encoder_out
+
+
+def reference_gumbel_softmax(layer, logits):
+    """Mean of the straight-through samples, one K x B x T x S one-hot per sample."""
+    samples = [F.softmax((logits + layer.sample_gumbel(logits.size(), logits.device)) / layer.temperature, dim=-1)
+               for _ in range(layer.num_samples)]
+    y = torch.stack(samples)
+    y_hard = F.one_hot(y.max(dim=-1)[1], logits.size(-1)).type_as(y)
+    return ((y_hard - y).detach() + y).mean(dim=0)
+
+
+def test_seeded_samples_are_reproducible():
+    torch.manual_seed(1)
+    layer = fconv.GumbelAttentionLayer(CONV_CHANNELS, EMBED_DIM, num_samples=NUM_SAMPLES, seed=3)
+    same_seed = fconv.GumbelAttentionLayer(CONV_CHANNELS, EMBED_DIM, num_samples=NUM_SAMPLES, seed=3)
+    same_seed.load_state_dict(layer.state_dict())
+    inputs = random_inputs()
+    rng_state = torch.get_rng_state()
+    first = layer(*inputs)[1]
+    # the samples come from the layer's own generator, not the global one
+    assert torch.equal(torch.get_rng_state(), rng_state)
+    assert torch.equal(same_seed(*inputs)[1], first)
+    # the generator goes on: the next samples are different, and again the same for both
+    second = layer(*inputs)[1]
+    assert not torch.equal(second, first)
+    assert torch.equal(same_seed(*inputs)[1], second)
+    other_seed = fconv.GumbelAttentionLayer(CONV_CHANNELS, EMBED_DIM, num_samples=NUM_SAMPLES, seed=4)
+    other_seed.load_state_dict(layer.state_dict())
+    assert not torch.equal(other_seed(*inputs)[1], first)
+
+
+def test_hard_counts_match_one_hot_samples():
+    torch.manual_seed(1)
+    logits = torch.randn(BSZ, TGT_LEN, SRC_LEN, requires_grad=True)
+    expected_logits = logits.detach().requires_grad_()
+    layer = fconv.GumbelAttentionLayer(CONV_CHANNELS, EMBED_DIM, num_samples=NUM_SAMPLES, seed=3)
+    reference = fconv.GumbelAttentionLayer(CONV_CHANNELS, EMBED_DIM, num_samples=NUM_SAMPLES, seed=3)
+    y = layer.gumbel_softmax(logits)
+    expected = reference_gumbel_softmax(reference, expected_logits)
+    # every sample adds 1 / num_samples to the count of its argmax
+    counts = y.detach() * NUM_SAMPLES
+    assert torch.allclose(counts, counts.round(), atol=1e-4)
+    assert torch.allclose(y.sum(dim=-1), torch.ones(BSZ, TGT_LEN), atol=1e-5)
+    assert torch.allclose(y, expected, atol=1e-6)
+    grad = torch.randn(BSZ, TGT_LEN, SRC_LEN)
+    y.backward(grad)
+    expected.backward(grad)
+    assert torch.allclose(logits.grad, expected_logits.grad, atol=1e-5)
+
+
+def test_eval_uses_softmax():
+    torch.manual_seed(1)
+    layer = fconv.GumbelAttentionLayer(CONV_CHANNELS, EMBED_DIM, num_samples=NUM_SAMPLES)
+    dot = fconv.DotAttentionLayer(CONV_CHANNELS, EMBED_DIM)
+    dot.load_state_dict(layer.state_dict())
+    layer.eval()
+    inputs = random_inputs()
+    rng_state = torch.get_rng_state()
+    with torch.no_grad():
+        out, attn_scores = layer(*inputs)
+        expected_out, expected_scores = dot(*inputs)
+    # nothing is sampled
+    assert torch.equal(torch.get_rng_state(), rng_state)
+    assert torch.allclose(attn_scores, expected_scores, atol=1e-6)
+    assert torch.allclose(out, expected_out, atol=1e-6)
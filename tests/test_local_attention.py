@@ -0,0 +1,96 @@
+import math
+
+from conftest import import_fconv
+
+fconv = import_fconv('attention')
+
+import torch
+import torch.nn.functional as F
+
+CONV_CHANNELS, EMBED_DIM = 6, 4
+BSZ, TGT_LEN, SRC_LEN = 2, 5, 23
+
+
+def random_inputs():
+    torch.manual_seed(1)
+    width = EMBED_DIM + EMBED_DIM
+    x = torch.randn(BSZ, TGT_LEN, CONV_CHANNELS)
+    target_embedding = torch.randn(BSZ, TGT_LEN, width)
+    encoder_out = (torch.randn(BSZ, width, SRC_LEN), torch.randn(BSZ, SRC_LEN, width))
+    return x, target_embedding, encoder_out
+
+
+def build_layers(window):
+    torch.manual_seed(1)
+    local = fconv.LocalAttentionLayer(CONV_CHANNELS, EMBED_DIM, window=window, pool=4, block_size=2)
+    dot = fconv.DotAttentionLayer(CONV_CHANNELS, EMBED_DIM)
+    dot.load_state_dict(local.state_dict())
+    local.eval()
+    dot.eval()
+    return local, dot
+
+
+def reference_local(layer, x, target_embedding, encoder_out):
+    """Dense dot attention with every target position masked to its window."""
+    query = (layer.in_projection(x) + target_embedding) * math.sqrt(0.5)
+    pooled = F.avg_pool1d(encoder_out[0], layer.pool, ceil_mode=True)
+    center = torch.bmm(query, pooled).max(dim=2)[1] * layer.pool + layer.pool // 2
+    start = (center - layer.window // 2).clamp(0, SRC_LEN - layer.window)
+    offset = torch.arange(SRC_LEN) - start.unsqueeze(2)
+    outside = (offset < 0) | (offset >= layer.window)
+    attn_scores = F.softmax(torch.bmm(query, encoder_out[0]).masked_fill(outside, float('-inf')), dim=2)
+    out = torch.bmm(attn_scores, encoder_out[1]) * (SRC_LEN * math.sqrt(1.0 / SRC_LEN))
+    return (layer.out_projection(out) + x) * math.sqrt(0.5), attn_scores
+
+
+def decode(layer, x, target_embedding, encoder_out):
+    """Output and attention scores of every step of incremental decoding."""
+    incremental_state = {}
+    steps = [
+        layer(x[:, t:t + 1], target_embedding[:, t:t + 1], encoder_out, incremental_state)
+        for t in range(x.size(1))
+    ]
+    return tuple(torch.cat(step, dim=1) for step in zip(*steps))
+
+
+def test_full_sequence_is_dense():
+    local, dot = build_layers(window=8)
+    local.train()
+    dot.train()
+    x, target_embedding, encoder_out = random_inputs()
+    out, attn_scores = local(x, target_embedding, encoder_out)
+    expected_out, expected_scores = dot(x, target_embedding, encoder_out)
+    assert torch.allclose(attn_scores, expected_scores, atol=1e-6)
+    assert torch.allclose(out, expected_out, atol=1e-6)
+
+
+def test_incremental_matches_masked_dot():
+    local, _ = build_layers(window=8)
+    x, target_embedding, encoder_out = random_inputs()
+    with torch.no_grad():
+        out, attn_scores = decode(local, x, target_embedding, encoder_out)
+        expected_out, expected_scores = reference_local(local, x, target_embedding, encoder_out)
+    assert torch.allclose(attn_scores, expected_scores, atol=1e-6)
+    assert torch.allclose(out, expected_out, atol=1e-5)
+
+
+def test_window_covering_source_matches_dot():
+    local, dot = build_layers(window=SRC_LEN)
+    x, target_embedding, encoder_out = random_inputs()
+    with torch.no_grad():
+        out, attn_scores = decode(local, x, target_embedding, encoder_out)
+        expected_out, expected_scores = dot(x, target_embedding, encoder_out)
+    assert torch.allclose(attn_scores, expected_scores, atol=1e-6)
+    assert torch.allclose(out, expected_out, atol=1e-5)
+
+
+def test_window_block_covering_source_matches_dense():
+    local, _ = build_layers(window=SRC_LEN)
+    x, target_embedding, encoder_out = random_inputs()
+    query = (local.in_projection(x) + target_embedding) * math.sqrt(0.5)
+    start = torch.zeros(BSZ, TGT_LEN, dtype=torch.long)
+    with torch.no_grad():
+        context, attn_scores = local._attend_block(query, start, encoder_out)
+        expected_scores = F.softmax(torch.bmm(query, encoder_out[0]), dim=2)
+    assert torch.allclose(attn_scores, expected_scores, atol=1e-6)
+    assert torch.allclose(context, torch.bmm(expected_scores, encoder_out[1]), atol=1e-5)
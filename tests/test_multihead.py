@@ -0,0 +1,54 @@
+import pytest
+
+from conftest import import_fconv
+
+fconv = import_fconv('attention')
+benchmark_attention = pytest.importorskip('benchmark_attention')
+
+import torch
+
+CONV_CHANNELS, EMBED_DIM = 6, 4
+BSZ, TGT_LEN, SRC_LEN = 2, 5, 7
+
+
+def test_fused_heads_match_loop():
+    torch.manual_seed(1)
+    layer = fconv.MultiHeadAttentionLayer(CONV_CHANNELS, EMBED_DIM, num_heads=4)
+    loop = benchmark_attention.MultiHeadLoop(layer)
+    layer.eval()
+    width = EMBED_DIM + EMBED_DIM
+    x = torch.randn(BSZ, TGT_LEN, CONV_CHANNELS)
+    target_embedding = torch.randn(BSZ, TGT_LEN, width)
+    encoder_out = (torch.randn(BSZ, width, SRC_LEN), torch.randn(BSZ, SRC_LEN, width))
+    with torch.no_grad():
+        out, attn_scores = layer(x, target_embedding, encoder_out)
+        expected_out, expected_scores = loop(x, target_embedding, encoder_out)
+    assert torch.allclose(attn_scores, expected_scores, atol=1e-6)
+    assert torch.allclose(out, expected_out, atol=1e-5)
+
+
+def test_head_projections_are_saved():
+    layer = fconv.MultiHeadAttentionLayer(CONV_CHANNELS, EMBED_DIM)
+    state_dict = layer.state_dict()
+    for name in ('query_projection', 'key_projection', 'value_projection'):
+        assert name + '.weight_v' in state_dict
+
+
+def test_cached_step_after_reorder_matches_uncached():
+    torch.manual_seed(1)
+    layer = fconv.MultiHeadAttentionLayer(CONV_CHANNELS, EMBED_DIM, num_heads=4)
+    layer.eval()
+    width = EMBED_DIM + EMBED_DIM
+    x = torch.randn(BSZ, 2, CONV_CHANNELS)
+    target_embedding = torch.randn(BSZ, 2, width)
+    encoder_out = (torch.randn(BSZ, width, SRC_LEN), torch.randn(BSZ, SRC_LEN, width))
+    new_order = torch.LongTensor([1, 1])
+    incremental_state = {}
+    with torch.no_grad():
+        layer(x[:, :1], target_embedding[:, :1], encoder_out, incremental_state)
+        layer.reorder_incremental_state(incremental_state, new_order)
+        encoder_out = tuple(out.index_select(0, new_order) for out in encoder_out)
+        out, attn_scores = layer(x[:, 1:], target_embedding[:, 1:], encoder_out, incremental_state)
+        expected_out, expected_scores = layer(x[:, 1:], target_embedding[:, 1:], encoder_out)
+    assert torch.allclose(attn_scores, expected_scores, atol=1e-6)
+    assert torch.allclose(out, expected_out, atol=1e-6)
@@ -0,0 +1,56 @@
+from conftest import build_word_embeddings_model, import_fconv, random_sample, run_model
+
+fconv = import_fconv('word-embeddings')
+
+import torch
+import torch.nn.functional as F
+
+
+def reference_ngtu(x):
+    a, b = x.chunk(2, dim=-1)
+    return torch.tanh(a) * torch.sigmoid(b)
+
+
+def test_ngtu_matches_reference():
+    x = torch.randn(3, 4, 6)
+    assert torch.allclose(fconv.NGTU.apply(x), reference_ngtu(x), atol=1e-6)
+
+
+def test_ngtu_gradcheck():
+    x = torch.randn(3, 4, 6, dtype=torch.double, requires_grad=True)
+    assert torch.autograd.gradcheck(fconv.NGTU.apply, (x,))
+
+
+def test_ngtu_layer_norm_matches_reference():
+    x = torch.randn(3, 4, 6)
+    residual = torch.randn(3, 4, 3)
+    layer_norm = fconv.Fp32LayerNorm(3)
+    layer_norm.weight.data.normal_()
+    layer_norm.bias.data.normal_()
+    expected = layer_norm(reference_ngtu(x) + residual)
+    assert torch.allclose(fconv.ngtu_layer_norm(x, residual, layer_norm), expected, atol=1e-5)
+
+
+def test_ngtu_layer_norm_gradcheck():
+    x = torch.randn(3, 4, 6, dtype=torch.double, requires_grad=True)
+    residual = torch.randn(3, 4, 3, dtype=torch.double, requires_grad=True)
+    weight = torch.randn(3, dtype=torch.double, requires_grad=True)
+    bias = torch.randn(3, dtype=torch.double, requires_grad=True)
+
+    def fused(x, residual, weight, bias):
+        return fconv.NGTULayerNorm.apply(x, residual, weight, bias, 1e-5)
+
+    assert torch.autograd.gradcheck(fused, (x, residual, weight, bias))
+
+
+def test_model_backward_with_and_without_attention():
+    # decoder layers without attention take the fused path, the others the
+    # gate-only one
+    torch.manual_seed(1)
+    model = build_word_embeddings_model(fconv, attention=[True, False] * 10, dropout=0.1)
+    model.train()
+    logits, _ = run_model(model, random_sample(model))
+    logits.sum().backward()
+    for name, p in model.named_parameters():
+        assert p.grad is not None, name
+        assert torch.isfinite(p.grad).all(), name
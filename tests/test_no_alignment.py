@@ -0,0 +1,44 @@
+import pytest
+
+from conftest import build_word_embeddings_model, import_fconv, random_sample
+
+fconv = import_fconv('word-embeddings')
+# generate.py of this repository and the SequenceGenerator of the checkout
+generate = pytest.importorskip('generate')
+if not hasattr(generate, 'NoAlignmentSequenceGenerator'):
+    pytest.skip('generate.py is not the word-embeddings version', allow_module_level=True)
+
+import torch
+
+BEAM_SIZE = 3
+
+
+def hypotheses(generator_cls, need_attn):
+    """Tokens and scores of the hypotheses of every sentence of a batch."""
+    torch.manual_seed(1)
+    model = build_word_embeddings_model(fconv)
+    model.eval()
+    model.make_generation_fast_(beamable_mm_beam_size=BEAM_SIZE, need_attn=need_attn)
+    sample = random_sample(model, bsz=2, src_len=7)
+    batch = {
+        'id': torch.arange(2),
+        'net_input': {
+            name: sample[name] for name in ('src_tokens', 'src_lengths', 'src_doctopic', 'src_wordtopics')
+        },
+        'target': None,
+    }
+    generator = generator_cls([model], beam_size=BEAM_SIZE)
+    result = {}
+    for sample_id, _, _, hypos in generator.generate_batched_itr([batch], maxlen_a=0, maxlen_b=6):
+        result[int(sample_id)] = [(hypo['tokens'].tolist(), float(hypo['score'])) for hypo in hypos]
+    return result
+
+
+def test_no_alignment_gives_same_hypotheses():
+    expected = hypotheses(generate.SequenceGenerator, need_attn=True)
+    result = hypotheses(generate.NoAlignmentSequenceGenerator, need_attn=False)
+    assert result.keys() == expected.keys()
+    for sample_id, hypos in result.items():
+        assert [tokens for tokens, _ in hypos] == [tokens for tokens, _ in expected[sample_id]]
+        for (_, score), (_, expected_score) in zip(hypos, expected[sample_id]):
+            assert score == pytest.approx(expected_score, abs=1e-5)
@@ -0,0 +1,44 @@
+import pytest
+
+from conftest import build_word_embeddings_model, import_fconv
+
+fconv = import_fconv('word-embeddings')
+pytest.importorskip('onnx')
+onnxruntime = pytest.importorskip('onnxruntime')
+export_inference = pytest.importorskip('export_inference')
+
+import numpy as np
+import torch
+
+from fairseq.models.fconv_inference import export_inference_modules
+
+
+def test_onnx_matches_pytorch(tmp_path):
+    torch.manual_seed(1)
+    model = build_word_embeddings_model(fconv, attention=[True, False] * 10)
+    model.eval()
+    dictionary = model.decoder.dictionary
+    sample = export_inference.make_batch(model, dictionary, batch_size=3, src_len=9)
+    with torch.no_grad():
+        ref_lprobs, tokens = export_inference.decode_eager(model, sample, 6, dictionary.eos())
+
+    encoder, decoder_step = export_inference_modules(model)
+    export_inference.export_onnx(encoder, decoder_step, sample, str(tmp_path), opset=13)
+    # every output of both graphs, step by step, against the exported modules
+    export_inference.check_onnx(encoder, decoder_step, sample, tokens, str(tmp_path), atol=1e-4)
+
+    # and the log-probabilities of the ONNX graphs against the eager model
+    options = {'providers': ['CPUExecutionProvider']}
+    encoder_session = onnxruntime.InferenceSession(str(tmp_path / 'encoder.onnx'), **options)
+    decoder_session = onnxruntime.InferenceSession(str(tmp_path / 'decoder_step.onnx'), **options)
+    feeds = dict(zip(
+        export_inference.ENCODER_OUTPUTS,
+        export_inference.run_onnx(
+            encoder_session, {name: sample[name].numpy() for name in export_inference.ENCODER_INPUTS}),
+    ))
+    feeds['conv_state'] = decoder_step.initial_state(torch.from_numpy(feeds['encoder_b'])).numpy()
+    for step in range(tokens.size(1) - 1):
+        feeds['tokens'] = tokens[:, step].numpy()
+        feeds['step'] = np.array(step, dtype=np.int64)
+        lprobs, _, feeds['conv_state'] = export_inference.run_onnx(decoder_session, feeds)
+        np.testing.assert_allclose(lprobs, ref_lprobs[step].numpy(), atol=1e-4)
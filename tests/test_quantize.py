@@ -0,0 +1,69 @@
+import copy
+
+import pytest
+
+from conftest import build_word_embeddings_model, import_fconv, random_sample, run_model
+
+fconv = import_fconv('word-embeddings')
+
+import torch
+
+
+def folded_model():
+    torch.manual_seed(1)
+    model = build_word_embeddings_model(fconv)
+    model.eval()
+    fconv.fold_weight_norm_(model)
+    return model
+
+
+def test_encoder_conv_matches_conv_tbc():
+    conv = folded_model().encoder.convolutions[0]
+    x = torch.randn(6, 2, conv.in_channels)
+    with torch.no_grad():
+        out = fconv.QuantizedConvTBC(conv)(x)
+        expected = conv(x)
+    assert out.size() == expected.size()
+    assert torch.allclose(out, expected, atol=1e-5)
+
+
+def test_decoder_conv_matches_linearized_convolution():
+    conv = folded_model().decoder.convolutions[0]
+    quantized = fconv.QuantizedConvTBC(conv)
+    x = torch.randn(6, 2, conv.in_channels)
+    with torch.no_grad():
+        # full sequences are padded on both sides, the decoder drops the future
+        assert torch.allclose(quantized(x)[:x.size(0)], conv(x), atol=1e-5)
+
+        # incremental decoding, B x T x C
+        incremental_state, expected_state = {}, {}
+        x = x.transpose(0, 1)
+        for step in range(x.size(1)):
+            out = quantized(x[:, :step + 1], incremental_state)
+            expected = conv(x[:, :step + 1], expected_state)
+            assert torch.allclose(out, expected, atol=1e-5)
+        new_order = torch.LongTensor([1, 0])
+        quantized.reorder_incremental_state(incremental_state, new_order)
+        conv.reorder_incremental_state(expected_state, new_order)
+        x = torch.randn(2, 1, conv.in_channels)
+        assert torch.allclose(quantized(x, incremental_state), conv(x, expected_state), atol=1e-5)
+
+
+def log_probs(model, sample):
+    with torch.no_grad():
+        net_output = run_model(model, sample)
+        return model.decoder.get_normalized_probs(net_output, log_probs=True)
+
+
+@pytest.mark.skipif(not hasattr(torch, 'quantization'), reason='needs torch.quantization')
+def test_int8_log_probs_close_to_float():
+    model = folded_model()
+    sample = random_sample(model, bsz=4, src_len=9, tgt_len=6)
+    expected = log_probs(model, sample)
+    quantized = fconv.quantize_int8_(copy.deepcopy(model))
+    assert not any(isinstance(m, fconv.ConvTBCBase) for m in quantized.modules())
+    lprobs = log_probs(quantized, sample)
+    # KL(float || int8) per target token, and agreement of the argmax
+    kl = (expected.exp() * (expected - lprobs)).sum(dim=-1)
+    assert kl.mean() < 0.01
+    assert (lprobs.max(dim=-1)[1] == expected.max(dim=-1)[1]).float().mean() >= 0.9
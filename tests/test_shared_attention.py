@@ -0,0 +1,92 @@
+import copy
+
+import pytest
+
+from conftest import build_dictionary, import_fconv
+
+fconv = import_fconv('attention')
+
+import torch
+
+CONV_CHANNELS, EMBED_DIM = 6, 4
+BSZ, TGT_LEN, SRC_LEN = 2, 5, 7
+FULL, EVERY_SECOND = [True] * 4, [True, False, True, False]
+
+
+def build_model(attention_scores, attention_type='dot'):
+    dictionary = build_dictionary()
+    encoder = fconv.FConvEncoder(
+        dictionary, embed_dim=EMBED_DIM, max_positions=64, convolutions=((CONV_CHANNELS, 3),) * 2)
+    decoder = fconv.FConvDecoder(
+        dictionary, embed_dim=EMBED_DIM, out_embed_dim=EMBED_DIM, max_positions=64,
+        convolutions=((CONV_CHANNELS, 3),) * 4, attention_type=attention_type,
+        attention_scores=attention_scores)
+    return fconv.FConvModel(encoder, decoder)
+
+
+def load(model, state_dict):
+    """As utils.load_model_state of fairseq."""
+    model.upgrade_state_dict(state_dict)
+    model.load_state_dict(state_dict)
+
+
+@pytest.mark.parametrize('variant', ['dot', 'general', 'concat', 'additive', 'multihead'])
+@pytest.mark.parametrize('trained,loaded', [
+    (FULL, EVERY_SECOND),
+    (EVERY_SECOND, [True, False, False, False]),
+    (EVERY_SECOND, EVERY_SECOND),
+])
+def test_checkpoint_loads_with_fewer_scoring_layers(variant, trained, loaded):
+    torch.manual_seed(1)
+    state_dict = build_model(trained, variant).state_dict()
+    model = build_model(loaded, variant)
+    load(model, copy.copy(state_dict))
+    for name, param in model.state_dict().items():
+        assert torch.equal(param, state_dict[name])
+
+
+@pytest.mark.parametrize('trained,loaded', [
+    (EVERY_SECOND, FULL),
+    (EVERY_SECOND, [True, True, False, False]),
+])
+def test_checkpoint_without_scoring_weights_is_rejected(trained, loaded):
+    state_dict = build_model(trained).state_dict()
+    with pytest.raises(ValueError, match='layer 1 computes its scores'):
+        load(build_model(loaded), state_dict)
+
+
+def sharing_layer(layer, **kwargs):
+    """A layer with the weights of *layer* but without its scoring modules,
+    as in a decoder layer that reuses the attention scores of an earlier layer."""
+    sharing = type(layer)(CONV_CHANNELS, EMBED_DIM, **kwargs)
+    for name in sharing.scoring_modules:
+        delattr(sharing, name)
+    state_dict = layer.state_dict()
+    sharing.load_state_dict({name: state_dict[name] for name in sharing.state_dict()})
+    return sharing
+
+
+# with one head, the scores returned by the multi-head attention are those of its head
+@pytest.mark.parametrize('variant,kwargs', [
+    ('dot', {}), ('local', {}), ('general', {}), ('concat', {}), ('additive', {}), ('gumbel', {}),
+    ('multihead', {'num_heads': 1}),
+])
+def test_sharing_layer_matches_full_layer(variant, kwargs):
+    torch.manual_seed(1)
+    layer = fconv.ATTENTION_REGISTRY[variant](CONV_CHANNELS, EMBED_DIM, **kwargs)
+    layer.eval()
+    sharing = sharing_layer(layer, **kwargs)
+    sharing.eval()
+    assert not any(name.startswith(layer.scoring_modules) for name in sharing.state_dict())
+    width = EMBED_DIM + EMBED_DIM
+    x = torch.randn(BSZ, TGT_LEN, CONV_CHANNELS)
+    target_embedding = torch.randn(BSZ, TGT_LEN, width)
+    encoder_out = (torch.randn(BSZ, width, SRC_LEN), torch.randn(BSZ, SRC_LEN, width))
+    with torch.no_grad():
+        expected, attn_scores = layer(x, target_embedding, encoder_out)
+        assert torch.allclose(sharing.attend(x, attn_scores, encoder_out), expected, atol=1e-6)
+        incremental_state = {}
+        for step in range(TGT_LEN):
+            out = sharing.attend(
+                x[:, step:step + 1], attn_scores[:, step:step + 1], encoder_out, incremental_state)
+            assert torch.allclose(out, expected[:, step:step + 1], atol=1e-6)
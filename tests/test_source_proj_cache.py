@@ -0,0 +1,50 @@
+import pytest
+
+from conftest import import_fconv
+
+fconv = import_fconv('attention')
+
+import torch
+
+from fairseq import utils
+
+CONV_CHANNELS, EMBED_DIM = 6, 4
+NUM_SENTENCES, BEAM_SIZE, SRC_LEN = 2, 3, 7
+BSZ = NUM_SENTENCES * BEAM_SIZE
+
+
+def beam_inputs():
+    """Decoder inputs of two steps, with the encoder output of every sentence
+    repeated for its beams as in beam search."""
+    torch.manual_seed(1)
+    width = EMBED_DIM + EMBED_DIM
+    x = torch.randn(BSZ, 2, CONV_CHANNELS)
+    target_embedding = torch.randn(BSZ, 2, width)
+    encoder_out = (torch.randn(NUM_SENTENCES, width, SRC_LEN), torch.randn(NUM_SENTENCES, SRC_LEN, width))
+    encoder_out = tuple(out.repeat(1, BEAM_SIZE, 1).view(BSZ, out.size(1), out.size(2)) for out in encoder_out)
+    return x, target_embedding, encoder_out
+
+
+@pytest.mark.parametrize('variant', ['general', 'concat', 'additive', 'multihead'])
+@pytest.mark.parametrize('new_order,copied', [
+    ([2, 2, 0, 4, 3, 5], False),  # every beam stays in its sentence
+    ([3, 4, 0, 1, 2, 2], True),  # beams taken from the other sentence
+])
+def test_cached_step_after_reorder_matches_uncached(variant, new_order, copied):
+    layer = fconv.ATTENTION_REGISTRY[variant](CONV_CHANNELS, EMBED_DIM)
+    layer.eval()
+    layer.make_generation_fast_(beamable_mm_beam_size=BEAM_SIZE)
+    x, target_embedding, encoder_out = beam_inputs()
+    new_order = torch.LongTensor(new_order)
+    incremental_state = {}
+    with torch.no_grad():
+        layer(x[:, :1], target_embedding[:, :1], encoder_out, incremental_state)
+        cached = utils.get_incremental_state(layer, incremental_state, 'source_proj')
+        layer.reorder_incremental_state(incremental_state, new_order)
+        reordered = utils.get_incremental_state(layer, incremental_state, 'source_proj')
+        assert (reordered is not cached) == copied
+        encoder_out = tuple(out.index_select(0, new_order) for out in encoder_out)
+        out, attn_scores = layer(x[:, 1:], target_embedding[:, 1:], encoder_out, incremental_state)
+        expected_out, expected_scores = layer(x[:, 1:], target_embedding[:, 1:], encoder_out)
+    assert torch.allclose(attn_scores, expected_scores, atol=1e-6)
+    assert torch.allclose(out, expected_out, atol=1e-6)
@@ -0,0 +1,153 @@
+import argparse
+import copy
+import types
+
+import pytest
+
+from conftest import build_dictionary, import_fconv
+
+fconv = import_fconv('word-embeddings')
+trainer = pytest.importorskip('fairseq.trainer')
+if not hasattr(trainer, 'SparseRowSGD'):
+    pytest.skip('fairseq/trainer.py is not the word-embeddings version', allow_module_level=True)
+
+import numpy as np
+import torch
+
+from fairseq import vectordict
+from fairseq.meters import AverageMeter
+
+NUM_ROWS, DIM = 6, 3
+
+
+def sparse_grad(rows, values):
+    return torch.sparse_coo_tensor(torch.tensor([rows]), values, (NUM_ROWS, DIM))
+
+
+def reference_sgd(table, grads, **kwargs):
+    """torch.optim.SGD with one parameter per row, stepped only for the rows
+    present in each gradient."""
+    rows = [table[i].clone().requires_grad_() for i in range(NUM_ROWS)]
+    optimizers = [torch.optim.SGD([row], **kwargs) for row in rows]
+    for grad in grads:
+        grad = grad.coalesce().to_dense()
+        touched = set(grad.nonzero()[:, 0].tolist())
+        for i in touched:
+            rows[i].grad = grad[i].clone()
+            optimizers[i].step()
+    return torch.stack([row.detach() for row in rows])
+
+
+@pytest.mark.parametrize('momentum,nesterov,weight_decay', [
+    (0., False, 0.), (0.9, False, 0.), (0.9, True, 0.), (0.9, True, 0.1),
+])
+def test_sparse_row_sgd_matches_sgd_on_touched_rows(momentum, nesterov, weight_decay):
+    torch.manual_seed(1)
+    table = torch.randn(NUM_ROWS, DIM)
+    # the first gradient has a repeated row, row 0 is never touched
+    grads = [
+        sparse_grad([1, 3, 1], torch.randn(3, DIM)),
+        sparse_grad([3, 4], torch.randn(2, DIM)),
+        sparse_grad([1, 5], torch.randn(2, DIM)),
+    ]
+    weight = torch.nn.Parameter(table.clone())
+    optimizer = trainer.SparseRowSGD(
+        [weight], lr=0.1, momentum=momentum, weight_decay=weight_decay, nesterov=nesterov)
+    for grad in grads:
+        weight.grad = grad
+        optimizer.step()
+    expected = reference_sgd(
+        table, grads, lr=0.1, momentum=momentum, weight_decay=weight_decay, nesterov=nesterov)
+    assert torch.allclose(weight.data, expected, atol=1e-6)
+    assert weight.data[0].equal(table[0])
+
+
+def test_sparse_row_sgd_state_dict_round_trip():
+    torch.manual_seed(1)
+    weight = torch.nn.Parameter(torch.randn(NUM_ROWS, DIM))
+    optimizer = trainer.SparseRowSGD([weight], lr=0.1, momentum=0.9, nesterov=True)
+    weight.grad = sparse_grad([1, 3], torch.randn(2, DIM))
+    optimizer.step()
+
+    resumed_weight = torch.nn.Parameter(weight.data.clone())
+    resumed = trainer.SparseRowSGD([resumed_weight], lr=0.1, momentum=0.9, nesterov=True)
+    # as saved in a checkpoint, not sharing the momentum buffer
+    resumed.load_state_dict(copy.deepcopy(optimizer.state_dict()))
+    grad = sparse_grad([3, 4], torch.randn(2, DIM))
+    weight.grad, resumed_weight.grad = grad, grad.clone()
+    optimizer.step()
+    resumed.step()
+    assert resumed_weight.data.equal(weight.data)
+
+
+def test_sparse_gradients_need_sgd():
+    fake_trainer = trainer.Trainer.__new__(trainer.Trainer)
+    fake_trainer.args = argparse.Namespace(optimizer='adam')
+    fake_trainer._sparse_params = [torch.nn.Parameter(torch.zeros(NUM_ROWS, DIM))]
+    with pytest.raises(ValueError):
+        fake_trainer._build_optimizer()
+
+
+# rows touched by each worker; worker 1 has no gradient, worker 2 has more
+# rows than worker 0, so the others are padded
+WORKER_ROWS = [[1, 3], None, [0, 3, 5]]
+
+
+def worker_grad(rank):
+    rows = WORKER_ROWS[rank]
+    if rows is None:
+        return None
+    generator = torch.Generator().manual_seed(rank)
+    return sparse_grad(rows, torch.randn(len(rows), DIM, generator=generator))
+
+
+def all_reduce_worker(rank, init_method, output_path):
+    world_size = len(WORKER_ROWS)
+    torch.distributed.init_process_group(
+        'gloo', init_method=init_method, world_size=world_size, rank=rank)
+    weight = torch.nn.Parameter(torch.zeros(NUM_ROWS, DIM))
+    weight.grad = worker_grad(rank)
+    fake_trainer = types.SimpleNamespace(
+        args=argparse.Namespace(distributed_world_size=world_size),
+        _sparse_params=[weight],
+        meters={'sparse_comm': AverageMeter()},
+    )
+    trainer.Trainer._all_reduce_sparse_grads(fake_trainer, 2.)
+    torch.save(weight.grad.to_dense(), '{}.{}'.format(output_path, rank))
+    torch.distributed.destroy_process_group()
+
+
+def test_all_reduce_sparse_grads_pads_rows(tmp_path):
+    output_path = str(tmp_path / 'grad')
+    torch.multiprocessing.spawn(
+        all_reduce_worker, args=('file://' + str(tmp_path / 'store'), output_path),
+        nprocs=len(WORKER_ROWS))
+    expected = sum(grad.to_dense() for grad in map(worker_grad, range(len(WORKER_ROWS)))
+                   if grad is not None) / 2.
+    for rank in range(len(WORKER_ROWS)):
+        assert torch.allclose(torch.load('{}.{}'.format(output_path, rank)), expected, atol=1e-6)
+
+
+def test_delta_embedding_trains_offset_only(tmp_path):
+    dictionary = build_dictionary()
+    np.save(str(tmp_path / 'glove.npy'), np.random.RandomState(1).rand(len(dictionary), 8))
+    provider = vectordict.GloveNpyProvider(argparse.Namespace(
+        embedding_path=str(tmp_path / 'glove.npy'), embedding_dim=8))
+    torch.manual_seed(1)
+    encoder = fconv.FConvEncoder(
+        dictionary, embed_provider=provider, max_positions=64, dropout=0., topic_dim=4,
+        embed_grad='delta')
+    encoder.num_attention_layers = 1  # set by FConvModel
+    assert not encoder.embed_tokens.weight.requires_grad
+    assert encoder.embed_delta.sparse
+    assert encoder.embed_delta.weight.data.abs().sum() == 0
+    assert torch.allclose(encoder.embed_tokens.weight.data, torch.FloatTensor(provider.load()))
+
+    src_tokens = torch.LongTensor([[4, 5, 6, 5], [7, 4, 8, 9]])
+    encoder_out = encoder(
+        src_tokens, torch.LongTensor([4, 4]), torch.rand(2, 4), torch.rand(2, 4, 4))
+    encoder_out[0].sum().backward()
+    assert encoder.embed_tokens.weight.grad is None
+    grad = encoder.embed_delta.weight.grad.coalesce()
+    assert grad.is_sparse
+    assert sorted(grad._indices()[0].tolist()) == [4, 5, 6, 7, 8, 9]
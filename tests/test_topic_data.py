@@ -0,0 +1,73 @@
+import types
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+PAD, EOS = 1, 2
+TOPIC_DIM = 4
+
+
+def import_data():
+    """fairseq.data of the checkout, if it is the word-embeddings version."""
+    data = pytest.importorskip('fairseq.data')
+    if not hasattr(data, 'infer_topic_dim'):
+        pytest.skip('fairseq/data.py is not the word-embeddings version')
+    return data
+
+
+def write_topic_table(path, rows):
+    with open(str(path / 'dict.document-lemma.lda.txt'), 'w', encoding='utf8') as f:
+        for lemma, weights in rows:
+            f.write('{} {}\n'.format(lemma, ' '.join(str(w) for w in weights)))
+
+
+def test_topic_dim_is_read_from_the_table(tmp_path):
+    data = import_data()
+    write_topic_table(tmp_path, [('house', [0.1, 0.2, 0.7]), ('tree', [0.5, 0.25, 0.25])])
+    assert data.infer_topic_dim(str(tmp_path), 'document') == 3
+    table = data.load_src_lemma_topic_dictionaries(str(tmp_path), 'document')
+    assert table == {'house': [0.1, 0.2, 0.7], 'tree': [0.5, 0.25, 0.25]}
+
+
+def test_mixed_topic_widths_are_rejected(tmp_path):
+    data = import_data()
+    write_topic_table(tmp_path, [('house', [0.1, 0.2, 0.7]), ('tree', [0.5, 0.5])])
+    with pytest.raises(Exception, match='"tree" has 2 topic weights, expected 3'):
+        data.load_src_lemma_topic_dictionaries(str(tmp_path), 'document')
+
+
+def test_ensemble_of_mixed_topic_widths_is_rejected():
+    generate = pytest.importorskip('generate')
+    if not hasattr(generate, 'ensemble_topic_dim'):
+        pytest.skip('generate.py is not the word-embeddings version')
+
+    def model(topic_dim):
+        return types.SimpleNamespace(encoder=types.SimpleNamespace(topic_dim=topic_dim))
+
+    assert generate.ensemble_topic_dim([model(50), model(50)]) == 50
+    with pytest.raises(ValueError, match='50, 512'):
+        generate.ensemble_topic_dim([model(512), model(50)])
+
+
+@pytest.mark.parametrize('left_pad', [True, False])
+def test_collate_tokens_pads_topics(left_pad):
+    data = import_data()
+    # topics of 2 weights, zero-padded to the TOPIC_DIM of an older model
+    tokens = [torch.LongTensor([4, 5, EOS]), torch.LongTensor([6, 7, 8, 9, EOS])]
+    doctopics = [[0.1, 0.9], [0.6, 0.4]]
+    wordtopics = [[[0.2, 0.8]] * 3, [[0.3, 0.7]] * 5]
+    res, res_doctopic, res_wordtopics = data.LanguagePairDataset.collate_tokens(
+        tokens, doctopics, wordtopics, PAD, EOS, TOPIC_DIM, left_pad)
+
+    expected = torch.full((2, 5), PAD, dtype=torch.long)
+    expected_doctopic = torch.zeros(2, TOPIC_DIM)
+    expected_wordtopics = torch.zeros(2, 5, TOPIC_DIM)
+    for i, v in enumerate(tokens):
+        positions = slice(5 - len(v), 5) if left_pad else slice(0, len(v))
+        expected[i, positions] = v
+        expected_doctopic[i, :2] = torch.FloatTensor(doctopics[i])
+        expected_wordtopics[i, positions, :2] = torch.FloatTensor(wordtopics[i])
+    assert res.equal(expected)
+    assert res_doctopic.equal(expected_doctopic)
+    assert res_wordtopics.equal(expected_wordtopics)
@@ -0,0 +1,118 @@
+import argparse
+
+import pytest
+
+from conftest import build_word_embeddings_model, import_fconv
+
+fconv = import_fconv('word-embeddings')
+trainer = pytest.importorskip('fairseq.trainer')
+if not hasattr(trainer, 'DynamicLossScaler'):
+    pytest.skip('fairseq/trainer.py is not the word-embeddings version', allow_module_level=True)
+
+import torch
+
+
+def build_trainer(seed=1):
+    torch.manual_seed(seed)
+    args = argparse.Namespace(
+        cpu=True, amp='none', optimizer='sgd', lr=[0.1], momentum=0.9, weight_decay=0.,
+        lr_scheduler='fixed', force_anneal=None, lr_shrink=0.1, warmup_updates=0, clip_norm=0.,
+        distributed_world_size=1, distributed_rank=0)
+    return trainer.Trainer(args, build_word_embeddings_model(fconv), torch.nn.Module())
+
+
+def parameters(t):
+    return [p.data.clone() for p in t.model.parameters()]
+
+
+def step(t, scale=1.):
+    """An update with the gradient scale * p of every parameter p."""
+    t._zero_grad()
+    loss = sum((p ** 2).sum() for p in t.model.parameters()) * (scale / 2.)
+    return t._backward_and_opt(loss, 1.)
+
+
+def test_loss_scale_follows_overflows():
+    scaler = trainer.DynamicLossScaler(init_scale=8., scale_window=2)
+    scales = []
+    for overflow in [True, False, False, False, True, True, False, False]:
+        scaler.update_scale(overflow)
+        scales.append(scaler.loss_scale)
+    assert scales == [4., 4., 8., 8., 4., 2., 2., 4.]
+
+    resumed = trainer.DynamicLossScaler(scale_window=2)
+    resumed.load_state_dict(scaler.state_dict())
+    for overflow in [False, False, True, False]:
+        scaler.update_scale(overflow)
+        resumed.update_scale(overflow)
+        assert resumed.loss_scale == scaler.loss_scale
+
+
+def test_overflow_skips_the_update():
+    t = build_trainer()
+    t._loss_scaler = trainer.DynamicLossScaler(init_scale=4.)
+    expected = parameters(t)
+    grad_norm, oom, overflow = step(t, scale=float('inf'))
+    assert overflow
+    assert t._loss_scaler.loss_scale == 2.
+    assert t._num_updates == 0
+    for p, expected_p in zip(t.model.parameters(), expected):
+        assert p.data.equal(expected_p)
+        assert p.grad is None or not p.grad.any()
+
+    # the next update is that of the unscaled gradients
+    grad_norm, oom, overflow = step(t)
+    assert not overflow
+    assert t._num_updates == 1
+    for p, expected_p in zip(t.model.parameters(), expected):
+        assert torch.allclose(p.data, expected_p * 0.9, atol=1e-6)
+
+
+def test_gpu_checkpoint_resumes_on_the_cpu(tmp_path, monkeypatch):
+    t = build_trainer()
+    t._loss_scaler = trainer.DynamicLossScaler(init_scale=8.)
+    t._loss_scaler.update_scale(True)
+    # as train.py, which loads the checkpoint (if any) before training
+    assert t.load_checkpoint(str(tmp_path / 'missing.pt')) is None
+    step(t)
+    saved = []
+    monkeypatch.setattr(trainer.utils, 'save_state', lambda *args: saved.append(args))
+    t.save_checkpoint(str(tmp_path / 'checkpoint_last.pt'), {'epoch': 1, 'batch_offset': 0, 'val_loss': None})
+    extra_state = saved[0][-1]
+    assert extra_state['loss_scaler'] == t._loss_scaler.state_dict()
+
+    # the checkpoint written by utils.save_state, with the tensors of a GPU
+    state = {
+        'args': None,
+        'model': t.model.state_dict(),
+        'optimizer_history': [{
+            'criterion_name': t.criterion.__class__.__name__,
+            'optimizer_name': t.optimizer.__class__.__name__,
+            'lr_scheduler_state': t.lr_scheduler.state_dict(),
+            'num_updates': t._num_updates,
+        }],
+        'last_optimizer_state': t.optimizer.state_dict(),
+        'extra_state': extra_state,
+    }
+    path = str(tmp_path / 'checkpoint_last.pt')
+    with monkeypatch.context() as m:
+        m.setattr(torch.serialization, 'location_tag', lambda storage: 'cuda:0')
+        torch.save(state, path)
+    if not torch.cuda.is_available():
+        with pytest.raises(RuntimeError):
+            torch.load(path)
+
+    resumed = build_trainer(seed=2)
+    resumed._loss_scaler = trainer.DynamicLossScaler(init_scale=8.)
+    assert resumed.load_checkpoint(path)['epoch'] == 1
+    assert resumed._num_updates == 1
+    assert resumed._loss_scaler.state_dict() == t._loss_scaler.state_dict()
+    for p, expected_p in zip(resumed.model.parameters(), t.model.parameters()):
+        assert p.device.type == 'cpu'
+        assert p.data.equal(expected_p.data)
+
+    # the momentum buffers were restored too
+    step(t)
+    step(resumed)
+    for p, expected_p in zip(resumed.model.parameters(), t.model.parameters()):
+        assert torch.allclose(p.data, expected_p.data, atol=1e-6)
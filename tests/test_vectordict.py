@@ -0,0 +1,146 @@
+import argparse
+import os
+
+import pytest
+
+vectordict = pytest.importorskip('fairseq.vectordict')
+if not hasattr(vectordict, 'embedding_stats'):
+    pytest.skip('fairseq/vectordict.py is not the word-embeddings version', allow_module_level=True)
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+NUM_ROWS, DIM = 10, 3
+
+
+def save_embedding(path, seed=1, offset=0.):
+    embeddings = np.random.RandomState(seed).rand(NUM_ROWS, DIM).astype(np.float32) + offset
+    np.save(path, embeddings)
+    return embeddings
+
+
+# chunks of one row, chunks that do not divide the rows, one chunk, and a chunk larger than the matrix
+@pytest.mark.parametrize('chunk_size', [1, 3, 4, NUM_ROWS, NUM_ROWS + 5])
+@pytest.mark.parametrize('offset', [0., 1000.])
+def test_embedding_stats_match_numpy(tmp_path, chunk_size, offset):
+    path = str(tmp_path / 'glove.npy')
+    embeddings = save_embedding(path, offset=offset).astype(np.float64)
+    for source in (path, embeddings):
+        mean, std = vectordict.embedding_stats(source, chunk_size)
+        assert np.allclose(mean, np.mean(embeddings, axis=0), rtol=0., atol=1e-10)
+        assert np.allclose(std, np.std(embeddings, axis=0), rtol=0., atol=1e-10)
+
+
+def test_normalization_cache_is_rebuilt_when_stale(tmp_path, monkeypatch):
+    path = str(tmp_path / 'glove.npy')
+    builds = []
+    build_normalization_cache = vectordict.build_normalization_cache
+
+    def counting_build(*args, **kwargs):
+        builds.append(args[0])
+        return build_normalization_cache(*args, **kwargs)
+
+    monkeypatch.setattr(vectordict, 'build_normalization_cache', counting_build)
+
+    def check(embeddings, num_builds):
+        normalized = vectordict.load_embedding(path, normalize=True, chunk_size=4)
+        assert len(builds) == num_builds
+        mean, std = vectordict.load_embedding_stats(path)
+        assert np.allclose(mean, embeddings.mean(axis=0), atol=1e-6)
+        assert np.allclose(normalized, vectordict.normalize_embedding(embeddings, mean, std))
+
+    embeddings = save_embedding(path)
+    check(embeddings, 1)
+    check(embeddings, 1)
+
+    # a new embedding file (the modification time is moved on explicitly,
+    # since the file system may not resolve both writes)
+    mtime_ns = os.stat(path).st_mtime_ns
+    embeddings = save_embedding(path, seed=2)
+    os.utime(path, ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+    check(embeddings, 2)
+
+    # statistics written with another scale
+    stats_path, _ = vectordict._normalization_cache(path)
+    with np.load(stats_path) as stats:
+        stats = dict(stats)
+    stats['scale'] = vectordict.NORM_SCALE + 1.
+    np.savez(stats_path, **stats)
+    check(embeddings, 3)
+    check(embeddings, 3)
+
+
+def test_register_embedding_provider(monkeypatch):
+    monkeypatch.setattr(vectordict, 'EMBEDDING_PROVIDER_REGISTRY', {})
+
+    @vectordict.register_embedding_provider('test')
+    class TestProvider(vectordict.EmbeddingProvider):
+        default_dim = 4
+
+        def _load(self):
+            return np.ones((NUM_ROWS, 8))
+
+    with pytest.raises(ValueError):
+        vectordict.register_embedding_provider('test')(TestProvider)
+    with pytest.raises(ValueError):
+        vectordict.register_embedding_provider('other')(object)
+    provider = vectordict.build_embedding_provider(argparse.Namespace(embedding_provider='test'))
+    assert isinstance(provider, TestProvider)
+    assert provider.load().shape == (NUM_ROWS, 4)
+
+
+def test_embedding_arg_defaults_only_fill_missing_options(monkeypatch):
+    monkeypatch.setattr(vectordict, '_EMBEDDING_ARG_DEFAULTS', {})
+    vectordict.set_embedding_arg_defaults(argparse.Namespace(
+        embedding_provider='word2vec', embedding_path=None, embedding_dim=200))
+    # the arguments of a checkpoint saved before the embedding options
+    provider = vectordict.build_embedding_provider(argparse.Namespace())
+    assert isinstance(provider, vectordict.Word2VecProvider)
+    assert provider.path == vectordict.Word2VecProvider.default_path
+    assert provider.embedding_dim == 200
+    # the options stored in a newer checkpoint win, even if they are None
+    provider = vectordict.build_embedding_provider(argparse.Namespace(
+        embedding_provider='glove-npy', embedding_path='vectors.npy', embedding_dim=None))
+    assert isinstance(provider, vectordict.GloveNpyProvider)
+    assert provider.path == 'vectors.npy'
+    assert provider.embedding_dim == vectordict.GloveNpyProvider.default_dim
+
+
+def test_providers_are_shared_by_configuration(tmp_path, monkeypatch):
+    monkeypatch.setattr(vectordict, '_EMBEDDING_PROVIDERS', {})
+    path = str(tmp_path / 'glove.npy')
+    save_embedding(path)
+
+    def provider(**kwargs):
+        return vectordict.get_embedding_provider(argparse.Namespace(
+            embedding_provider='glove-npy', embedding_path=path, **kwargs))
+
+    first = provider(embedding_dim=2)
+    assert provider(embedding_dim=2) is first
+    assert provider(embedding_dim=3) is not first
+    assert first.load() is first.load()
+    vectordict.release_embedding_providers()
+    assert first._embedding is None
+
+
+def embedding_model(weight):
+    """A model with an embedding table tied to its output projection."""
+    model = nn.Module()
+    model.embed = nn.Embedding(NUM_ROWS, DIM)
+    model.embed.weight.data.copy_(weight)
+    model.out = nn.Linear(DIM, NUM_ROWS, bias=False)
+    model.out.weight = model.embed.weight
+    return model
+
+
+def test_share_embeddings_only_shares_equal_tables():
+    torch.manual_seed(1)
+    weight = torch.randn(NUM_ROWS, DIM)
+    models = [embedding_model(weight), embedding_model(weight), embedding_model(weight + 1.)]
+    assert vectordict.share_embeddings_(models) == 1
+    shared = models[0].embed.weight
+    assert models[1].embed.weight is shared
+    assert models[1].out.weight is shared
+    assert models[2].embed.weight is not shared
+    assert models[2].out.weight is models[2].embed.weight
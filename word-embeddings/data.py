@@ -17,7 +17,7 @@ import numpy as np
 import os
 import torch
 import torch.utils.data
-from fairseq.vectordict import vector_dict
+from fairseq.vectordict import startup_report, vector_dict
 
 from fairseq.dictionary import Dictionary
 from fairseq.indexed_dataset import IndexedDataset, IndexedInMemoryDataset, IndexedRawTextDataset, IndexedRawTextDatasetDOCTOPICS, IndexedRawTextDatasetLEMMA
@@ -59,8 +59,9 @@ def create_vec_dict():
 
 def load_dictionaries(path, src_lang, dst_lang):
     """Load dictionaries for a given language pair."""
-    src_dict = Dictionary.load(os.path.join(path, 'dict.{}.txt'.format(src_lang)))
-    dst_dict = Dictionary.load(os.path.join(path, 'dict.{}.txt'.format(dst_lang)))
+    with startup_report.section('dictionary'):
+        src_dict = Dictionary.load(os.path.join(path, 'dict.{}.txt'.format(src_lang)))
+        dst_dict = Dictionary.load(os.path.join(path, 'dict.{}.txt'.format(dst_lang)))
     #vector_dict.src_dict = src_dict.indices
     #vector_dict.reverse()
     #vector_dict.add_vector()
@@ -68,18 +69,29 @@ def load_dictionaries(path, src_lang, dst_lang):
     return src_dict, dst_dict
 
 
+def infer_topic_dim(path, src_lang):
+    """Number of topics K in the lemma-topic table (read from its first line)."""
+    with open(os.path.join(path, 'dict.{}-lemma.lda.txt'.format(src_lang)),encoding='utf8') as f:
+        return len(f.readline().split()) - 1
+
+
 def load_src_lemma_topic_dictionaries(path, src_lang):
     """
     SHASHI
     """
     print("Loading ",os.path.join(path, 'dict.{}-lemma.lda.txt'.format(src_lang)))
     src_lemma_topic_dict = {}
-    with open(os.path.join(path, 'dict.{}-lemma.lda.txt'.format(src_lang)),encoding='utf8') as f:
+    topic_dim = None
+    with startup_report.section('topic table'), \
+            open(os.path.join(path, 'dict.{}-lemma.lda.txt'.format(src_lang)),encoding='utf8') as f:
         for line in f:
             ldata = line.split()
             src_lemma_topic_dict[ldata[0]] = [float(item) for item in ldata[1:]]
-            # if len(src_lemma_topic_dict[ldata[0]]) != 512:
-            #     print("some problem")
+            if topic_dim is None:
+                topic_dim = len(ldata) - 1
+            elif len(ldata) - 1 != topic_dim:
+                raise Exception('Lemma "{}" has {} topic weights, expected {}'.format(
+                    ldata[0], len(ldata) - 1, topic_dim))
     print("Done!")
     return src_lemma_topic_dict
 
@@ -134,12 +146,19 @@ def load_dataset(path, load_splits, src=None, dst=None):
                 eos_idx=dataset.src_dict.eos(),
             )
 
+    print(startup_report)
     return dataset
 
 
-def load_raw_text_dataset(path, load_splits, src=None, dst=None, doctopic=None, embed_dim=512):
+def load_raw_text_dataset(path, load_splits, src=None, dst=None, doctopic=None, embed_dim=None, topic_dim=None):
     """Loads specified data splits (e.g., test, train or valid) from raw text
-    files in the specified folder."""
+    files in the specified folder.
+
+    Topic vectors are as wide as the lemma-topic table unless a larger
+    *topic_dim* is given, in which case they are zero-padded (models trained
+    before the topic width was configurable expect 512). *embed_dim* is
+    no longer used and only kept for existing callers.
+    """
     # if src is None and dst is None or doctopic is None:
     #     # find language pair automatically
     #     src, dst = infer_language_pair(path, load_splits)
@@ -147,8 +166,13 @@ def load_raw_text_dataset(path, load_splits, src=None, dst=None, doctopic=None,
 
     src_dict, dst_dict = load_dictionaries(path, src, dst)
     src_lemma_topic_dict = load_src_lemma_topic_dictionaries(path, src)
+    table_topic_dim = len(next(iter(src_lemma_topic_dict.values())))
+    if topic_dim is None:
+        topic_dim = table_topic_dim
+    assert topic_dim >= table_topic_dim, \
+        'topic_dim ({}) is smaller than the lemma-topic table ({})'.format(topic_dim, table_topic_dim)
     
-    dataset = LanguageDatasets(src, dst, doctopic, src_dict, dst_dict, src_lemma_topic_dict)
+    dataset = LanguageDatasets(src, dst, doctopic, src_dict, dst_dict, src_lemma_topic_dict, topic_dim)
 
     # Load dataset from raw text files
     for split in load_splits:
@@ -165,15 +189,16 @@ def load_raw_text_dataset(path, load_splits, src=None, dst=None, doctopic=None,
             src_lemma_topic_dict,
             pad_idx=dataset.src_dict.pad(),
             eos_idx=dataset.src_dict.eos(),
-            embed_dim=embed_dim,
+            topic_dim=topic_dim,
         )
 
         # print(dataset.splits[split].__getitem__(0)) 
+    print(startup_report)
     return dataset
 
 
 class LanguageDatasets(object):
-    def __init__(self, src, dst, doctopic, src_dict, dst_dict, src_lemma_topic_dict):
+    def __init__(self, src, dst, doctopic, src_dict, dst_dict, src_lemma_topic_dict, topic_dim=512):
         self.src = src
         self.dst = dst
         self.doctopic = doctopic
@@ -181,6 +206,7 @@ class LanguageDatasets(object):
         self.src_dict = src_dict
         self.dst_dict = dst_dict
         self.src_lemma_topic_dict = src_lemma_topic_dict
+        self.topic_dim = topic_dim
         
         self.splits = {}
 
@@ -245,7 +271,7 @@ class LanguagePairDataset(torch.utils.data.Dataset):
     LEFT_PAD_SOURCE = True
     LEFT_PAD_TARGET = False
 
-    def __init__(self, src, dst, src_lemma, src_doctopic, src_lemma_topic_dict, pad_idx, eos_idx, embed_dim=512):
+    def __init__(self, src, dst, src_lemma, src_doctopic, src_lemma_topic_dict, pad_idx, eos_idx, topic_dim=512):
         self.src = src
         self.dst = dst
         self.src_lemma = src_lemma
@@ -254,7 +280,7 @@ class LanguagePairDataset(torch.utils.data.Dataset):
         
         self.pad_idx = pad_idx
         self.eos_idx = eos_idx
-        self.embed_dim = embed_dim
+        self.topic_dim = topic_dim
         
     def __getitem__(self, i):
         # subtract 1 for 0-based indexing
@@ -271,10 +297,10 @@ class LanguagePairDataset(torch.utils.data.Dataset):
         return len(self.src)
 
     def collater(self, samples):
-        return LanguagePairDataset.collate(samples, self.pad_idx, self.eos_idx, self.embed_dim, self.dst is not None)
+        return LanguagePairDataset.collate(samples, self.pad_idx, self.eos_idx, self.topic_dim, self.dst is not None)
 
     @staticmethod
-    def collate(samples, pad_idx, eos_idx, embed_dim, has_target=True):
+    def collate(samples, pad_idx, eos_idx, topic_dim, has_target=True):
         if len(samples) == 0:
             return {}
 
@@ -285,7 +311,7 @@ class LanguagePairDataset(torch.utils.data.Dataset):
             if key == "source":
                 doctopic = [s['doctopic'] for s in samples]
                 wordtopics = [s['wordtopics'] for s in samples]
-            return LanguagePairDataset.collate_tokens(tokens, doctopic, wordtopics, pad_idx, eos_idx, embed_dim, left_pad, move_eos_to_beginning)
+            return LanguagePairDataset.collate_tokens(tokens, doctopic, wordtopics, pad_idx, eos_idx, topic_dim, left_pad, move_eos_to_beginning)
 
         id = torch.LongTensor([s['id'] for s in samples])
         src_tokens, src_doctopic, src_wordtopics = merge('source', left_pad=LanguagePairDataset.LEFT_PAD_SOURCE)
@@ -327,7 +353,7 @@ class LanguagePairDataset(torch.utils.data.Dataset):
         }
 
     @staticmethod
-    def collate_tokens(values, values_doctopic, values_wordtopics, pad_idx, eos_idx, embed_dim, left_pad, move_eos_to_beginning=False):
+    def collate_tokens(values, values_doctopic, values_wordtopics, pad_idx, eos_idx, topic_dim, left_pad, move_eos_to_beginning=False):
         size = max(v.size(0) for v in values)
         res = values[0].new(len(values), size).fill_(pad_idx)
         res_doctopic = None
@@ -341,8 +367,8 @@ class LanguagePairDataset(torch.utils.data.Dataset):
             for wordtopics in values_wordtopics:
                 tmp_tensor = torch.FloatTensor(wordtopics)
                 tmp_values_wordtopics.append(tmp_tensor)
-            res_doctopic = tmp_values_wordtopics[0].new(len(values), embed_dim).fill_(0.0)
-            res_wordtopics = tmp_values_wordtopics[0].new(len(values), size, embed_dim).fill_(0.0)
+            res_doctopic = tmp_values_wordtopics[0].new(len(values), topic_dim).fill_(0.0)
+            res_wordtopics = tmp_values_wordtopics[0].new(len(values), size, topic_dim).fill_(0.0)
         
         # print(values[0], len(values[0]))
         # # print(values_doctopic[0])
@@ -369,14 +395,15 @@ class LanguagePairDataset(torch.utils.data.Dataset):
                 copy_tensor(v, res[i][size-len(v):])
                 if values_doctopic and values_wordtopics:
                     # Source only
-                    copy_tensor_srconly(tmp_values_doctopic[i], res_doctopic[i])
-                    copy_tensor_srconly(tmp_values_wordtopics[i], res_wordtopics[i][size-len(tmp_values_wordtopics[i]):])
+                    # topics narrower than topic_dim are zero-padded on the right
+                    copy_tensor_srconly(tmp_values_doctopic[i], res_doctopic[i][:tmp_values_doctopic[i].size(-1)])
+                    copy_tensor_srconly(tmp_values_wordtopics[i], res_wordtopics[i][size-len(tmp_values_wordtopics[i]):, :tmp_values_wordtopics[i].size(-1)])
             else:
                 copy_tensor(v, res[i][:len(v)])
                 if values_doctopic and values_wordtopics:
                     # Source only
-                    copy_tensor_srconly(tmp_values_doctopic[i], res_doctopic[i])
-                    copy_tensor_srconly(tmp_values_wordtopics[i], res_wordtopics[i][:len(tmp_values_wordtopics[i])])
+                    copy_tensor_srconly(tmp_values_doctopic[i], res_doctopic[i][:tmp_values_doctopic[i].size(-1)])
+                    copy_tensor_srconly(tmp_values_wordtopics[i], res_wordtopics[i][:len(tmp_values_wordtopics[i]), :tmp_values_wordtopics[i].size(-1)])
         return res, res_doctopic, res_wordtopics
 
 
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3 -u
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Export the encoder and a single decoder step of a topic-aware fconv
+checkpoint as TorchScript modules (and optionally ONNX graphs), and compare
+their CPU latency with the eager fairseq model.
+"""
+
+import argparse
+from collections import OrderedDict
+import inspect
+import os
+import time
+
+import torch
+
+from fairseq import data, utils
+from fairseq.models.fconv_inference import export_inference_modules
+
+
+ENCODER_INPUTS = ['src_tokens', 'src_lengths', 'src_doctopic', 'src_wordtopics']
+ENCODER_OUTPUTS = ['encoder_a', 'encoder_b', 'doctopic', 'doctopic_proj']
+DECODER_INPUTS = ['tokens', 'step'] + ENCODER_OUTPUTS + ['conv_state']
+DECODER_OUTPUTS = ['lprobs', 'attn', 'new_conv_state']
+
+
+def main(args):
+    if args.cpu_threads is not None:
+        torch.set_num_threads(args.cpu_threads)
+    if args.source_lang is None or args.target_lang is None:
+        args.source_lang, args.target_lang = data.infer_language_pair(args.data, ['train'])
+    src_dict, dst_dict = data.load_dictionaries(args.data, args.source_lang, args.target_lang)
+
+    print('| loading model from {}'.format(args.path))
+    models, _ = utils.load_ensemble_for_inference([args.path], src_dict, dst_dict)
+    model = models[0]
+    model.eval()
+
+    # a synthetic batch of the requested size
+    torch.manual_seed(1)
+    sample = make_batch(model, src_dict, args.batch_size, args.source_length)
+
+    # reference outputs of the eager model, before weight norm is folded
+    with torch.no_grad():
+        ref_lprobs, tokens = decode_eager(model, sample, args.steps, dst_dict.eos())
+
+    eager_encoder, eager_decoder_step = export_inference_modules(model)
+    encoder = torch.jit.script(eager_encoder)
+    decoder_step = torch.jit.script(eager_decoder_step)
+    with torch.no_grad():
+        lprobs = decode_exported(encoder, decoder_step, sample, tokens)
+    diff = (lprobs - ref_lprobs).abs().max().item()
+    print('| max abs difference of the log-probabilities: {:.2e}'.format(diff))
+    if not diff <= args.atol:
+        raise RuntimeError('TorchScript log-probabilities differ from the eager model by {:.2e}'.format(diff))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    encoder.save(os.path.join(args.output_dir, 'encoder.pt'))
+    decoder_step.save(os.path.join(args.output_dir, 'decoder_step.pt'))
+    print('| saved encoder.pt and decoder_step.pt to {}'.format(args.output_dir))
+
+    if args.onnx:
+        export_onnx(eager_encoder, eager_decoder_step, sample, args.output_dir, args.opset)
+        print('| saved encoder.onnx and decoder_step.onnx to {}'.format(args.output_dir))
+        check_onnx(eager_encoder, eager_decoder_step, sample, tokens, args.output_dir, args.onnx_atol)
+
+    if args.benchmark:
+        runs = [
+            ('eager', lambda: decode_eager(model, sample, args.steps, dst_dict.eos())),
+            ('torchscript', lambda: decode_exported(encoder, decoder_step, sample, tokens)),
+        ]
+        if hasattr(torch, 'compile'):
+            encoder_c, decoder_step_c = export_inference_modules(model)
+            encoder_c, decoder_step_c = torch.compile(encoder_c), torch.compile(decoder_step_c)
+            runs.append(('torch.compile', lambda: decode_exported(encoder_c, decoder_step_c, sample, tokens)))
+        for name, run in runs:
+            seconds = benchmark(run, args.repeat)
+            print('| {}: {:.1f} ms per batch, {:.2f} ms per decoder step'.format(
+                name, 1000 * seconds, 1000 * seconds / args.steps))
+
+
+def make_batch(model, src_dict, batch_size, src_len):
+    topic_dim = model.encoder.topic_dim
+    src_tokens = torch.randint(src_dict.nspecial, len(src_dict), (batch_size, src_len)).long()
+    src_tokens[:, -1] = src_dict.eos()
+    doctopic = torch.softmax(torch.randn(batch_size, topic_dim), dim=-1)
+    wordtopics = torch.softmax(torch.randn(batch_size, src_len, topic_dim), dim=-1)
+    return {
+        'src_tokens': src_tokens,
+        'src_lengths': torch.LongTensor(batch_size).fill_(src_len),
+        'src_doctopic': doctopic,
+        'src_wordtopics': wordtopics,
+    }
+
+
+def decode_eager(model, sample, steps, eos):
+    """Greedy decoding with the fairseq model and incremental_state; returns
+    the log-probabilities of each step (steps x B x V) and the tokens fed."""
+    encoder_out = model.encoder(
+        sample['src_tokens'], sample['src_lengths'], sample['src_doctopic'], sample['src_wordtopics'])
+    bsz = sample['src_tokens'].size(0)
+    tokens = sample['src_tokens'].new(bsz, steps + 1).fill_(eos)
+    incremental_state = {}
+    all_lprobs = []
+    for step in range(steps):
+        decoder_out = model.decoder(tokens[:, :step + 1], encoder_out, sample['src_doctopic'], incremental_state)
+        lprobs = model.decoder.get_normalized_probs(decoder_out, log_probs=True)[:, -1]
+        tokens[:, step + 1] = lprobs.max(dim=-1)[1]
+        all_lprobs.append(lprobs)
+    return torch.stack(all_lprobs), tokens
+
+
+def decode_exported(encoder, decoder_step, sample, tokens):
+    """Feed *tokens* to the exported modules; returns the log-probabilities of
+    each step (steps x B x V)."""
+    encoder_a, encoder_b, doctopic, doctopic_proj = encoder(
+        sample['src_tokens'], sample['src_lengths'], sample['src_doctopic'], sample['src_wordtopics'])
+    conv_state = decoder_step.initial_state(encoder_b)
+    all_lprobs = []
+    for step in range(tokens.size(1) - 1):
+        lprobs, _, conv_state = decoder_step(
+            tokens[:, step], torch.tensor(step), encoder_a, encoder_b, doctopic, doctopic_proj, conv_state)
+        all_lprobs.append(lprobs)
+    return torch.stack(all_lprobs)
+
+
+def export_onnx(encoder, decoder_step, sample, output_dir, opset):
+    """Write encoder.onnx and decoder_step.onnx; batch, source length and
+    the dimensions that follow them are dynamic."""
+    # the TorchScript-based exporter, which takes dynamic_axes (PyTorch 2.9
+    # and later default to the torch.export-based one)
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs = dict(opset_version=opset, dynamo=False)
+    else:
+        export_kwargs = dict(opset_version=opset)
+    encoder_inputs = tuple(sample[name] for name in ENCODER_INPUTS)
+    torch.onnx.export(
+        encoder, encoder_inputs, os.path.join(output_dir, 'encoder.onnx'),
+        input_names=ENCODER_INPUTS, output_names=ENCODER_OUTPUTS,
+        dynamic_axes={
+            'src_tokens': {0: 'batch', 1: 'src_len'},
+            'src_lengths': {0: 'batch'},
+            'src_doctopic': {0: 'batch'},
+            'src_wordtopics': {0: 'batch', 1: 'src_len'},
+            'encoder_a': {0: 'batch', 2: 'src_len'},
+            'encoder_b': {0: 'batch', 1: 'src_len'},
+            'doctopic': {0: 'batch'},
+            'doctopic_proj': {0: 'batch'},
+        },
+        **export_kwargs
+    )
+
+    with torch.no_grad():
+        encoder_out = encoder(*encoder_inputs)
+    step_inputs = (sample['src_tokens'][:, -1], torch.tensor(0)) + tuple(encoder_out) + (
+        decoder_step.initial_state(encoder_out[1]),)
+    torch.onnx.export(
+        decoder_step, step_inputs, os.path.join(output_dir, 'decoder_step.onnx'),
+        input_names=DECODER_INPUTS, output_names=DECODER_OUTPUTS,
+        dynamic_axes={
+            'tokens': {0: 'batch'},
+            'encoder_a': {0: 'batch', 2: 'src_len'},
+            'encoder_b': {0: 'batch', 1: 'src_len'},
+            'doctopic': {0: 'batch'},
+            'doctopic_proj': {0: 'batch'},
+            'conv_state': {1: 'batch'},
+            'lprobs': {0: 'batch'},
+            'attn': {0: 'batch', 1: 'src_len'},
+            'new_conv_state': {1: 'batch'},
+        },
+        **export_kwargs
+    )
+
+
+def run_onnx(session, feeds):
+    """Run an onnxruntime *session*, feeding only the inputs the graph kept
+    (unused inputs such as src_lengths are pruned by the exporter)."""
+    return session.run(None, {i.name: feeds[i.name] for i in session.get_inputs()})
+
+
+def check_onnx(encoder, decoder_step, sample, tokens, output_dir, atol):
+    """Compare the outputs of the ONNX graphs (run with onnxruntime) with
+    those of the PyTorch modules; raises if they differ by more than atol."""
+    import onnxruntime
+
+    max_diff = OrderedDict((name, 0.) for name in ENCODER_OUTPUTS + DECODER_OUTPUTS)
+
+    def compare(name, expected, actual):
+        max_diff[name] = max(max_diff[name], float(abs(expected.numpy() - actual).max()))
+
+    options = {'providers': ['CPUExecutionProvider']}
+    encoder_session = onnxruntime.InferenceSession(os.path.join(output_dir, 'encoder.onnx'), **options)
+    decoder_session = onnxruntime.InferenceSession(os.path.join(output_dir, 'decoder_step.onnx'), **options)
+
+    with torch.no_grad():
+        encoder_out = encoder(*(sample[name] for name in ENCODER_INPUTS))
+    onnx_encoder_out = run_onnx(encoder_session, {name: sample[name].numpy() for name in ENCODER_INPUTS})
+    for name, expected, actual in zip(ENCODER_OUTPUTS, encoder_out, onnx_encoder_out):
+        compare(name, expected, actual)
+
+    # the PyTorch decoder is fed the outputs of the PyTorch encoder, the ONNX
+    # one those of the ONNX encoder, with the same tokens
+    conv_state = decoder_step.initial_state(encoder_out[1])
+    feeds = dict(zip(ENCODER_OUTPUTS, onnx_encoder_out))
+    feeds['conv_state'] = conv_state.numpy()
+    for step in range(tokens.size(1) - 1):
+        with torch.no_grad():
+            outputs = decoder_step(tokens[:, step], torch.tensor(step), *encoder_out, conv_state)
+        feeds['tokens'] = tokens[:, step].numpy()
+        feeds['step'] = torch.tensor(step).numpy()
+        onnx_outputs = run_onnx(decoder_session, feeds)
+        for name, expected, actual in zip(DECODER_OUTPUTS, outputs, onnx_outputs):
+            compare(name, expected, actual)
+        conv_state = outputs[2]
+        feeds['conv_state'] = onnx_outputs[2]
+
+    for name, diff in max_diff.items():
+        print('| onnx {}: max abs difference {:.2e}'.format(name, diff))
+        if not diff <= atol:
+            raise RuntimeError('ONNX output {} differs from PyTorch by {:.2e}'.format(name, diff))
+
+
+def benchmark(run, repeat):
+    with torch.no_grad():
+        run()  # warm up
+        start = time.perf_counter()
+        for _ in range(repeat):
+            run()
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export an fconv checkpoint for inference')
+    parser.add_argument('data', metavar='DIR', help='path to data directory (for the dictionaries)')
+    parser.add_argument('--path', metavar='FILE', required=True, help='path to model file')
+    parser.add_argument('-s', '--source-lang', default=None, metavar='SRC', help='source language')
+    parser.add_argument('-t', '--target-lang', default=None, metavar='TARGET', help='target language')
+    parser.add_argument('--output-dir', default='.', metavar='DIR', help='where to write the modules')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare the latency of eager, TorchScript and torch.compile')
+    parser.add_argument('--batch-size', default=5, type=int, metavar='N',
+                        help='sentences (or beams) per batch')
+    parser.add_argument('--source-length', default=400, type=int, metavar='N', help='source tokens')
+    parser.add_argument('--steps', default=60, type=int, metavar='N', help='decoder steps')
+    parser.add_argument('--repeat', default=10, type=int, metavar='N', help='timed runs')
+    parser.add_argument('--cpu-threads', type=int, metavar='N',
+                        help='number of threads used by CPU ops (default: PyTorch default)')
+    parser.add_argument('--atol', default=1e-3, type=float, metavar='TOL',
+                        help='largest difference of the TorchScript log-probabilities from the '
+                             'eager model accepted')
+    parser.add_argument('--onnx', action='store_true',
+                        help='also export ONNX graphs and check them with onnxruntime')
+    parser.add_argument('--opset', default=13, type=int, metavar='N', help='ONNX opset version')
+    parser.add_argument('--onnx-atol', default=1e-4, type=float, metavar='TOL',
+                        help='largest difference from PyTorch accepted by the ONNX check')
+    main(parser.parse_args())
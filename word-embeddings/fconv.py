@@ -8,17 +8,21 @@
 # Modified by Shashi Narayan (2018)
 
 # Xin: code for NGTU and word2vec/glove with no padding
+import functools
 import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.nn.utils.weight_norm import WeightNorm
+from torch.utils.checkpoint import checkpoint
 
 
 from fairseq import utils
 from fairseq.data import LanguagePairDataset
 from fairseq.modules import BeamableMM, GradMultiply, LearnedPositionalEmbedding, LinearizedConvolution
-from fairseq.vectordict import vector_dict
+from fairseq.modules import ConvTBC as ConvTBCBase
+from fairseq.vectordict import get_embedding_provider
 
 from . import FairseqEncoder, FairseqIncrementalDecoder, FairseqModel, register_model, register_model_architecture
 
@@ -50,44 +54,173 @@ class FConvModel(FairseqModel):
                             help='share input and output embeddings (requires'
                                  ' --decoder-out-embed-dim and --decoder-embed-dim'
                                  ' to be equal)')
+        parser.add_argument('--encoder-embed-grad', choices=['dense', 'sparse', 'delta'],
+                            help='gradient of the encoder token embedding: dense, sparse'
+                                 ' (only rows seen in the batch are reduced and updated)'
+                                 ' or delta (pre-trained rows are frozen and a sparse,'
+                                 ' zero-initialized offset is trained)')
+        parser.add_argument('--checkpoint-activations', type=int, metavar='N',
+                            help='when training, keep only the input of every N encoder and'
+                                 ' decoder layers and recompute their activations in the'
+                                 ' backward pass (0 disables)')
 
     @classmethod
     def build_model(cls, args, src_dict, dst_dict):
         """Build a new model instance."""
+        embed_provider = get_embedding_provider(args)
+        # train.py sets the topic width from the lemma-topic table; models trained
+        # before it was configurable zero-padded topics to 512
+        topic_dim = getattr(args, 'topic_dim', 512)
+        checkpoint_activations = getattr(args, 'checkpoint_activations', 0)
         encoder = FConvEncoder(
             src_dict,
+            embed_provider=embed_provider,
             embed_dim=args.encoder_embed_dim,
             convolutions=eval(args.encoder_layers),
             dropout=args.dropout,
             max_positions=args.max_source_positions,
+            embed_grad=getattr(args, 'encoder_embed_grad', 'dense'),
+            topic_dim=topic_dim,
+            checkpoint_activations=checkpoint_activations,
         )
         decoder = FConvDecoder(
             dst_dict,
-            embed_dim=args.decoder_embed_dim,
+            embed_dim=embed_provider.embedding_dim,
             convolutions=eval(args.decoder_layers),
             out_embed_dim=args.decoder_out_embed_dim,
             attention=eval(args.decoder_attention),
             dropout=args.dropout,
             max_positions=args.max_target_positions,
-            share_embed=args.share_input_output_embed
+            share_embed=args.share_input_output_embed,
+            topic_dim=topic_dim,
+            checkpoint_activations=checkpoint_activations,
         )
         return FConvModel(encoder, decoder)
 
+    def make_generation_fast_(self, **kwargs):
+        """Optimize model for faster generation. The base class already
+        removes weight normalization from every module; the cached weights of
+        the linearized convolutions, derived from the normalized ones, are
+        dropped as well."""
+        super().make_generation_fast_(**kwargs)
+        fold_weight_norm_(self)
+
+
+class NGTU(torch.autograd.Function):
+    """Non-linear gated tanh unit tanh(a) * sigmoid(b), where x = [a, b] is
+    split in half along the last dimension.
+
+    Equivalent to F.glu(torch.cat([torch.tanh(a), b], -1)) but only x is kept
+    for backward, where tanh and sigmoid are recomputed, so none of the
+    intermediates of the unfused version are allocated.
+    """
+
+    @staticmethod
+    def forward(ctx, x):
+        a, b = x.chunk(2, dim=-1)
+        ctx.save_for_backward(x)
+        return torch.tanh(a).mul_(torch.sigmoid(b))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, = ctx.saved_tensors
+        return ngtu_backward(x, grad_output)
+
+
+class NGTULayerNorm(torch.autograd.Function):
+    """layer_norm(tanh(a) * sigmoid(b) + residual) in one pass, computed in
+    float32 (or wider); the output has the dtype of x.
+
+    Only x, the normalized sum and the inverse standard deviation are kept
+    for backward; the gate and the sum before normalization are never stored.
+    """
+
+    @staticmethod
+    def forward(ctx, x, residual, weight, bias, eps):
+        dtype = torch.promote_types(x.dtype, torch.float32)
+        a, b = x.to(dtype).chunk(2, dim=-1)
+        h = torch.tanh(a).mul_(torch.sigmoid(b)).add_(residual.to(dtype))
+        h.sub_(h.mean(dim=-1, keepdim=True))
+        rstd = h.pow(2).mean(dim=-1, keepdim=True).add_(eps).rsqrt_()
+        x_hat = h.mul_(rstd)
+        ctx.residual_dtype = residual.dtype
+        ctx.save_for_backward(x, x_hat, rstd, weight)
+        return torch.addcmul(bias.to(dtype), x_hat, weight.to(dtype)).to(x.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, x_hat, rstd, weight = ctx.saved_tensors
+        grad_output = grad_output.to(x_hat.dtype)
+        channels = x_hat.size(-1)
+        grad_weight = (grad_output * x_hat).reshape(-1, channels).sum(dim=0).to(weight.dtype)
+        grad_bias = grad_output.reshape(-1, channels).sum(dim=0).to(weight.dtype)
+        grad_x_hat = grad_output * weight.to(x_hat.dtype)
+        grad_h = grad_x_hat - grad_x_hat.mean(dim=-1, keepdim=True)
+        grad_h.sub_(x_hat * (grad_x_hat * x_hat).mean(dim=-1, keepdim=True)).mul_(rstd)
+        grad_x = ngtu_backward(x.to(x_hat.dtype), grad_h).to(x.dtype)
+        return grad_x, grad_h.to(ctx.residual_dtype), grad_weight, grad_bias, None
+
+
+def ngtu_backward(x, grad_output):
+    """Gradient of tanh(a) * sigmoid(b) with respect to x = [a, b]."""
+    a, b = x.chunk(2, dim=-1)
+    t = torch.tanh(a)
+    s = torch.sigmoid(b)
+    gs = grad_output * s
+    grad_b = (gs * t).mul_(1 - s)
+    grad_a = gs.mul_(t.mul_(t).neg_().add_(1))
+    return torch.cat([grad_a, grad_b], dim=-1)
+
+
+def ngtu_layer_norm(x, residual, layer_norm):
+    """layer_norm(NGTU(x) + residual) with the parameters of *layer_norm*."""
+    return NGTULayerNorm.apply(x, residual, layer_norm.weight, layer_norm.bias, layer_norm.eps)
+
+
+class Fp32LayerNorm(nn.LayerNorm):
+    """LayerNorm computed in float32 under mixed precision; the output has the
+    dtype of the input. Parameters and state dict are those of nn.LayerNorm."""
+
+    def forward(self, input):
+        return F.layer_norm(
+            input.float(), self.normalized_shape, self.weight, self.bias, self.eps,
+        ).type_as(input)
+
 
 class FConvEncoder(FairseqEncoder):
     """Convolutional encoder"""
-    def __init__(self, dictionary, embed_dim=512, max_positions=1024,
-                 convolutions=((512, 3),) * 20, dropout=0.1):
+    def __init__(self, dictionary, embed_provider=None, embed_dim=512, max_positions=1024,
+                 convolutions=((512, 3),) * 20, dropout=0.1, embed_grad='dense', topic_dim=512,
+                 checkpoint_activations=0):
         super().__init__(dictionary)
-        embed_dim = vector_dict.embedding_dim
-        convolutions=((vector_dict.embedding_dim, 3),) * 20
+        if embed_provider is not None:
+            embed_dim = embed_provider.embedding_dim
+        convolutions=((embed_dim, 3),) * 20
         self.dropout = dropout
         self.num_attention_layers = None
         self.embed_dim = embed_dim
+        self.checkpoint_activations = checkpoint_activations
+        self.topic_dim = topic_dim
         num_embeddings = len(dictionary)
         padding_idx = dictionary.pad()
-        self.embed_tokens = nn.Embedding.from_pretrained(torch.FloatTensor(vector_dict.embedding[:,:vector_dict.embedding_dim]), freeze=False)  # load pre-trained vector
-        #self.embed_tokens = Embedding(num_embeddings, embed_dim, padding_idx)
+        embedding = embed_provider.load() if embed_provider is not None else None
+        self.embed_delta = None
+        if embedding is not None:
+            # load pre-trained vector
+            self.embed_tokens = nn.Embedding.from_pretrained(
+                torch.FloatTensor(embedding),
+                freeze=(embed_grad == 'delta'),
+                sparse=(embed_grad == 'sparse'),
+            )
+            if embed_grad == 'delta':
+                self.embed_delta = nn.Embedding(len(embedding), embed_dim, sparse=True)
+                self.embed_delta.weight.data.zero_()
+        else:
+            if embed_grad == 'delta':
+                raise ValueError('--encoder-embed-grad delta needs pre-trained embeddings, '
+                                 'use dense or sparse with the random provider')
+            self.embed_tokens = Embedding(num_embeddings, embed_dim, padding_idx)
+            self.embed_tokens.sparse = embed_grad == 'sparse'
         #self.embed_tokens.weight.data.copy_(torch.from_numpy(vector_dict.embedding))
         #self.embed_tokens.weight.requires_grad = True
         self.embed_positions = PositionalEmbedding(
@@ -99,7 +232,7 @@ class FConvEncoder(FairseqEncoder):
 
         in_channels = convolutions[0][0]
         # Shashi
-        self.fc1 = Linear(embed_dim+512, in_channels, dropout=dropout)
+        self.fc1 = Linear(embed_dim+topic_dim, in_channels, dropout=dropout)
         self.projections = nn.ModuleList()
         self.convolutions = nn.ModuleList()
         for (out_channels, kernel_size) in convolutions:
@@ -110,19 +243,19 @@ class FConvEncoder(FairseqEncoder):
                         dropout=dropout)
             )
             in_channels = out_channels
-        self.fc2 = Linear(in_channels, embed_dim+512)
-        self.lay_norm = nn.LayerNorm(embed_dim)  # layer nomalization in NGTU
+        self.fc2 = Linear(in_channels, embed_dim+topic_dim)
+        self.lay_norm = Fp32LayerNorm(embed_dim)  # layer nomalization in NGTU
 
     def forward(self, src_tokens, src_lengths, src_doctopic, src_wordtopics):
         # embed tokens and positions
         # print(self.embed_tokens(src_tokens), self.embed_positions(src_tokens), src_doctopic, src_wordtopics)
 
         # ''' 1)
-        # src_doctopic: batchsize x 512
-        # src_wordtopics: batchsize x wordcount x 512
-        src_doctopic_ext = src_doctopic.unsqueeze(1) # batchsize x 1 x 512
+        # src_doctopic: batchsize x topic_dim
+        # src_wordtopics: batchsize x wordcount x topic_dim
+        src_doctopic_ext = src_doctopic.unsqueeze(1) # batchsize x 1 x topic_dim
         # print(src_doctopic_ext)
-        src_wordtopics_doctopic = src_wordtopics * src_doctopic_ext # batchsize x wordcount x 512
+        src_wordtopics_doctopic = src_wordtopics * src_doctopic_ext # batchsize x wordcount x topic_dim
         # print(src_wordtopics_doctopic)
         # ''' 
 
@@ -139,25 +272,52 @@ class FConvEncoder(FairseqEncoder):
         
         
         x = self.embed_tokens(src_tokens) + self.embed_positions(src_tokens) # batchsize x wordcount x 512
+        if self.embed_delta is not None:
+            x = x + self.embed_delta(src_tokens)
         #word_embedding = torch.FloatTensor(vector_dict.get_embedding(src_tokens.cpu().numpy(), self.embed_dim)).to('cuda')
         #x = word_embedding + self.embed_positions(src_tokens) # batchsize x wordcount x 512
         # print(x)
 
-        # Concat wordtopics*doctopic to (wordembedding+posembedding)
-        x = torch.cat((x, src_wordtopics_doctopic), 2)
-        # print(x)
-        
+        # wordtopics*doctopic is combined with (wordembedding+posembedding) without
+        # materialising their concatenation; dropout is elementwise, so it can be
+        # applied to the two parts separately
         x = F.dropout(x, p=self.dropout, training=self.training)
-        input_embedding = x
+        topics = F.dropout(src_wordtopics_doctopic, p=self.dropout, training=self.training)
+        input_embedding = (x, topics)
 
-        # project to size of convolution
-        x = self.fc1(x)
+        # project to size of convolution: fc1([x, topics]) as the sum of the
+        # projections by its word and topic weight blocks
+        x = split_linear(self.fc1, input_embedding)
 
         # B x T x C -> T x B x C
         x = x.transpose(0, 1)
 
         # temporal convolutions
-        for proj, conv in zip(self.projections, self.convolutions):
+        x = run_layers(self._conv_layers, len(self.convolutions), self.checkpoint_activations,
+                       self.training, x)[0]
+
+        # T x B x C -> B x T x C
+        x = x.transpose(1, 0)
+
+        # project back to size of embedding
+        x = self.fc2(x)
+
+        # scale gradients (this only affects backward, not forward)
+        x = GradMultiply.apply(x, 1.0 / (2.0 * self.num_attention_layers))
+
+        # add output to input embedding for attention; the attention values
+        # are kept as their word and topic parts (B x S x embed_dim and
+        # B x S x topic_dim), see AttentionLayer
+        y = (
+            (x[:, :, :self.embed_dim] + input_embedding[0]) * math.sqrt(0.5),
+            (x[:, :, self.embed_dim:] + input_embedding[1]) * math.sqrt(0.5),
+        )
+
+        # print(x,y)
+        return x, y
+
+    def _conv_layers(self, start, end, x):
+        for proj, conv in zip(self.projections[start:end], self.convolutions[start:end]):
             residual = x if proj is None else proj(x)
             x = F.dropout(x, p=self.dropout, training=self.training)
             padding_l = (conv.kernel_size[0] - 1) // 2
@@ -167,11 +327,7 @@ class FConvEncoder(FairseqEncoder):
 
 
             # NGTU BEGIN
-            part_1, part_2 = x[:,:,:self.embed_dim],x[:,:,self.embed_dim:] 
-            part_1 = torch.tanh(part_1)
-            x = torch.cat([part_1,part_2],dim=2)
-            x = F.glu(x, dim=2)
-            x = self.lay_norm(x + residual)
+            x = ngtu_layer_norm(x, residual, self.lay_norm)
             # NGTU END
 
             '''
@@ -180,23 +336,7 @@ class FConvEncoder(FairseqEncoder):
             x = (x + residual) * math.sqrt(0.5)
             # GLU END
             '''
-
-
-
-        # T x B x C -> B x T x C
-        x = x.transpose(1, 0)
-
-        # project back to size of embedding
-        x = self.fc2(x)
-
-        # scale gradients (this only affects backward, not forward)
-        x = GradMultiply.apply(x, 1.0 / (2.0 * self.num_attention_layers))
-
-        # add output to input embedding for attention
-        y = (x + input_embedding) * math.sqrt(0.5)
-
-        # print(x,y)
-        return x, y
+        return x,
 
     def max_positions(self):
         """Maximum input length supported by the encoder."""
@@ -205,33 +345,40 @@ class FConvEncoder(FairseqEncoder):
 # original attension
 
 class AttentionLayer(nn.Module):
-    def __init__(self, conv_channels, embed_dim, bmm=None):
+    def __init__(self, conv_channels, embed_dim, bmm=None, topic_dim=512):
         super().__init__()
-        embed_dim = vector_dict.embedding_dim
+        self.embed_dim = embed_dim
         # projects from output of convolution to embedding dimension
-        self.in_projection = Linear(conv_channels, embed_dim+512)
+        self.in_projection = Linear(conv_channels, embed_dim+topic_dim)
         # projects from embedding dimension to convolution size
-        self.out_projection = Linear(embed_dim+512, conv_channels)
+        self.out_projection = Linear(embed_dim+topic_dim, conv_channels)
 
         self.bmm = bmm if bmm is not None else torch.bmm
 
     def forward(self, x, target_embedding, encoder_out):
         residual = x
 
-        # attention
-        x = (self.in_projection(x) + target_embedding) * math.sqrt(0.5) # d_i
+        # attention; target_embedding is (token embedding, doc-topic embedding),
+        # the latter possibly of length 1 and broadcast over time
+        x = self.in_projection(x)
+        x = torch.cat((
+            x[:, :, :self.embed_dim] + target_embedding[0],
+            x[:, :, self.embed_dim:] + target_embedding[1],
+        ), 2) * math.sqrt(0.5) # d_i
         x = self.bmm(x, encoder_out[0]) # d_i*z_i
 
-        # softmax over last dim
+        # softmax over last dim, in float32 under mixed precision
         sz = x.size()
-        x = F.softmax(x.view(sz[0] * sz[1], sz[2]), dim=1)
+        x = F.softmax(x.view(sz[0] * sz[1], sz[2]).float(), dim=1).type_as(x)
         x = x.view(sz)
         attn_scores = x # a_i_j
 
-        x = self.bmm(x, encoder_out[1]) # get c_i
+        # get c_i from the word and topic parts of the values; only the
+        # B x T contexts are concatenated
+        x = torch.cat([self.bmm(x, values) for values in encoder_out[1]], 2)
 
         # scale attention output
-        s = encoder_out[1].size(1)
+        s = encoder_out[1][0].size(1)
         x = x * (s * math.sqrt(1.0 / s))
 
         # project back
@@ -357,12 +504,12 @@ class AttentionLayer(nn.Module):
 
         self.bmm = bmm if bmm is not None else torch.bmm
         
-    def sample_gumbel(self, shape, eps=1e-20):
-        U = torch.rand(shape).cuda()
+    def sample_gumbel(self, shape, eps=1e-20, device=None):
+        U = torch.rand(shape, device=device)
         return -Variable(torch.log(-torch.log(U + eps) + eps))
 
     def gumbel_softmax_sample(self, logits, temperature):
-        y = logits + self.sample_gumbel(logits.size())
+        y = logits + self.sample_gumbel(logits.size(), device=logits.device)
         return F.softmax(y / temperature, dim=-1)
 
     def gumbel_softmax(self, logits, temperature):
@@ -427,13 +574,13 @@ class AttentionLayer(nn.Module):
         # projects from embedding dimension to convolution size
         self.out_projection = Linear(self.num_head*(embed_dim+embed_dim), conv_channels)
         self.bmm = bmm if bmm is not None else torch.bmm
-        self.multi_head_key = []
-        self.multi_head_value = []
-        self.multi_head_query = []
+        self.multi_head_key = nn.ModuleList()
+        self.multi_head_value = nn.ModuleList()
+        self.multi_head_query = nn.ModuleList()
         for i in range(self.num_head):
-            self.multi_head_key.append(Linear(embed_dim+embed_dim, embed_dim+embed_dim).to('cuda'))
-            self.multi_head_value.append(Linear(embed_dim+embed_dim, embed_dim+embed_dim).to('cuda'))
-            self.multi_head_query.append(Linear(embed_dim+embed_dim, embed_dim+embed_dim).to('cuda'))
+            self.multi_head_key.append(Linear(embed_dim+embed_dim, embed_dim+embed_dim))
+            self.multi_head_value.append(Linear(embed_dim+embed_dim, embed_dim+embed_dim))
+            self.multi_head_query.append(Linear(embed_dim+embed_dim, embed_dim+embed_dim))
         #self.multi_head_fusion = Linear(self.num_head*(embed_dim+embed_dim), embed_dim+embed_dim)
     def forward(self, x, target_embedding, encoder_out):
         residual = x
@@ -538,13 +685,16 @@ class FConvDecoder(FairseqIncrementalDecoder):
     """Convolutional decoder"""
     def __init__(self, dictionary, embed_dim=512, out_embed_dim=256,
                  max_positions=1024, convolutions=((512, 3),) * 20,
-                 attention=True, dropout=0.1, share_embed=False):
+                 attention=True, dropout=0.1, share_embed=False, topic_dim=512,
+                 checkpoint_activations=0):
         super().__init__(dictionary)
-        embed_dim = vector_dict.embedding_dim
         self.embed_dim = embed_dim
-        convolutions=((vector_dict.embedding_dim, 3),) * 20
+        self.checkpoint_activations = checkpoint_activations
+        self.topic_dim = topic_dim
+        convolutions=((embed_dim, 3),) * 20
         self.register_buffer('version', torch.Tensor([2]))
         self.dropout = dropout
+        self.need_attn = True
 
         in_channels = convolutions[0][0]
         if isinstance(attention, bool):
@@ -564,11 +714,11 @@ class FConvDecoder(FairseqIncrementalDecoder):
             left_pad=LanguagePairDataset.LEFT_PAD_TARGET,
         )
         
-        self.fc1 = Linear(embed_dim+512, in_channels, dropout=dropout)
+        self.fc1 = Linear(embed_dim+topic_dim, in_channels, dropout=dropout)
         self.projections = nn.ModuleList()
         self.convolutions = nn.ModuleList()
         self.attention = nn.ModuleList()
-        self.lay_norm = nn.LayerNorm(embed_dim)
+        self.lay_norm = Fp32LayerNorm(embed_dim)
         for i, (out_channels, kernel_size) in enumerate(convolutions):
             self.projections.append(Linear(in_channels, out_channels)
                                     if in_channels != out_channels else None)
@@ -576,7 +726,7 @@ class FConvDecoder(FairseqIncrementalDecoder):
                 LinearizedConv1d(in_channels, out_channels * 2, kernel_size,
                                  padding=(kernel_size - 1), dropout=dropout)
             )
-            self.attention.append(AttentionLayer(out_channels, embed_dim)
+            self.attention.append(AttentionLayer(out_channels, embed_dim, topic_dim=topic_dim)
                                   if attention[i] else None)
             in_channels = out_channels
         self.fc2 = Linear(in_channels, out_embed_dim)
@@ -599,37 +749,85 @@ class FConvDecoder(FairseqIncrementalDecoder):
         x += self.embed_positions(prev_output_tokens, incremental_state)
         # print(x.size())
 
-        # Add doctopic vector in the decoder
-        # src_doctopic: batchsize x 512
-        src_doctopic_ext = src_doctopic.unsqueeze(1) # batchsize x 1 x 512
-        # print(src_doctopic_ext.size())
-        src_doctopic_ext = src_doctopic_ext.repeat(1, x.size()[1], 1)
-        # print(src_doctopic_ext.size())
-
-        # Concat doctopic to (wordembedding+posembedding)
-        x = torch.cat((x, src_doctopic_ext), 2)
-        # print(x.size())
-        
         x = F.dropout(x, p=self.dropout, training=self.training)
-        target_embedding = x
-        # print("Before FC1 ", x.size())
+
+        # Add doctopic vector in the decoder, conceptually concatenated to
+        # (wordembedding+posembedding); its part of target_embedding and of the
+        # fc1 projection is computed once per sequence
+        src_doctopic_ext, doctopic_proj = self._embed_doctopic(src_doctopic, x.size(1), incremental_state)
+        target_embedding = (x, src_doctopic_ext)
 
         # project to size of convolution
-        x = self.fc1(x)
-        # print("FC1 ", x.size())
+        x = F.linear(x, weight_of(self.fc1)[:, :self.embed_dim], self.fc1.bias) + doctopic_proj
         
-        # B x T x C -> T x B x C
-        x = self._transpose_if_training(x, incremental_state)
-        
-        # temporal convolutions
+        # temporal convolutions; activations stay B x T x C throughout, both
+        # when training and when decoding incrementally
+        conv_layers = functools.partial(self._conv_layers, incremental_state=incremental_state)
+        out = run_layers(conv_layers, len(self.convolutions), self.checkpoint_activations,
+                         self.training and incremental_state is None,
+                         x, target_embedding[0], target_embedding[1], encoder_a, *encoder_b)
+        x = out[0]
+        avg_attn_scores = None
+        for attn_scores in out[1:]:
+            avg_attn_scores = attn_scores if avg_attn_scores is None else avg_attn_scores + attn_scores
+
+        # project back to size of vocabulary
+        x = self.fc2(x)
+        x = F.dropout(x, p=self.dropout, training=self.training)
+        x = self.fc3(x)
+
+        return x, avg_attn_scores
+
+    def make_generation_fast_(self, need_attn=True, **kwargs):
+        """Without *need_attn*, the attention scores are neither averaged nor
+        returned (the decoder returns None for them); they are only needed
+        for alignments. They are never averaged in training."""
+        self.need_attn = need_attn
+
+    def get_normalized_probs(self, net_output, log_probs):
+        """Get normalized probabilities (or log probs) from a net's output,
+        in float32 even if the logits were computed in lower precision."""
+        logits = net_output[0].float()
+        if log_probs:
+            return F.log_softmax(logits, dim=-1)
+        else:
+            return F.softmax(logits, dim=-1)
+
+    def max_positions(self):
+        """Maximum output length supported by the decoder."""
+        return self.embed_positions.max_positions()
+
+    def upgrade_state_dict(self, state_dict):
+        if state_dict.get('decoder.version', torch.Tensor([1]))[0] < 2:
+            # old models use incorrect weight norm dimension
+            for i, conv in enumerate(self.convolutions):
+                # reconfigure weight norm
+                nn.utils.remove_weight_norm(conv)
+                self.convolutions[i] = nn.utils.weight_norm(conv, dim=0)
+            state_dict['decoder.version'] = torch.Tensor([1])
+        return state_dict
+
+    def _embed_tokens(self, tokens, incremental_state):
+        if incremental_state is not None:
+            # keep only the last token for incremental forward pass
+            tokens = tokens[:, -1:]
+        return self.embed_tokens(tokens)
+
+    def _conv_layers(self, start, end, x, target_token, target_doctopic, encoder_a,
+                     encoder_b_word, encoder_b_topic, incremental_state=None):
+        """Layers start..end-1; returns x and, if the segment has attention
+        and the scores are needed, its share of the averaged attention scores."""
+        target_embedding = (target_token, target_doctopic)
+        encoder_b = (encoder_b_word, encoder_b_topic)
         avg_attn_scores = None
         num_attn_layers = len(self.attention)
-        for proj, conv, attention in zip(self.projections, self.convolutions, self.attention):
+        layers = zip(self.projections[start:end], self.convolutions[start:end], self.attention[start:end])
+        for proj, conv, attention in layers:
             residual = x if proj is None else proj(x)
 
             x = F.dropout(x, p=self.dropout, training=self.training)
             
-            x = conv(x, incremental_state)
+            x = self._conv(conv, x, incremental_state)
 
             '''
             # original GLU BEGIN
@@ -639,27 +837,23 @@ class FConvDecoder(FairseqIncrementalDecoder):
 
 
             # NGTU BEGIN
-            part_1, part_2 = x[:,:,:self.embed_dim],x[:,:,self.embed_dim:] 
-            part_1 = torch.tanh(part_1)
-            x = torch.cat([part_1,part_2],dim=2)
-            x = F.glu(x, dim=2)
+            if attention is None:
+                # without attention, the gate, residual and layer norm are fused
+                x = ngtu_layer_norm(x, residual, self.lay_norm)
+                continue
+            x = NGTU.apply(x)
             # NGTU END
 
 
             # attention
-            if attention is not None:
-                x = self._transpose_if_training(x, incremental_state)
-                # print(x.size())
-                
-                x, attn_scores = attention(x, target_embedding, (encoder_a, encoder_b))
+            x, attn_scores = attention(x, target_embedding, (encoder_a, encoder_b))
+            if self.need_attn and not self.training:
                 attn_scores = attn_scores / num_attn_layers
                 if avg_attn_scores is None:
                     avg_attn_scores = attn_scores
                 else:
                     avg_attn_scores.add_(attn_scores)
 
-                x = self._transpose_if_training(x, incremental_state)
-
             '''
             # original GLU BEGIN
             # residual
@@ -671,37 +865,33 @@ class FConvDecoder(FairseqIncrementalDecoder):
             # NGTU BEGIN
             x = self.lay_norm(x + residual)
             # NGTU END
-
-        # T x B x C -> B x T x C
-        x = self._transpose_if_training(x, incremental_state)
-        # print(x.size())
-        
-        # project back to size of vocabulary
-        x = self.fc2(x)
-        x = F.dropout(x, p=self.dropout, training=self.training)
-        x = self.fc3(x)
-
+        if avg_attn_scores is None:
+            return x,
         return x, avg_attn_scores
 
-    def max_positions(self):
-        """Maximum output length supported by the decoder."""
-        return self.embed_positions.max_positions()
+    def _embed_doctopic(self, src_doctopic, seq_len, incremental_state):
+        """Doc-topic part of target_embedding and its projection by fc1.
 
-    def upgrade_state_dict(self, state_dict):
-        if state_dict.get('decoder.version', torch.Tensor([1]))[0] < 2:
-            # old models use incorrect weight norm dimension
-            for i, conv in enumerate(self.convolutions):
-                # reconfigure weight norm
-                nn.utils.remove_weight_norm(conv)
-                self.convolutions[i] = nn.utils.weight_norm(conv, dim=0)
-            state_dict['decoder.version'] = torch.Tensor([1])
-        return state_dict
+        Unless dropout is active both are the same for every target position,
+        so they are computed once (B x 1 x C) and broadcast over time. This is
+        cached when doing incremental inference.
+        """
+        cached_result = utils.get_incremental_state(self, incremental_state, 'doctopic')
+        if cached_result is not None:
+            return cached_result
+
+        # src_doctopic: batchsize x topic_dim
+        src_doctopic_ext = src_doctopic.unsqueeze(1) # batchsize x 1 x topic_dim
+        if self.training and self.dropout > 0:
+            # keep an independent dropout mask per position
+            src_doctopic_ext = src_doctopic_ext.expand(-1, seq_len, -1)
+            src_doctopic_ext = F.dropout(src_doctopic_ext, p=self.dropout, training=True)
+        doctopic_proj = F.linear(src_doctopic_ext, weight_of(self.fc1)[:, self.embed_dim:])
+        result = (src_doctopic_ext, doctopic_proj)
 
-    def _embed_tokens(self, tokens, incremental_state):
         if incremental_state is not None:
-            # keep only the last token for incremental forward pass
-            tokens = tokens[:, -1:]
-        return self.embed_tokens(tokens)
+            utils.set_incremental_state(self, incremental_state, 'doctopic', result)
+        return result
 
     def _split_encoder_out(self, encoder_out, incremental_state):
         """Split and transpose encoder outputs.
@@ -712,19 +902,28 @@ class FConvDecoder(FairseqIncrementalDecoder):
         if cached_result is not None:
             return cached_result
 
-        # transpose only once to speed up attention layers
+        # transpose only once to speed up attention layers; bmm takes the
+        # transposed view directly, so no copy is made
         encoder_a, encoder_b = encoder_out
-        encoder_a = encoder_a.transpose(1, 2).contiguous()
+        encoder_a = encoder_a.transpose(1, 2)
         result = (encoder_a, encoder_b)
 
         if incremental_state is not None:
             utils.set_incremental_state(self, incremental_state, 'encoder_out', result)
         return result
 
-    def _transpose_if_training(self, x, incremental_state):
-        if incremental_state is None:
-            x = x.transpose(0, 1)
-        return x
+    def _conv(self, conv, x, incremental_state):
+        if incremental_state is not None:
+            # LinearizedConvolution already works on B x T x C incrementally
+            return conv(x, incremental_state)
+        # full sequences run as ConvTBC on T x B x C, which is faster and
+        # smaller than a batch-first product over the kernel taps
+        seq_len = x.size(1)
+        x = conv(x.transpose(0, 1))
+        if isinstance(conv, QuantizedConvTBC):
+            # remove future timesteps added by the padding
+            x = x[:seq_len]
+        return x.transpose(0, 1)
 
 
 def Embedding(num_embeddings, embedding_dim, padding_idx):
@@ -747,6 +946,141 @@ def Linear(in_features, out_features, dropout=0):
     return nn.utils.weight_norm(m)
 
 
+def fold_weight_norm_(model):
+    """Remove weight normalization from all modules of *model*, keeping the
+    weights it currently computes, and drop the cached weights of the
+    linearized convolutions, which were derived from the normalized ones.
+    Returns the number of modules folded."""
+    num_folded = 0
+    for module in model.modules():
+        if any(isinstance(hook, WeightNorm) for hook in module._forward_pre_hooks.values()):
+            nn.utils.remove_weight_norm(module)
+            num_folded += 1
+        if isinstance(module, LinearizedConvolution):
+            module._linearized_weight = None
+    return num_folded
+
+
+def quantize_int8_(model):
+    """Dynamic int8 quantization of *model* for CPU inference: the weights of
+    the nn.Linear layers and of the convolutions are stored in int8 and the
+    activations are quantized on the fly. Weight norm is folded first.
+
+    fc1 is applied by column blocks (see split_linear) and stays in float32;
+    it runs once per token, next to fc3 over the whole vocabulary.
+    """
+    fold_weight_norm_(model)
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, ConvTBCBase):
+                setattr(module, name, QuantizedConvTBC(child))
+    linears = set(
+        name for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and name.split('.')[-1] != 'fc1'
+    )
+    return torch.quantization.quantize_dynamic(model, linears, dtype=torch.qint8, inplace=True)
+
+
+class QuantizedConvTBC(nn.Module):
+    """Int8 stand-in for a (weight-norm folded) ConvTBC or LinearizedConvolution.
+
+    The weight is linearized to out_channels x (kernel_size * in_channels), as
+    in LinearizedConvolution, and kept in an nn.Linear that quantize_int8_()
+    converts. Full sequences (T x B x C) are unfolded into kernel_size windows;
+    incremental decoding (B x T x C) keeps the input buffer in
+    incremental_state like LinearizedConvolution.
+    """
+
+    def __init__(self, conv):
+        super().__init__()
+        self.in_channels = conv.in_channels
+        self.out_channels = conv.out_channels
+        self.kernel_size = conv.kernel_size
+        self.padding = conv.padding
+        kw = conv.kernel_size[0]
+        self.linear = nn.Linear(kw * conv.in_channels, conv.out_channels)
+        # kernel_size x in_channels x out_channels -> out_channels x (kernel_size * in_channels)
+        self.linear.weight.data.copy_(conv.weight.data.permute(2, 0, 1).contiguous().view(conv.out_channels, -1))
+        self.linear.bias.data.copy_(conv.bias.data)
+
+    def forward(self, input, incremental_state=None):
+        kw = self.kernel_size[0]
+        if incremental_state is not None:
+            bsz = input.size(0)
+            if kw > 1:
+                input_buffer = self._get_input_buffer(incremental_state)
+                if input_buffer is None:
+                    input_buffer = input.new_zeros(bsz, kw, input.size(2))
+                else:
+                    input_buffer = torch.cat([input_buffer[:, 1:], input_buffer[:, :1]], dim=1)
+                input_buffer[:, -1] = input[:, -1]
+                self._set_input_buffer(incremental_state, input_buffer)
+                input = input_buffer
+            return self.linear(input.contiguous().view(bsz, -1)).view(bsz, 1, -1)
+        padding = self.padding[0] if isinstance(self.padding, tuple) else self.padding
+        if padding > 0:
+            input = F.pad(input, (0, 0, 0, 0, padding, padding))
+        # T x B x C -> T' x B x C x kw -> T' x B x (kw * C)
+        windows = input.unfold(0, kw, 1).transpose(2, 3).contiguous()
+        return self.linear(windows.view(windows.size(0), windows.size(1), -1))
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        input_buffer = self._get_input_buffer(incremental_state)
+        if input_buffer is not None:
+            self._set_input_buffer(incremental_state, input_buffer.index_select(0, new_order))
+
+    def _get_input_buffer(self, incremental_state):
+        return utils.get_incremental_state(self, incremental_state, 'input_buffer')
+
+    def _set_input_buffer(self, incremental_state, new_buffer):
+        return utils.set_incremental_state(self, incremental_state, 'input_buffer', new_buffer)
+
+
+def weight_of(module):
+    """Current weight of *module*. With weight norm, module.weight is only
+    refreshed by the forward pre-hook, so it is recomputed from g and v."""
+    for hook in module._forward_pre_hooks.values():
+        if isinstance(hook, WeightNorm):
+            return hook.compute_weight(module)
+    return module.weight
+
+
+def run_layers(layers, num_layers, every, training, *inputs):
+    """Run layers(0, num_layers, *inputs), which returns a tuple whose first
+    element is the new x.
+
+    With *every* > 0 and *training*, the layers are run in segments of *every*
+    layers under torch.utils.checkpoint: only the segment inputs are kept and
+    each segment is recomputed (with the same dropout masks) in the backward
+    pass. Any further outputs of the segments are concatenated. The
+    non-reentrant checkpoint is used, which also computes the gradients of
+    parameters reached from segment inputs that do not require gradients.
+    """
+    if every <= 0 or not training:
+        return layers(0, num_layers, *inputs)
+    x, rest = inputs[0], inputs[1:]
+    extra = ()
+    for start in range(0, num_layers, every):
+        end = min(start + every, num_layers)
+        out = checkpoint(functools.partial(layers, start, end), x, *rest, use_reentrant=False)
+        x, extra = out[0], extra + tuple(out[1:])
+    return (x,) + extra
+
+
+def split_linear(linear, inputs):
+    """Apply *linear* to the concatenation of *inputs* along the last
+    dimension, without materialising it: the weight is split into column
+    blocks and the partial projections are summed."""
+    weight = weight_of(linear)
+    x, offset = None, 0
+    for i, inp in enumerate(inputs):
+        width = inp.size(-1)
+        y = F.linear(inp, weight[:, offset:offset + width], linear.bias if i == 0 else None)
+        x = y if x is None else x + y
+        offset += width
+    return x
+
+
 def LinearizedConv1d(in_channels, out_channels, kernel_size, dropout=0, **kwargs):
     """Weight-normalized Conv1d layer optimized for decoding"""
     m = LinearizedConvolution(in_channels, out_channels, kernel_size, **kwargs)
@@ -775,6 +1109,8 @@ def base_architecture(args):
     args.decoder_out_embed_dim = getattr(args, 'decoder_out_embed_dim', 256)
     args.decoder_attention = getattr(args, 'decoder_attention', 'True')
     args.share_input_output_embed = getattr(args, 'share_input_output_embed', False)
+    args.encoder_embed_grad = getattr(args, 'encoder_embed_grad', 'dense')
+    args.checkpoint_activations = getattr(args, 'checkpoint_activations', 0)
 
 @register_model_architecture('fconv', 'fconv_newsroom')
 def fconv_newsroom(args):
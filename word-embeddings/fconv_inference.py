@@ -0,0 +1,263 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+
+"""
+Inference-only versions of the topic-aware FConvEncoder and of a single
+FConvDecoder step, for TorchScript, torch.compile and ONNX.
+
+They are built from a trained FConvModel and compute the same outputs as
+the model in eval mode, but without incremental_state dicts, eval'd layer
+specs or GradMultiply: the decoder state (the input windows of the
+convolutions) is an explicit tensor that goes in and out of every step,
+and what depends only on the source is computed once by the encoder.
+"""
+
+import math
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+from .fconv import fold_weight_norm_
+
+
+def export_inference_modules(model):
+    """Build (InferenceEncoder, InferenceDecoderStep) from a trained
+    FConvModel. Weight norm of *model* is folded in place."""
+    model.eval()
+    fold_weight_norm_(model)
+    return InferenceEncoder(model.encoder, model.decoder), InferenceDecoderStep(model.decoder)
+
+
+def _positions(tokens, padding_idx: int, left_pad: bool):
+    """Positions of *tokens* as numbered by LearnedPositionalEmbedding."""
+    mask = tokens.ne(padding_idx)
+    seq_len = tokens.size(1)
+    positions = torch.arange(seq_len, device=tokens.device).unsqueeze(0) + (padding_idx + 1)
+    if left_pad:
+        positions = positions - seq_len + mask.long().sum(dim=1, keepdim=True)
+    return torch.where(mask, positions, tokens)
+
+
+def _parameter(tensor):
+    return nn.Parameter(tensor.detach().clone(), requires_grad=False)
+
+
+class InferenceEncoder(nn.Module):
+    """Encoder of the topic-aware model, plus the parts of the decoder that
+    depend only on the source.
+
+    forward(src_tokens, src_lengths, src_doctopic, src_wordtopics) returns
+    encoder_a (B x C x S, the attention keys), encoder_b (B x S x C, the
+    attention values, already multiplied by the sqrt(S) scale AttentionLayer
+    applies to its output), doctopic (B x 1 x topic_dim, the doc-topic part
+    of the target embedding) and doctopic_proj (B x conv_channels, its
+    projection by the decoder fc1), which are inputs of every
+    InferenceDecoderStep.
+    """
+
+    def __init__(self, encoder, decoder):
+        super().__init__()
+        if any(proj is not None for proj in encoder.projections):
+            raise ValueError('only encoders with equal-width layers can be exported')
+        self.embed_dim = encoder.embed_dim
+        self.padding_idx = encoder.embed_positions.padding_idx
+        self.left_pad = encoder.embed_positions.left_pad
+        embed_weight = encoder.embed_tokens.weight
+        if encoder.embed_delta is not None:
+            embed_weight = embed_weight + encoder.embed_delta.weight
+        self.embed_tokens = _parameter(embed_weight)
+        self.embed_positions = _parameter(encoder.embed_positions.weight)
+        self.fc1 = _Linear(encoder.fc1.weight, encoder.fc1.bias)
+        self.convolutions = nn.ModuleList([_EncoderConv(conv) for conv in encoder.convolutions])
+        self.lay_norm = _LayerNorm(encoder.lay_norm)
+        self.fc2 = _Linear(encoder.fc2.weight, encoder.fc2.bias)
+        # doc-topic projection of the decoder fc1, computed once per source
+        self.decoder_fc1_topic = _parameter(decoder.fc1.weight[:, decoder.embed_dim:])
+
+    def forward(self, src_tokens, src_lengths, src_doctopic, src_wordtopics):
+        # type: (Tensor, Tensor, Tensor, Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor]
+        positions = _positions(src_tokens, self.padding_idx, self.left_pad)
+        embedding = F.embedding(src_tokens, self.embed_tokens) + F.embedding(positions, self.embed_positions)
+        topics = src_wordtopics * src_doctopic.unsqueeze(1)
+
+        x = self.fc1(torch.cat([embedding, topics], dim=2))
+        for conv in self.convolutions:
+            x = self.lay_norm(conv(x) + x)
+        x = self.fc2(x)
+
+        y = torch.cat([x[:, :, :self.embed_dim] + embedding, x[:, :, self.embed_dim:] + topics], dim=2)
+        # sqrt(0.5) of the encoder times sqrt(S) of the attention; S is counted
+        # with a tensor op so that it stays dynamic in traced (ONNX) graphs
+        src_len = torch.ones_like(y[0, :, 0]).sum()
+        y = y * (src_len * 0.5).sqrt()
+
+        doctopic = src_doctopic.unsqueeze(1)
+        doctopic_proj = F.linear(src_doctopic, self.decoder_fc1_topic)
+        return x.transpose(1, 2), y, doctopic, doctopic_proj
+
+
+class InferenceDecoderStep(nn.Module):
+    """One step of the topic-aware decoder with explicit state.
+
+    forward(tokens, step, encoder_a, encoder_b, doctopic, doctopic_proj,
+    conv_state) takes the last target token (B), the 0-based index of the
+    step (a 0-dim tensor), the outputs of InferenceEncoder and the input
+    windows of the convolutions (num_layers x B x (kernel_size - 1) x C,
+    zeros at step 0, see initial_state). It returns the log-probabilities of
+    the next token (B x V), the averaged attention (B x S) and the new
+    conv_state. Beams are reordered by index_select on dimension 1 of
+    conv_state and dimension 0 of the other inputs.
+    """
+
+    def __init__(self, decoder):
+        super().__init__()
+        if any(proj is not None for proj in decoder.projections):
+            raise ValueError('only decoders with equal-width layers can be exported')
+        self.embed_dim = decoder.embed_dim
+        self.padding_idx = decoder.embed_positions.padding_idx
+        self.embed_tokens = _parameter(decoder.embed_tokens.weight)
+        self.embed_positions = _parameter(decoder.embed_positions.weight)
+        self.fc1_tokens = _Linear(decoder.fc1.weight[:, :decoder.embed_dim], decoder.fc1.bias)
+        self.layers = nn.ModuleList([
+            _DecoderLayer(conv, attention, decoder.embed_dim)
+            for conv, attention in zip(decoder.convolutions, decoder.attention)
+        ])
+        self.num_layers = len(self.layers)
+        # the eager decoder averages over all layers, with or without attention
+        self.num_attn_layers = len(decoder.attention)
+        self.kernel_size = decoder.convolutions[0].kernel_size[0]
+        self.conv_channels = decoder.convolutions[0].in_channels
+        self.lay_norm = _LayerNorm(decoder.lay_norm)
+        self.fc2 = _Linear(decoder.fc2.weight, decoder.fc2.bias)
+        self.fc3 = _Linear(decoder.fc3.weight, decoder.fc3.bias)
+
+    @torch.jit.export
+    def initial_state(self, encoder_b):
+        # type: (Tensor) -> Tensor
+        return encoder_b.new_zeros(
+            self.num_layers, encoder_b.size(0), self.kernel_size - 1, self.conv_channels)
+
+    def forward(self, tokens, step, encoder_a, encoder_b, doctopic, doctopic_proj, conv_state):
+        # type: (Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor) -> Tuple[Tensor, Tensor, Tensor]
+        position = (step + self.padding_idx + 1).view(1).expand(tokens.size(0))
+        embedding = F.embedding(tokens, self.embed_tokens) + F.embedding(position, self.embed_positions)
+        x = self.fc1_tokens(embedding) + doctopic_proj
+        target_embedding = embedding.unsqueeze(1)
+
+        attn = encoder_b.new_zeros(encoder_b.size(0), encoder_b.size(1))
+        new_state = []
+        i = 0
+        for layer in self.layers:
+            residual = x
+            window = torch.cat([conv_state[i], x.unsqueeze(1)], dim=1)
+            new_state.append(window[:, 1:])
+            x, attn_scores = layer(window, target_embedding, doctopic, encoder_a, encoder_b)
+            attn = attn + attn_scores
+            x = self.lay_norm(x + residual)
+            i += 1
+
+        x = self.fc3(self.fc2(x))
+        lprobs = F.log_softmax(x.float(), dim=-1)
+        attn = attn / self.num_attn_layers
+        return lprobs, attn, torch.stack(new_state)
+
+
+class _Linear(nn.Module):
+
+    def __init__(self, weight, bias):
+        super().__init__()
+        self.weight = _parameter(weight)
+        self.bias = _parameter(bias)
+
+    def forward(self, x):
+        return F.linear(x, self.weight, self.bias)
+
+
+class _LayerNorm(nn.Module):
+
+    def __init__(self, layer_norm):
+        super().__init__()
+        self.normalized_shape = list(layer_norm.normalized_shape)
+        self.eps = layer_norm.eps
+        self.weight = _parameter(layer_norm.weight)
+        self.bias = _parameter(layer_norm.bias)
+
+    def forward(self, x):
+        return F.layer_norm(x, self.normalized_shape, self.weight, self.bias, self.eps)
+
+
+def _ngtu(x, dim: int):
+    a, b = x.chunk(2, dim=dim)
+    return torch.tanh(a) * torch.sigmoid(b)
+
+
+class _EncoderConv(nn.Module):
+    """ConvTBC layer of the encoder followed by the NGTU gate, on B x T x C."""
+
+    def __init__(self, conv):
+        super().__init__()
+        kw = conv.kernel_size[0]
+        self.padding_l = (kw - 1) // 2
+        self.padding_r = kw // 2
+        # kernel_size x in_channels x out_channels -> out_channels x in_channels x kernel_size
+        self.weight = _parameter(conv.weight.permute(2, 1, 0))
+        self.bias = _parameter(conv.bias)
+
+    def forward(self, x):
+        x = F.pad(x.transpose(1, 2), [self.padding_l, self.padding_r])
+        x = F.conv1d(x, self.weight, self.bias)
+        return _ngtu(x, 1).transpose(1, 2)
+
+
+class _DecoderLayer(nn.Module):
+    """LinearizedConvolution, NGTU gate and attention of one decoder layer,
+    for a single step given the window of its last kernel_size inputs."""
+
+    def __init__(self, conv, attention, embed_dim: int):
+        super().__init__()
+        # kernel_size x in_channels x out_channels -> out_channels x (kernel_size * in_channels)
+        weight = conv.weight.permute(2, 0, 1).contiguous()
+        self.conv = _Linear(weight.view(weight.size(0), -1), conv.bias)
+        self.attention = _Attention(attention, embed_dim) if attention is not None else _NoAttention()
+
+    def forward(self, window, target_embedding, doctopic, encoder_a, encoder_b):
+        # type: (Tensor, Tensor, Tensor, Tensor, Tensor) -> Tuple[Tensor, Tensor]
+        x = _ngtu(self.conv(window.reshape(window.size(0), -1)), 1)
+        return self.attention(x, target_embedding, doctopic, encoder_a, encoder_b)
+
+
+class _Attention(nn.Module):
+    """AttentionLayer for a single step (x is B x C)."""
+
+    def __init__(self, attention, embed_dim: int):
+        super().__init__()
+        self.embed_dim = embed_dim
+        self.in_projection = _Linear(attention.in_projection.weight, attention.in_projection.bias)
+        self.out_projection = _Linear(attention.out_projection.weight, attention.out_projection.bias)
+
+    def forward(self, x, target_embedding, doctopic, encoder_a, encoder_b):
+        # type: (Tensor, Tensor, Tensor, Tensor, Tensor) -> Tuple[Tensor, Tensor]
+        residual = x
+        q = self.in_projection(x).unsqueeze(1)
+        q = torch.cat([
+            q[:, :, :self.embed_dim] + target_embedding,
+            q[:, :, self.embed_dim:] + doctopic,
+        ], dim=2) * math.sqrt(0.5)
+        attn_scores = F.softmax(torch.bmm(q, encoder_a).float(), dim=2).type_as(q)
+        x = torch.bmm(attn_scores, encoder_b).squeeze(1)
+        x = (self.out_projection(x) + residual) * math.sqrt(0.5)
+        return x, attn_scores.squeeze(1)
+
+
+class _NoAttention(nn.Module):
+
+    def forward(self, x, target_embedding, doctopic, encoder_a, encoder_b):
+        # type: (Tensor, Tensor, Tensor, Tensor, Tensor) -> Tuple[Tensor, Tensor]
+        return x, encoder_b.new_zeros(encoder_b.size(0), encoder_b.size(1))
@@ -6,19 +6,30 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
+import time
+_start_time = time.time()
+
+import io
+import resource
 import torch
 
 from fairseq import bleu, data, options, progress_bar, tokenizer, utils
 from fairseq.meters import StopwatchMeter, TimeMeter
+from fairseq.models.fconv import quantize_int8_
 from fairseq.sequence_generator import SequenceGenerator
 from fairseq.sequence_scorer import SequenceScorer
-from fairseq.vectordict import vector_dict
-import numpy as np
+from fairseq.vectordict import (
+    add_embedding_args, release_embedding_providers, set_embedding_arg_defaults, share_embeddings_,
+    startup_report,
+)
 
 def main(args):
     print(args)
 
-    use_cuda = torch.cuda.is_available() and not args.cpu
+    # int8 dynamic quantization only runs on the CPU
+    use_cuda = torch.cuda.is_available() and not args.cpu and args.quantize == 'none'
+    if not use_cuda and args.cpu_threads is not None:
+        torch.set_num_threads(args.cpu_threads)
 
     # Load dataset
     if args.replace_unk is None:
@@ -34,29 +45,57 @@ def main(args):
             [args.gen_subset],
             args.source_lang,
             args.target_lang,
-            args.doctopics, args.encoder_embed_dim,
+            args.doctopics,
         )
     if args.source_lang is None or args.target_lang is None:
         # record inferred languages in args
         args.source_lang, args.target_lang = dataset.src, dataset.dst
 
-    # Load ensemble
+    # Load ensemble; each model is built from the arguments stored in its own
+    # checkpoint, so models with different embedding providers can be mixed.
+    # Embedding options given here are used for checkpoints that lack them.
+    set_embedding_arg_defaults(args)
     print('| loading model(s) from {}'.format(', '.join(args.path)))
-    models, _ = utils.load_ensemble_for_inference(args.path, dataset.src_dict, dataset.dst_dict)
+    models = []
+    for path in args.path:
+        models.extend(utils.load_ensemble_for_inference([path], dataset.src_dict, dataset.dst_dict)[0])
+    release_embedding_providers()
+    num_shared = share_embeddings_(models)
+    if num_shared > 0:
+        print('| sharing {} identical embedding table(s) between models'.format(num_shared))
+    print(startup_report)
+
+    # models trained before the topic width was configurable expect topic
+    # vectors zero-padded to 512
+    topic_dim = ensemble_topic_dim(models)
+    split = dataset.splits[args.gen_subset]
+    if hasattr(split, 'topic_dim'):
+        split.topic_dim = max(split.topic_dim, topic_dim)
 
     print('| [{}] dictionary: {} types'.format(dataset.src, len(dataset.src_dict)))
     print('| [{}] dictionary: {} types'.format(dataset.dst, len(dataset.dst_dict)))
     print('| {} {} {} examples'.format(args.data, args.gen_subset, len(dataset.splits[args.gen_subset])))
 
+    # Load alignment dictionary for unknown word replacement
+    # (None if no unknown word replacement, empty if no path to align dictionary)
+    align_dict = utils.load_align_dict(args.replace_unk)
+
+    # Alignments are needed to replace unknown words and to print A- lines
+    if args.no_alignment and (align_dict is not None or args.score_reference):
+        raise ValueError('--no-alignment cannot be used with --replace-unk or --score-reference')
+    print_alignment = not args.quiet and not args.no_alignment
+
     # Optimize ensemble for generation
     for model in models:
         model.make_generation_fast_(
             beamable_mm_beam_size=None if args.no_beamable_mm else args.beam,
+            need_attn=not args.no_alignment,
         )
-
-    # Load alignment dictionary for unknown word replacement
-    # (None if no unknown word replacement, empty if no path to align dictionary)
-    align_dict = utils.load_align_dict(args.replace_unk)
+        if args.quantize == 'int8':
+            quantize_int8_(model)
+    print('| model size: {:.1f} MB ({})'.format(
+        sum(model_size_mb(model) for model in models),
+        'int8' if args.quantize == 'int8' else 'float32'))
 
     # Load dataset (possibly sharded)
     max_positions = min(model.max_encoder_positions() for model in models)
@@ -78,7 +117,8 @@ def main(args):
     if args.score_reference:
         translator = SequenceScorer(models)
     else:
-        translator = SequenceGenerator(
+        generator_cls = NoAlignmentSequenceGenerator if args.no_alignment else SequenceGenerator
+        translator = generator_cls(
             models, beam_size=args.beam, stop_early=(not args.no_early_stop),
             normalize_scores=(not args.unnormalized), len_penalty=args.lenpen,
             unk_penalty=args.unkpen)
@@ -118,10 +158,14 @@ def main(args):
 
             # Process top predictions
             for i, hypo in enumerate(hypos[:min(len(hypos), args.nbest)]):
+                # copy the alignment to the CPU only if it is used
+                alignment = None
+                if align_dict is not None or print_alignment:
+                    alignment = hypo['alignment'].int().cpu()
                 hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
                     hypo_tokens=hypo['tokens'].int().cpu(),
                     src_str=src_str,
-                    alignment=hypo['alignment'].int().cpu(),
+                    alignment=alignment,
                     align_dict=align_dict,
                     dst_dict=dataset.dst_dict,
                     remove_bpe=args.remove_bpe,
@@ -136,10 +180,11 @@ def main(args):
                             hypo['positional_scores'].tolist(),
                         ))
                     ))
-                    print('A-{}\t{}'.format(
-                        sample_id,
-                        ' '.join(map(lambda x: str(utils.item(x)), alignment))
-                    ))
+                    if print_alignment:
+                        print('A-{}\t{}'.format(
+                            sample_id,
+                            ' '.join(map(lambda x: str(utils.item(x)), alignment))
+                        ))
 
                 # Score only the top hypothesis
                 if has_target and i == 0:
@@ -157,26 +202,55 @@ def main(args):
         num_sentences, gen_timer.n, gen_timer.sum, 1. / gen_timer.avg))
     if has_target:
         print('| Generate {} with beam={}: {}'.format(args.gen_subset, args.beam, scorer.result_string()))
+    # ru_maxrss is in KB on Linux
+    print('| peak resident memory: {:.1f} MB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
 
 
-if __name__ == '__main__':
+class NoAlignmentSequenceGenerator(SequenceGenerator):
+    """SequenceGenerator for models that return no attention scores
+    (--no-alignment). The generator copies the scores of every step into its
+    alignment buffer, so a zero is returned in their place and broadcast by
+    the copy; the alignments of the hypotheses are then left zero."""
+
+    def _decode(self, *args, **kwargs):
+        probs, avg_attn = super()._decode(*args, **kwargs)
+        if avg_attn is None:
+            avg_attn = probs.new_zeros(1)
+        return probs, avg_attn
+
 
-    # word2vec
-    #embeddings = np.load('./word2vec.npy') # load pre_processed word2vec matrix
-    #embedding_mean = np.mean(embeddings,axis=0)
-    #embedding_std = np.std(embeddings,axis=0)
-    #vector_dict.embedding = np.nan_to_num((embeddings-embedding_mean)/(embedding_std*3.3)) # normalization
-    #vector_dict.embedding = np.nan_to_num(embeddings)
-    #vector_dict.embedding_dim = 500 # setting the embedding dim
-
-    # glove
-    embeddings = np.load('./glove.npy')
-    # embedding_mean = np.mean(embeddings,axis=0)
-    # embedding_std = np.std(embeddings,axis=0)
-    #vector_dict.embedding = np.nan_to_num((embeddings-embedding_mean)/(embedding_std*3.3))
-    vector_dict.embedding = np.nan_to_num(embeddings)
-    vector_dict.embedding_dim = 300
+def ensemble_topic_dim(models):
+    """Width of the topic vectors expected by *models*. The models of an
+    ensemble share one batch, so they must all expect the same width."""
+    topic_dims = sorted(set(model.encoder.topic_dim for model in models))
+    if len(topic_dims) > 1:
+        raise ValueError('the models expect topic vectors of different widths ({}) and cannot'
+                         ' be ensembled'.format(', '.join(str(dim) for dim in topic_dims)))
+    return topic_dims[0]
+
+
+def model_size_mb(model):
+    """Size of the serialized state dict of *model*, in MB."""
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / 2.**20
+
+
+if __name__ == '__main__':
+    startup_report.add('import', time.time() - _start_time)
 
     parser = options.get_generation_parser()
+    parser.add_argument('--cpu-threads', type=int, metavar='N',
+                        help='number of threads used by CPU ops (default: PyTorch default)')
+    parser.add_argument('--quantize', default='none', choices=['none', 'int8'],
+                        help='int8: dynamic int8 quantization of the linear and convolution'
+                             ' layers (implies --cpu)')
+    parser.add_argument('--no-alignment', action='store_true',
+                        help='do not compute the attention alignments nor print A- lines'
+                             ' (not with --replace-unk or --score-reference)')
+    add_embedding_args(parser)
+    # the embedding options stored in a checkpoint take precedence
+    parser.set_defaults(embedding_provider=None, normalize_embeddings=None, embedding_stats_chunk_size=None)
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3 -u
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Beam search over the ONNX graphs written by export_inference.py --onnx,
+run with onnxruntime. Batches come from the data pipeline of generate.py;
+the model itself runs without PyTorch.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import onnxruntime
+import torch
+
+from fairseq import bleu, data
+
+from export_inference import ENCODER_INPUTS, ENCODER_OUTPUTS, run_onnx
+
+
+def main(args):
+    options = onnxruntime.SessionOptions()
+    if args.cpu_threads is not None:
+        options.intra_op_num_threads = args.cpu_threads
+    encoder = onnxruntime.InferenceSession(
+        os.path.join(args.onnx_dir, 'encoder.onnx'), options, providers=['CPUExecutionProvider'])
+    decoder = onnxruntime.InferenceSession(
+        os.path.join(args.onnx_dir, 'decoder_step.onnx'), options, providers=['CPUExecutionProvider'])
+
+    # topic vectors are padded to the topic width of the exported model
+    topic_dim = next(i.shape[1] for i in encoder.get_inputs() if i.name == 'src_doctopic')
+    dataset = data.load_raw_text_dataset(
+        args.data, [args.gen_subset], args.source_lang, args.target_lang, args.doctopics,
+        topic_dim=topic_dim,
+    )
+    itr = dataset.eval_dataloader(
+        args.gen_subset, max_sentences=args.max_sentences,
+        skip_invalid_size_inputs_valid_test=True,
+    )
+
+    scorer = bleu.Scorer(dataset.dst_dict.pad(), dataset.dst_dict.eos(), dataset.dst_dict.unk())
+    num_sentences, num_tokens, seconds = 0, 0, 0.
+    has_target = False
+    for sample in itr:
+        start = time.perf_counter()
+        hypos = beam_search(
+            encoder, decoder, sample['net_input'], args.beam, args.max_len_b,
+            dataset.dst_dict.eos(), dataset.dst_dict.pad(), args.lenpen,
+        )
+        seconds += time.perf_counter() - start
+        for i, sample_id in enumerate(sample['id'].tolist()):
+            score, hypo_tokens = hypos[i][0]
+            hypo_tokens = torch.from_numpy(hypo_tokens).int()
+            num_sentences += 1
+            num_tokens += len(hypo_tokens)
+            if not args.quiet:
+                hypo_str = dataset.dst_dict.string(hypo_tokens, args.remove_bpe)
+                print('H-{}\t{}\t{}'.format(sample_id, score, hypo_str))
+            has_target = sample['target'] is not None
+            if has_target:
+                target_tokens = sample['target'][i]
+                target_tokens = target_tokens[target_tokens.ne(dataset.dst_dict.pad())].int()
+                scorer.add(target_tokens, hypo_tokens)
+
+    print('| Translated {} sentences ({} tokens) in {:.1f}s ({:.2f} tokens/s)'.format(
+        num_sentences, num_tokens, seconds, num_tokens / seconds if seconds > 0 else 0.))
+    if has_target:
+        print('| Generate {} with beam={}: {}'.format(args.gen_subset, args.beam, scorer.result_string()))
+
+
+def beam_search(encoder, decoder, net_input, beam, max_len, eos, pad, lenpen):
+    """Returns, for each sentence of the batch, its finished hypotheses
+    (score, tokens ending with eos), best first."""
+    encoder_out = run_onnx(encoder, {name: net_input[name].numpy() for name in ENCODER_INPUTS})
+    bsz = encoder_out[0].shape[0]
+
+    # the beams of a sentence are consecutive rows; beams are only reordered
+    # within a sentence, so the encoder outputs never need reordering
+    feeds = {name: np.repeat(out, beam, axis=0) for name, out in zip(ENCODER_OUTPUTS, encoder_out)}
+    num_layers, _, width, channels = next(i.shape for i in decoder.get_inputs() if i.name == 'conv_state')
+    feeds['conv_state'] = np.zeros((num_layers, bsz * beam, width, channels), dtype=np.float32)
+
+    tokens = np.full((bsz * beam, 1), eos, dtype=np.int64)
+    scores = np.zeros((bsz, beam), dtype=np.float32)
+    scores[:, 1:] = -np.inf  # all beams start identical, expand only the first
+    finalized = [[] for _ in range(bsz)]
+
+    for step in range(max_len + 1):
+        feeds['tokens'] = tokens[:, -1]
+        feeds['step'] = np.array(step, dtype=np.int64)
+        lprobs, _, feeds['conv_state'] = run_onnx(decoder, feeds)
+        lprobs[:, pad] = -np.inf
+        if step == max_len:
+            # force eos at the maximum length
+            eos_lprobs = lprobs[:, eos].copy()
+            lprobs[:] = -np.inf
+            lprobs[:, eos] = eos_lprobs
+        vocab = lprobs.shape[1]
+
+        # the 2 * beam best continuations of each sentence, best first, so
+        # that beam of them are left after removing those ending with eos
+        cand = (scores.reshape(-1, 1) + lprobs).reshape(bsz, beam * vocab)
+        top = np.argpartition(-cand, 2 * beam, axis=1)[:, :2 * beam]
+        top = np.take_along_axis(top, np.argsort(-np.take_along_axis(cand, top, 1), axis=1), 1)
+
+        rows = np.zeros(bsz * beam, dtype=np.int64)
+        next_tokens = np.full(bsz * beam, pad, dtype=np.int64)
+        next_scores = np.full(bsz * beam, -np.inf, dtype=np.float32)
+        for i in range(bsz):
+            rows[i * beam:(i + 1) * beam] = i * beam
+            live = 0
+            for idx in top[i]:
+                b, w = divmod(int(idx), vocab)
+                row, score = i * beam + b, cand[i, idx]
+                if not np.isfinite(score):
+                    break
+                if w == eos:
+                    if len(finalized[i]) < beam:
+                        hypo = np.append(tokens[row, 1:], eos)
+                        finalized[i].append((float(score) / (step + 1) ** lenpen, hypo))
+                elif live < beam and len(finalized[i]) < beam:
+                    rows[i * beam + live] = row
+                    next_tokens[i * beam + live] = w
+                    next_scores[i * beam + live] = score
+                    live += 1
+        if all(len(hypos) >= beam for hypos in finalized):
+            break
+
+        tokens = np.concatenate([tokens[rows], next_tokens[:, None]], axis=1)
+        feeds['conv_state'] = feeds['conv_state'][:, rows]
+        scores = next_scores.reshape(bsz, beam)
+
+    return [sorted(hypos, key=lambda hypo: -hypo[0]) for hypos in finalized]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Beam search over exported ONNX graphs')
+    parser.add_argument('data', metavar='DIR', help='path to data directory')
+    parser.add_argument('--onnx-dir', default='.', metavar='DIR',
+                        help='directory with encoder.onnx and decoder_step.onnx')
+    parser.add_argument('-s', '--source-lang', default=None, metavar='SRC', help='source language')
+    parser.add_argument('-t', '--target-lang', default=None, metavar='TARGET', help='target language')
+    parser.add_argument('--doctopics', default='doc-topics', metavar='SUFFIX',
+                        help='suffix of the document topic files (e.g. test.doc-topics)')
+    parser.add_argument('--gen-subset', default='test', metavar='SPLIT', help='data subset to generate')
+    parser.add_argument('--max-sentences', default=32, type=int, metavar='N', help='sentences per batch')
+    parser.add_argument('--beam', default=5, type=int, metavar='N', help='beam size')
+    parser.add_argument('--max-len-b', default=200, type=int, metavar='N', help='maximum output length')
+    parser.add_argument('--lenpen', default=1, type=float,
+                        help='length penalty: <1.0 favors shorter, >1.0 favors longer sentences')
+    parser.add_argument('--remove-bpe', nargs='?', const='@@ ', default=None,
+                        help='remove BPE tokens before scoring')
+    parser.add_argument('--quiet', action='store_true', help='only print final scores')
+    parser.add_argument('--cpu-threads', type=int, metavar='N',
+                        help='number of threads used by onnxruntime (default: onnxruntime default)')
+    main(parser.parse_args())
@@ -6,16 +6,16 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
-from fairseq import options
-from fairseq.vectordict import vector_dict
+import time
+_start_time = time.time()
+
+from fairseq import data, options
+from fairseq.vectordict import add_embedding_args, get_embedding_provider, startup_report
 
 from distributed_train import main as distributed_main
 from multiprocessing_train import main as multiprocessing_main
 from singleprocess_train import main as singleprocess_main
-import numpy as np
 
-from gensim.models import KeyedVectors
-from gensim.test.utils import datapath
 
 def main(args):
     if args.distributed_port > 0 \
@@ -26,40 +26,29 @@ def main(args):
     else:
         singleprocess_main(args)
 
-def load_glove():
-    glove_dict = {}
-    with open("glove.6B.300d.txt", 'r',encoding='utf8') as f:
-        for line in f:
-            values = line.split()
-            word = values[0]
-            vector = np.asarray(values[1:], "float32")
-            glove_dict[word] = vector
-    return glove_dict
-
-def load_word2vec():
-    word2vec_dict = {}
-    wv_from_text = KeyedVectors.load_word2vec_format(datapath('word2vec_pre_kv_c'), binary=False)
-    
 
 if __name__ == '__main__':
-    
-    # glove
-    embeddings = np.load('./glove.npy')
-    #embedding_mean = np.mean(embeddings,axis=0)
-    #embedding_std = np.std(embeddings,axis=0)
-    #vector_dict.embedding = np.nan_to_num((embeddings-embedding_mean)/(embedding_std*3.3))
-    vector_dict.embedding = np.nan_to_num(embeddings)
-    vector_dict.embedding_dim = 300
-    
-    # word2vec
-    #embeddings = np.load('./word2vec.npy') # load pre_processed word2vec matrix
-    #embedding_mean = np.mean(embeddings,axis=0)
-    #embedding_std = np.std(embeddings,axis=0)
-    #vector_dict.embedding = np.nan_to_num((embeddings-embedding_mean)/(embedding_std*3.3)) # normalization
-    #vector_dict.embedding = np.nan_to_num(embeddings)
-    #vector_dict.embedding_dim = 500 # setting the embedding dim
+    startup_report.add('import', time.time() - _start_time)
 
-    # training 
     parser = options.get_training_parser()
+    add_embedding_args(parser)
+    group = parser.add_argument_group('Device and precision')
+    group.add_argument('--cpu', action='store_true',
+                       help='train on the CPU even if a GPU is available')
+    group.add_argument('--cpu-threads', type=int, metavar='N',
+                       help='number of threads used by CPU ops (default: PyTorch default)')
+    group.add_argument('--amp', default='none', choices=['none', 'bf16', 'fp16'],
+                       help='mixed precision training: bf16 (CPU or GPU) or fp16 with'
+                            ' dynamic loss scaling (GPU only)')
     args = options.parse_args_and_arch(parser)
+
+    # pre-trained embeddings: --embedding-provider {glove-npy,word2vec,random}
+    # (loaded here so the startup report covers it; the model reuses the provider)
+    get_embedding_provider(args).load()
+
+    # topic width of the model: the width of the lemma-topic table, which is
+    # also the width of the topic vectors built by the dataset
+    args.topic_dim = data.infer_topic_dim(args.data, args.source_lang)
+
+    # training 
     main(args)
@@ -8,40 +8,138 @@
 # Modified by Shashi Narayan (2018)
 
 """
-Train a network on multiple GPUs.
+Train a network on multiple GPUs, or on the CPU.
 """
 
 from collections import OrderedDict
+import contextlib
 import math
+import os
 import torch
+import torch.distributed
 
 from fairseq import distributed_utils, optim, utils
 from fairseq.meters import AverageMeter, TimeMeter
 from fairseq.optim import lr_scheduler
 
 
+class DynamicLossScaler(object):
+    """Loss scale for fp16 training: divided by scale_factor (and the update
+    skipped) when the gradients overflow, multiplied by it after scale_window
+    updates without overflow."""
+
+    def __init__(self, init_scale=2.**15, scale_factor=2., scale_window=2000):
+        self.loss_scale = init_scale
+        self.scale_factor = scale_factor
+        self.scale_window = scale_window
+        self._iter = 0
+        self._last_overflow_iter = -1
+
+    def update_scale(self, overflow):
+        if overflow:
+            self.loss_scale /= self.scale_factor
+            self._last_overflow_iter = self._iter
+        elif (self._iter - self._last_overflow_iter) % self.scale_window == 0:
+            self.loss_scale *= self.scale_factor
+        self._iter += 1
+
+    def state_dict(self):
+        return {
+            'loss_scale': self.loss_scale,
+            'iter': self._iter,
+            'last_overflow_iter': self._last_overflow_iter,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.loss_scale = state_dict['loss_scale']
+        self._iter = state_dict['iter']
+        self._last_overflow_iter = state_dict['last_overflow_iter']
+
+
+class SparseRowSGD(torch.optim.Optimizer):
+    """SGD with momentum and weight decay for tables with sparse gradients.
+
+    Only the rows present in the gradient are decayed and updated, and only
+    their momentum is advanced (the other rows keep theirs until they are
+    seen again).
+    """
+
+    def __init__(self, params, lr, momentum=0., weight_decay=0., nesterov=False):
+        defaults = dict(lr=lr, momentum=momentum, weight_decay=weight_decay, nesterov=nesterov)
+        super().__init__(params, defaults)
+
+    def step(self, closure=None):
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad.data.coalesce()
+                rows, d_p = grad._indices()[0], grad._values()
+                if group['weight_decay'] != 0:
+                    d_p = d_p.add(p.data[rows], alpha=group['weight_decay'])
+                if group['momentum'] != 0:
+                    state = self.state[p]
+                    if 'momentum_buffer' not in state:
+                        state['momentum_buffer'] = torch.zeros_like(p.data)
+                    buf = state['momentum_buffer']
+                    buf_rows = buf[rows].mul_(group['momentum']).add_(d_p)
+                    buf[rows] = buf_rows
+                    if group['nesterov']:
+                        d_p = d_p.add(buf_rows, alpha=group['momentum'])
+                    else:
+                        d_p = buf_rows
+                p.data.index_add_(0, rows, d_p.mul(-group['lr']))
+
+
 class Trainer(object):
     """Main class for multi-GPU training.
 
     Each GPU has a full copy of the model and is assigned to its own Python
     process. Gradients are accumulated with torch.distributed.all_reduce and all
     model replicas are updated synchronously after each batch.
+
+    Without a GPU, or with --cpu, the model is trained on the CPU instead.
+    With --amp, forward passes run under autocast in bf16 or fp16 while the
+    parameters, gradients and optimizer state stay in float32.
     """
 
     def __init__(self, args, model, criterion):
 
-        if not torch.cuda.is_available():
-            raise NotImplementedError('Training on CPU is not supported')
-
         self.args = args
 
+        if torch.cuda.is_available() and not getattr(args, 'cpu', False):
+            self.device = torch.device('cuda', torch.cuda.current_device())
+        else:
+            self.device = torch.device('cpu')
+            if getattr(args, 'cpu_threads', None) is not None:
+                torch.set_num_threads(args.cpu_threads)
+
         # copy model and criterion to current device
-        self.model = model.cuda()
-        self.criterion = criterion.cuda()
+        self.model = model.to(self.device)
+        self.criterion = criterion.to(self.device)
+
+        # mixed precision: --amp {none,bf16,fp16}
+        self._amp_dtype = None
+        self._loss_scaler = None
+        amp = getattr(args, 'amp', 'none')
+        if amp != 'none':
+            if not hasattr(torch, 'autocast'):
+                raise NotImplementedError('--amp requires PyTorch 1.10 or newer')
+            if amp == 'fp16' and self.device.type != 'cuda':
+                raise ValueError('--amp fp16 requires a GPU, use --amp bf16 on the CPU')
+            self._amp_dtype = torch.float16 if amp == 'fp16' else torch.bfloat16
+            if amp == 'fp16':
+                # bf16 has the exponent range of float32 and needs no loss scaling
+                self._loss_scaler = DynamicLossScaler()
+
+        # embedding tables with sparse gradients are updated separately
+        self._sparse_params = [
+            m.weight for m in self.model.modules()
+            if isinstance(m, torch.nn.Embedding) and m.sparse and m.weight.requires_grad
+        ]
 
         # initialize optimizer and LR scheduler
-        self.optimizer = optim.build_optimizer(self.args, self.model.parameters())
-        self.lr_scheduler = lr_scheduler.build_lr_scheduler(self.args, self.optimizer)
+        self._build_optimizer()
 
         # initialize meters
         self.meters = OrderedDict()
@@ -56,6 +154,8 @@ class Trainer(object):
         self.meters['gnorm'] = AverageMeter()  # gradient norm
         self.meters['clip'] = AverageMeter()   # % of updates clipped
         self.meters['oom'] = AverageMeter()    # out of memory
+        self.meters['overflow'] = AverageMeter()  # % of fp16 updates skipped on overflow
+        self.meters['sparse_comm'] = AverageMeter()  # sparse grad volume / dense volume
 
         self._max_bsz_seen = 0
         self._num_updates = 0
@@ -63,18 +163,27 @@ class Trainer(object):
     def save_checkpoint(self, filename, extra_state):
         """Save all training state in a checkpoint file."""
         if self.args.distributed_rank == 0:  # only save one checkpoint
+            if self._loss_scaler is not None:
+                extra_state = dict(extra_state or {}, loss_scaler=self._loss_scaler.state_dict())
+            if self._sparse_optimizer is not None:
+                extra_state = dict(extra_state or {}, sparse_optimizer=self._sparse_optimizer.state_dict())
             utils.save_state(filename, self.args, self.model, self.criterion, self.optimizer,
                              self.lr_scheduler, self._num_updates, self._optim_history, extra_state)
 
     def load_checkpoint(self, filename):
         """Load all training state from a checkpoint file."""
-        extra_state, self._optim_history, last_optim_state = utils.load_model_state(
-            filename, self.model, cuda_device=torch.cuda.current_device())
+        extra_state, self._optim_history, last_optim_state = self._load_model_state(filename)
+        loss_scaler_state, sparse_optimizer_state = None, None
+        if extra_state is not None:
+            extra_state = dict(extra_state)
+            loss_scaler_state = extra_state.pop('loss_scaler', None)
+            sparse_optimizer_state = extra_state.pop('sparse_optimizer', None)
+        if loss_scaler_state is not None and self._loss_scaler is not None:
+            self._loss_scaler.load_state_dict(loss_scaler_state)
 
         if last_optim_state is not None:
             # rebuild optimizer after loading model, since params may have changed
-            self.optimizer = optim.build_optimizer(self.args, self.model.parameters())
-            self.lr_scheduler = lr_scheduler.build_lr_scheduler(self.args, self.optimizer)
+            self._build_optimizer()
 
             # only reload optimizer and lr_scheduler if they match
             last_optim = self._optim_history[-1]
@@ -82,11 +191,29 @@ class Trainer(object):
                 self.lr_scheduler.load_state_dict(last_optim['lr_scheduler_state'])
                 if last_optim['optimizer_name'] == self.optimizer.__class__.__name__:
                     self.optimizer.load_state_dict(last_optim_state)
+                    if sparse_optimizer_state is not None and self._sparse_optimizer is not None:
+                        self._sparse_optimizer.load_state_dict(sparse_optimizer_state)
 
             self._num_updates = last_optim['num_updates']
 
         return extra_state
 
+    def _load_model_state(self, filename):
+        """utils.load_model_state, with the tensors mapped to the trainer's
+        device, so that a checkpoint saved on a GPU can be resumed on the CPU
+        (or on another GPU)."""
+        if not os.path.exists(filename):
+            return None, [], None
+        state = torch.load(filename, map_location=self.device)
+        state = utils._upgrade_state_dict(state)
+        state['model'] = self.model.upgrade_state_dict(state['model'])
+        try:
+            self.model.load_state_dict(state['model'])
+        except Exception:
+            raise Exception('Cannot load model parameters from checkpoint, '
+                            'please ensure that the architectures match')
+        return state['extra_state'], state['optimizer_history'], state['last_optimizer_state']
+
     def train_step(self, sample):
         """Do forward, backward and parameter update."""
 
@@ -102,16 +229,19 @@ class Trainer(object):
         agg_logging_output = self.criterion.__class__.aggregate_logging_outputs(logging_outputs)
 
         # backward pass, all-reduce gradients and take an optimization step
-        grad_norm, ooms_bwd = self._backward_and_opt(loss, grad_denom)
+        grad_norm, ooms_bwd, overflow = self._backward_and_opt(loss, grad_denom)
 
         # update meters
         self.meters['wps'].update(ntokens)
         self.meters['ups'].update(1.)
         self.meters['wpb'].update(ntokens)
         self.meters['bsz'].update(nsentences)
-        self.meters['gnorm'].update(grad_norm)
-        self.meters['clip'].update(1. if grad_norm > self.args.clip_norm else 0.)
+        if not overflow:
+            self.meters['gnorm'].update(grad_norm)
+            self.meters['clip'].update(1. if grad_norm > self.args.clip_norm else 0.)
         self.meters['oom'].update(ooms_fwd + ooms_bwd)
+        if self._loss_scaler is not None:
+            self.meters['overflow'].update(1. if overflow else 0.)
 
         # update loss meters for training
         if 'loss' in agg_logging_output:
@@ -128,7 +258,7 @@ class Trainer(object):
             self.model.eval()
         else:
             self.model.train()
-            self.optimizer.zero_grad()
+            self._zero_grad()
 
         loss = None
         sample_size = 0
@@ -139,7 +269,7 @@ class Trainer(object):
         oom = 0
         if sample is not None:
             try:
-                with utils.maybe_no_grad(eval):
+                with utils.maybe_no_grad(eval), self._autocast():
                     # calculate loss and sample size
                     loss, sample_size, logging_output_ = self.criterion(self.model, sample)
                     logging_output.update(logging_output_)
@@ -148,8 +278,7 @@ class Trainer(object):
                     print('| WARNING: ran out of memory, skipping batch')
                     oom = 1
                     loss = None
-                    if hasattr(torch.cuda, 'empty_cache'):
-                        torch.cuda.empty_cache()
+                    self._empty_cache()
                 else:
                     raise e
 
@@ -170,21 +299,30 @@ class Trainer(object):
         if loss is not None:
             try:
                 # backward pass
+                if self._loss_scaler is not None:
+                    # scale the loss so that small fp16 gradients do not underflow
+                    loss = loss * self._loss_scaler.loss_scale
                 loss.backward()
             except RuntimeError as e:
                 if 'out of memory' in str(e):
                     print('| WARNING: ran out of memory, skipping batch')
                     oom = 1
-                    if hasattr(torch.cuda, 'empty_cache'):
-                        torch.cuda.empty_cache()
-                    self.optimizer.zero_grad()
+                    self._empty_cache()
+                    self._zero_grad()
                 else:
                     raise e
 
-        # all-reduce grads and rescale by grad_denom
+        # all-reduce grads and rescale by grad_denom (and undo the loss scale)
+        if self._loss_scaler is not None:
+            grad_denom = grad_denom * self._loss_scaler.loss_scale
         if self.args.distributed_world_size > 1:
-            grads = [p.grad.data for p in self.model.parameters() if p.requires_grad]
+            sparse_ids = set(id(p) for p in self._sparse_params)
+            grads = [
+                p.grad.data for p in self.model.parameters()
+                if p.requires_grad and id(p) not in sparse_ids
+            ]
             distributed_utils.all_reduce_and_rescale_tensors(grads, grad_denom)
+            self._all_reduce_sparse_grads(grad_denom)
         else:
             for p in self.model.parameters():
                 if p.requires_grad:
@@ -192,19 +330,116 @@ class Trainer(object):
                         p.grad.data.div_(grad_denom)
 
         # clip grads
-        if self.args.clip_norm > 0:
-            grad_norm = utils.item(torch.nn.utils.clip_grad_norm(self.model.parameters(), self.args.clip_norm))
-        else:
-            grad_norm = math.sqrt(sum(p.grad.data.norm()**2 for p in self.model.parameters() if p.grad is not None))
+        grad_norm = self._clip_grads(self.args.clip_norm)
+
+        # skip the update if the scaled fp16 gradients overflowed; the
+        # gradients are all-reduced, so all workers skip the same updates
+        overflow = False
+        if self._loss_scaler is not None:
+            overflow = not math.isfinite(grad_norm)
+            self._loss_scaler.update_scale(overflow)
+            if overflow:
+                print('| WARNING: gradient overflow, reducing loss scale to {}'.format(
+                    self._loss_scaler.loss_scale))
+                self._zero_grad()
+                return grad_norm, oom, overflow
 
         # take an optimization step
         self.optimizer.step()
+        if self._sparse_optimizer is not None:
+            for group in self._sparse_optimizer.param_groups:
+                group['lr'] = self.get_lr()
+            self._sparse_optimizer.step()
         self._num_updates += 1
 
         # update learning rate
         self.lr_scheduler.step_update(self._num_updates)
 
-        return grad_norm, oom
+        return grad_norm, oom, overflow
+
+    def _clip_grads(self, max_norm):
+        """Clip the gradients to max_norm (if > 0) and return their norm.
+
+        The per-parameter norms are reduced on the device, so there is a
+        single device-to-host copy per update.
+        """
+        grads = [p.grad.data for p in self.model.parameters() if p.grad is not None]
+        if len(grads) == 0:
+            return 0.
+        grad_norm = utils.item(torch.stack([g.norm() for g in grads]).norm())
+        if max_norm > 0 and grad_norm > max_norm and math.isfinite(grad_norm):
+            clip_coef = max_norm / (grad_norm + 1e-6)
+            for g in grads:
+                g.mul_(clip_coef)
+        return grad_norm
+
+    def _autocast(self):
+        if self._amp_dtype is None:
+            return contextlib.ExitStack()
+        return torch.autocast(self.device.type, dtype=self._amp_dtype)
+
+    def _build_optimizer(self):
+        if len(self._sparse_params) > 0 and self.args.optimizer not in ('sgd', 'nag'):
+            raise ValueError('sparse embedding gradients (--encoder-embed-grad sparse or delta) '
+                             'are only supported with --optimizer sgd or nag')
+        sparse_ids = set(id(p) for p in self._sparse_params)
+        params = [p for p in self.model.parameters() if id(p) not in sparse_ids]
+        self.optimizer = optim.build_optimizer(self.args, params)
+        self.lr_scheduler = lr_scheduler.build_lr_scheduler(self.args, self.optimizer)
+        # most optimizers (and their momentum buffers) cannot handle sparse
+        # gradients, so touched embedding rows get an SGD update at the
+        # current learning rate, with the momentum and weight decay of the
+        # main optimizer (which is SGD or NAG, see above)
+        self._sparse_optimizer = None
+        if len(self._sparse_params) > 0:
+            group = self.optimizer.optimizer.param_groups[0]
+            self._sparse_optimizer = SparseRowSGD(
+                self._sparse_params, lr=self.get_lr(),
+                momentum=group.get('momentum', 0.),
+                weight_decay=group.get('weight_decay', 0.),
+                nesterov=self.args.optimizer == 'nag',
+            )
+
+    def _zero_grad(self):
+        self.optimizer.zero_grad()
+        if self._sparse_optimizer is not None:
+            self._sparse_optimizer.zero_grad()
+
+    def _all_reduce_sparse_grads(self, grad_denom):
+        """All-reduce sparse embedding gradients by exchanging only the rows
+        that were touched on each worker, instead of the whole table."""
+        world_size = self.args.distributed_world_size
+        for p in self._sparse_params:
+            if p.grad is not None:
+                grad = p.grad.data.coalesce()
+            else:
+                grad = torch.sparse_coo_tensor(
+                    p.data.new_zeros(1, 0).long(), p.data.new_zeros(0, p.size(1)), p.size())
+            indices, values = grad._indices(), grad._values()
+
+            # pad to the largest number of rows on any worker, then gather
+            nnz = indices.new_tensor([indices.size(1)])
+            all_nnz = [nnz.clone() for _ in range(world_size)]
+            torch.distributed.all_gather(all_nnz, nnz)
+            all_nnz = [int(n) for n in all_nnz]
+            max_nnz = max(all_nnz)
+            padded_indices = indices.new_zeros(1, max_nnz)
+            padded_indices[:, :indices.size(1)] = indices
+            padded_values = values.new_zeros(max_nnz, values.size(1))
+            padded_values[:values.size(0)] = values
+            all_indices = [padded_indices.clone() for _ in range(world_size)]
+            all_values = [padded_values.clone() for _ in range(world_size)]
+            torch.distributed.all_gather(all_indices, padded_indices)
+            torch.distributed.all_gather(all_values, padded_values)
+
+            grad = torch.sparse_coo_tensor(
+                torch.cat([i[:, :n] for i, n in zip(all_indices, all_nnz)], dim=1),
+                torch.cat([v[:n] for v, n in zip(all_values, all_nnz)], dim=0),
+                p.size(),
+            ).coalesce()
+            p.grad = grad.div_(grad_denom)
+            self.meters['sparse_comm'].update(
+                world_size * max_nnz * (p.size(1) + 1) / float(p.numel()))
 
     def valid_step(self, sample):
         """Do forward pass in evaluation mode."""
@@ -254,9 +489,12 @@ class Trainer(object):
     def _prepare_sample(self, sample, volatile):
         if sample is None or len(sample) == 0:
             return None
-        if hasattr(torch.cuda, 'empty_cache'):
-            # clear the caching allocator if this is the largest sample we've seen
-            if sample['target'].size(0) > self._max_bsz_seen:
-                self._max_bsz_seen = sample['target'].size(0)
-                torch.cuda.empty_cache()
-        return utils.make_variable(sample, volatile=volatile, cuda=True)
+        # clear the caching allocator if this is the largest sample we've seen
+        if sample['target'].size(0) > self._max_bsz_seen:
+            self._max_bsz_seen = sample['target'].size(0)
+            self._empty_cache()
+        return utils.make_variable(sample, volatile=volatile, cuda=self.device.type == 'cuda')
+
+    def _empty_cache(self):
+        if self.device.type == 'cuda' and hasattr(torch.cuda, 'empty_cache'):
+            torch.cuda.empty_cache()
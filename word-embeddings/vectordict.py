@@ -1,4 +1,366 @@
+from collections import OrderedDict
+import contextlib
+import os
+import time
 import numpy as np
+import torch.nn as nn
+
+# pre-trained vectors are rescaled to NORM_SCALE standard deviations per dimension
+NORM_SCALE = 3.3
+
+
+def add_embedding_args(parser):
+    group = parser.add_argument_group('Pre-trained embeddings')
+    group.add_argument('--embedding-provider', default='glove-npy',
+                       choices=sorted(EMBEDDING_PROVIDER_REGISTRY.keys()),
+                       help='source of the encoder token embeddings')
+    group.add_argument('--embedding-path', metavar='FILE',
+                       help='embedding file (default: ./glove.npy for glove-npy, '
+                            './word2vec.npy for word2vec); word2vec also accepts '
+                            'word2vec text/binary files')
+    group.add_argument('--embedding-dim', type=int, metavar='N',
+                       help='number of embedding columns to use (default: 300 for glove-npy, '
+                            '500 for word2vec, --encoder-embed-dim for random)')
+    group.add_argument('--normalize-embeddings', action='store_true',
+                       help='standardize pre-trained vectors per dimension; the statistics and '
+                            'the normalized matrix are cached next to the embedding file')
+    group.add_argument('--embedding-stats-chunk-size', default=65536, type=int, metavar='N',
+                       help='number of rows read at a time when computing normalization statistics')
+    return group
+
+
+def embedding_stats(path, chunk_size=65536):
+    """Per-dimension mean and (population) std of an .npy embedding matrix,
+    computed in a single streaming pass over memory-mapped row chunks.
+
+    *path* may also be an in-memory matrix.
+    """
+    embeddings = np.load(path, mmap_mode='r') if isinstance(path, str) else path
+    count = 0
+    mean = np.zeros(embeddings.shape[1], dtype=np.float64)
+    m2 = np.zeros(embeddings.shape[1], dtype=np.float64)
+    for start in range(0, embeddings.shape[0], chunk_size):
+        chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float64)
+        n = chunk.shape[0]
+        chunk_mean = chunk.mean(axis=0)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+        # merge chunk moments into the running ones (Chan et al.)
+        delta = chunk_mean - mean
+        total = count + n
+        mean += delta * n / total
+        m2 += chunk_m2 + delta ** 2 * count * n / total
+        count = total
+    return mean, np.sqrt(m2 / count)
+
+
+def normalize_embedding(embeddings, mean, std):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nan_to_num((embeddings - mean) / (std * NORM_SCALE)).astype(embeddings.dtype)
+
+
+def _normalization_cache(path):
+    root, _ = os.path.splitext(path)
+    return root + '.norm-stats.npz', root + '.normalized.npy'
+
+
+def _cache_is_fresh(path, stats_path, normalized_path):
+    if not (os.path.exists(stats_path) and os.path.exists(normalized_path)):
+        return False
+    src = os.stat(path)
+    with np.load(stats_path) as stats:
+        return (int(stats['source_size']) == src.st_size
+                and int(stats['source_mtime_ns']) == src.st_mtime_ns
+                and float(stats['scale']) == NORM_SCALE)
+
+
+def build_normalization_cache(path, chunk_size=65536):
+    """Compute normalization statistics for the embedding file at *path* and
+    write them, together with the normalized matrix, to its cache."""
+    stats_path, normalized_path = _normalization_cache(path)
+    print('| computing normalization statistics for {}'.format(path))
+    mean, std = embedding_stats(path, chunk_size)
+
+    embeddings = np.load(path, mmap_mode='r')
+    tmp_path = normalized_path + '.tmp.npy'
+    normalized = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=embeddings.dtype,
+                                           shape=embeddings.shape)
+    for start in range(0, embeddings.shape[0], chunk_size):
+        chunk = embeddings[start:start + chunk_size]
+        normalized[start:start + chunk_size] = normalize_embedding(chunk, mean, std)
+    normalized.flush()
+    del normalized
+
+    # write to temporary files first so concurrent workers never read a partial cache
+    src = os.stat(path)
+    tmp_stats_path = stats_path + '.tmp.npz'
+    np.savez(tmp_stats_path, mean=mean, std=std, scale=NORM_SCALE,
+             source_size=src.st_size, source_mtime_ns=src.st_mtime_ns)
+    os.replace(tmp_path, normalized_path)
+    os.replace(tmp_stats_path, stats_path)
+    return mean, std
+
+
+def load_embedding(path, normalize=False, chunk_size=65536):
+    """Load a pre-trained embedding matrix, optionally normalized.
+
+    Normalized matrices are read from the cache next to *path*, which is
+    (re)built only when it is missing or older than the embedding file.
+    """
+    if not normalize:
+        return np.nan_to_num(np.load(path))
+    stats_path, normalized_path = _normalization_cache(path)
+    if not _cache_is_fresh(path, stats_path, normalized_path):
+        build_normalization_cache(path, chunk_size)
+    return np.load(normalized_path)
+
+
+def load_embedding_stats(path):
+    """Return the cached (mean, std) of the embedding file at *path*."""
+    stats_path, _ = _normalization_cache(path)
+    with np.load(stats_path) as stats:
+        return stats['mean'], stats['std']
+
+
+class StartupReport(object):
+    """Accumulates wall-clock time spent in the stages of process startup."""
+
+    def __init__(self):
+        self.times = OrderedDict()
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.) + seconds
+
+    @contextlib.contextmanager
+    def section(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def __str__(self):
+        return '| startup: {} (total {:.2f}s)'.format(
+            ', '.join('{} {:.2f}s'.format(name, t) for name, t in self.times.items()),
+            sum(self.times.values()),
+        )
+
+
+startup_report = StartupReport()
+
+
+EMBEDDING_PROVIDER_REGISTRY = {}
+
+
+def register_embedding_provider(name):
+    """Decorator to register a new embedding provider."""
+
+    def register_embedding_provider_cls(cls):
+        if name in EMBEDDING_PROVIDER_REGISTRY:
+            raise ValueError('Cannot register duplicate embedding provider ({})'.format(name))
+        if not issubclass(cls, EmbeddingProvider):
+            raise ValueError('Embedding provider ({}: {}) must extend EmbeddingProvider'.format(
+                name, cls.__name__))
+        EMBEDDING_PROVIDER_REGISTRY[name] = cls
+        return cls
+
+    return register_embedding_provider_cls
+
+
+# embedding options given on the command line of generate.py; they stand in
+# for the options missing from checkpoints saved before they existed
+_EMBEDDING_ARG_DEFAULTS = {}
+
+
+def set_embedding_arg_defaults(args):
+    """Use the embedding options given in *args* (those not None) for models
+    whose stored arguments lack them."""
+    for name in ('embedding_provider', 'embedding_path', 'embedding_dim',
+                 'normalize_embeddings', 'embedding_stats_chunk_size'):
+        value = getattr(args, name, None)
+        if value is not None:
+            _EMBEDDING_ARG_DEFAULTS[name] = value
+
+
+def embedding_arg(args, name, default):
+    return getattr(args, name, _EMBEDDING_ARG_DEFAULTS.get(name, default))
+
+
+def build_embedding_provider(args):
+    return EMBEDDING_PROVIDER_REGISTRY[embedding_arg(args, 'embedding_provider', 'glove-npy')](args)
+
+
+_EMBEDDING_PROVIDERS = {}
+
+
+def get_embedding_provider(args):
+    """Return the provider for *args*. Models built with the same embedding
+    configuration share one provider, so the matrix is only loaded once."""
+    provider = build_embedding_provider(args)
+    return _EMBEDDING_PROVIDERS.setdefault(provider.cache_key(), provider)
+
+
+def release_embedding_providers():
+    """Drop the matrices cached by all providers once models are built."""
+    for provider in _EMBEDDING_PROVIDERS.values():
+        provider.release()
+
+
+def share_embeddings_(models):
+    """Make embedding tables with identical contents share one parameter
+    across (and within) *models*, e.g. after loading an ensemble.
+
+    Only tables that are equal element by element are shared: the frozen
+    pre-trained tables of --encoder-embed-grad delta models built from the
+    same vectors, but not tables fine-tuned by different training runs.
+    """
+    unique = []
+    replaced = {}
+    for model in models:
+        for module in model.modules():
+            if not isinstance(module, nn.Embedding) or id(module.weight) in replaced:
+                continue
+            weight = module.weight
+            for other in unique:
+                if other is weight:
+                    break
+                if (other.size() == weight.size() and other.dtype == weight.dtype
+                        and other.device == weight.device and other.data.equal(weight.data)):
+                    replaced[id(weight)] = other
+                    break
+            else:
+                unique.append(weight)
+
+    # rebind every reference (e.g. tied output projections) to the shared table
+    for model in models:
+        for module in model.modules():
+            for name, param in module._parameters.items():
+                if param is not None and id(param) in replaced:
+                    module._parameters[name] = replaced[id(param)]
+    return len(replaced)
+
+
+class EmbeddingProvider(object):
+    """Source of the encoder's token embedding matrix.
+
+    Heavy dependencies must be imported inside :meth:`_load` so that they are
+    only paid for by the provider that is actually selected.
+    """
+
+    default_path = None
+    default_dim = None
+
+    def __init__(self, args):
+        self.args = args
+        self.path = embedding_arg(args, 'embedding_path', None) or self.default_path
+        self.embedding_dim = embedding_arg(args, 'embedding_dim', None) or self.default_dim
+        self.normalize = embedding_arg(args, 'normalize_embeddings', False)
+        self.chunk_size = embedding_arg(args, 'embedding_stats_chunk_size', 65536)
+        self._embedding = None
+        self._loaded = False
+
+    def cache_key(self):
+        return (type(self).__name__, self.path, self.embedding_dim, self.normalize)
+
+    def load(self):
+        """Return a num_embeddings x embedding_dim matrix, or None if the model
+        should initialize its embeddings itself. The matrix is loaded once and
+        cached until :meth:`release` is called."""
+        if not self._loaded:
+            with startup_report.section('embedding'):
+                embeddings = self._load()
+            if embeddings is not None:
+                embeddings = embeddings[:, :self.embedding_dim]
+            self._embedding = embeddings
+            self._loaded = True
+        return self._embedding
+
+    def release(self):
+        self._embedding = None
+        self._loaded = False
+
+    def _load(self):
+        raise NotImplementedError
+
+    def _dictionary_path(self):
+        return os.path.join(self.args.data, 'dict.{}.txt'.format(self.args.source_lang))
+
+    def _load_dictionary(self):
+        from fairseq.dictionary import Dictionary
+        with startup_report.section('dictionary'):
+            return Dictionary.load(self._dictionary_path())
+
+
+@register_embedding_provider('glove-npy')
+class GloveNpyProvider(EmbeddingProvider):
+    """GloVe vectors pre-aligned with the source dictionary (.npy)."""
+
+    default_path = './glove.npy'
+    default_dim = 300
+
+    def _load(self):
+        return load_embedding(self.path, self.normalize, self.chunk_size)
+
+
+@register_embedding_provider('word2vec')
+class Word2VecProvider(EmbeddingProvider):
+    """word2vec vectors, either pre-aligned with the source dictionary (.npy)
+    or in word2vec text/binary format (requires gensim)."""
+
+    default_path = './word2vec.npy'
+    default_dim = 500
+
+    def _load(self):
+        if self.path.endswith('.npy'):
+            return load_embedding(self.path, self.normalize, self.chunk_size)
+
+        # the vectors of the source dictionary are written to an .npy file in
+        # the data directory once, and loaded (and normalized) from it like a
+        # pre-aligned file afterwards
+        aligned_path = self._aligned_path()
+        dict_path = self._dictionary_path()
+        if not (os.path.exists(aligned_path)
+                and os.stat(aligned_path).st_mtime_ns >= max(
+                    os.stat(self.path).st_mtime_ns, os.stat(dict_path).st_mtime_ns)):
+            self._write_aligned(aligned_path)
+        return load_embedding(aligned_path, self.normalize, self.chunk_size)
+
+    def _aligned_path(self):
+        root, _ = os.path.splitext(os.path.basename(self.path))
+        return os.path.join(self.args.data, '{}.{}.npy'.format(root, self.args.source_lang))
+
+    def _write_aligned(self, aligned_path):
+        from gensim.models import KeyedVectors
+        print('| aligning {} with the source dictionary'.format(self.path))
+        wv = KeyedVectors.load_word2vec_format(self.path, binary=self.path.endswith('.bin'))
+        dictionary = self._load_dictionary()
+
+        embeddings = np.empty([len(dictionary), wv.vector_size], dtype=np.float32)
+        # special symbols get fixed random vectors, as in VectorDict.add_vector
+        for i in range(dictionary.nspecial):
+            np.random.seed(10 * (i + 1))
+            embeddings[i] = np.random.random([wv.vector_size])
+        unk = embeddings[dictionary.unk()]
+        for i in range(dictionary.nspecial, len(dictionary)):
+            word = dictionary[i]
+            embeddings[i] = wv[word] if word in wv else unk
+
+        # write to a temporary file first so concurrent workers never read a partial matrix
+        tmp_path = aligned_path + '.tmp.npy'
+        np.save(tmp_path, embeddings)
+        os.replace(tmp_path, aligned_path)
+
+
+@register_embedding_provider('random')
+class RandomProvider(EmbeddingProvider):
+    """No pre-trained vectors; the model initializes its own embeddings."""
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.embedding_dim = self.embedding_dim or getattr(args, 'encoder_embed_dim', 512)
+
+    def _load(self):
+        return None
+
 
 class VectorDict:
     def __init__(self):